@@ -0,0 +1,278 @@
+"""Concurrent batch generation of message drafts."""
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import openai
+
+from message.chat import system_message
+from message.data import get_features_batch
+from message.history import count_tokens
+from message.model import ChatModel
+
+MODEL = "gpt-4o-mini"
+# tokens reserved for each completion when rate limiting
+COMPLETION_TOKENS = 400
+
+
+def estimate_tokens(messages: list[dict[str, str]]) -> int:
+    """Estimate the tokens a request counts against the rate limit.
+
+    The estimated prompt tokens plus the tokens reserved for the completion.
+
+    Parameters
+    ----------
+    messages : list[dict[str, str]]
+        The messages of the request.
+
+    Returns
+    -------
+    int
+        The estimated number of tokens.
+    """
+    return count_tokens(messages) + COMPLETION_TOKENS
+
+
+class RateLimiter:
+    """Token bucket limiting requests and tokens per minute.
+
+    Both buckets start full, so up to a minute's worth of requests can be
+    sent in a burst, and refill continuously.
+
+    Parameters
+    ----------
+    requests_per_minute : int, optional
+        Maximum requests per minute, unlimited if None.
+    tokens_per_minute : int, optional
+        Maximum tokens per minute, unlimited if None.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int | None = None,
+        tokens_per_minute: int | None = None,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(
+                self.requests_per_minute,
+                self._requests + elapsed * self.requests_per_minute / 60,
+            )
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self.tokens_per_minute,
+                self._tokens + elapsed * self.tokens_per_minute / 60,
+            )
+
+    def _wait_time(self, tokens: int) -> float:
+        """Seconds until a request of `tokens` tokens fits in both buckets."""
+        wait = 0.0
+        if self.requests_per_minute and self._requests < 1:
+            wait = (1 - self._requests) * 60 / self.requests_per_minute
+        if self.tokens_per_minute:
+            # a request larger than the bucket only waits for a full bucket
+            needed = min(tokens, self.tokens_per_minute)
+            if self._tokens < needed:
+                wait = max(wait, (needed - self._tokens) * 60 / self.tokens_per_minute)
+
+        return wait
+
+    async def acquire(self, tokens: int = 0):
+        """Wait until a request can be sent.
+
+        Callers are served in order.
+
+        Parameters
+        ----------
+        tokens : int
+            Tokens of the request.
+        """
+        async with self._lock:
+            self._refill()
+            while (wait := self._wait_time(tokens)) > 0:
+                await asyncio.sleep(wait)
+                self._refill()
+
+            if self.requests_per_minute:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+
+
+def load_completed(output: str | Path) -> set[str]:
+    """Get the session groups that already have a draft.
+
+    A line cut off by a crash is ignored, its session group is drafted again.
+
+    Parameters
+    ----------
+    output : str or Path
+        The JSONL drafts file.
+
+    Returns
+    -------
+    set[str]
+        The session groups with a draft.
+    """
+    if not os.path.exists(output):
+        return set()
+
+    completed = set()
+    with open(output, "r") as f:
+        for line in f:
+            try:
+                draft = json.loads(line)
+            except ValueError:
+                continue
+            if draft.get("error") is None:
+                completed.add(draft["session_group"])
+
+    return completed
+
+
+def _end_last_line(output: str | Path):
+    """Terminate a last line cut off by a crash, so appends start on a new line."""
+    if not os.path.exists(output) or os.path.getsize(output) == 0:
+        return
+
+    with open(output, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def _open_output(output: str | Path):
+    """Open the drafts file to append to it."""
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    _end_last_line(output)
+
+    return open(output, "a")
+
+
+def _append_line(f, line: str):
+    f.write(line)
+    f.flush()
+
+
+async def generate_batch(
+    session_groups: list[str],
+    output: str | Path,
+    concurrency: int = 8,
+    requests_per_minute: int | None = None,
+    tokens_per_minute: int | None = None,
+    bypass_cache: bool = False,
+    chat_model: ChatModel | None = None,
+) -> dict[str, int]:
+    """Draft the first message of many sessions concurrently.
+
+    Each draft is appended to the JSONL output as soon as it is done, as
+    ``{"session_group", "message", "error"}``. Session groups that already
+    have a draft in the output are skipped, so an interrupted batch resumes
+    where it stopped; failed drafts are written with their error and retried
+    on the next run.
+
+    Parameters
+    ----------
+    session_groups : list[str]
+        The session groups to draft messages for.
+    output : str or Path
+        The JSONL drafts file.
+    concurrency : int
+        Maximum number of requests in flight.
+    requests_per_minute : int, optional
+        Maximum requests per minute, unlimited if None.
+    tokens_per_minute : int, optional
+        Maximum (estimated) tokens per minute, unlimited if None.
+    bypass_cache : bool
+        Whether to skip the LLM response cache lookup.
+    chat_model : ChatModel, optional
+        The client, by default one allowing `concurrency` requests in flight.
+
+    Returns
+    -------
+    dict[str, int]
+        Number of drafted, failed and skipped (already drafted) session
+        groups, each counted once.
+    """
+    completed = load_completed(output)
+    requested = list(dict.fromkeys(session_groups))
+    pending = [
+        session_group for session_group in requested if session_group not in completed
+    ]
+    features = get_features_batch(pending)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    summary = {"drafted": 0, "failed": 0, "skipped": len(requested) - len(pending)}
+    queue = iter(pending)
+
+    async def draft(model: ChatModel, session_group: str) -> dict:
+        if not features[session_group]:
+            return {"message": None, "error": "unknown session group"}
+
+        params = {
+            "temperature": 0,
+            "model": MODEL,
+            "messages": [system_message(features[session_group])],
+        }
+        # cached drafts are free, only requests count against the rate limit
+        message = None if bypass_cache else model.get_cached_completion(**params)
+        if message is None:
+            await limiter.acquire(estimate_tokens(params["messages"]))
+            try:
+                message = await model.aget_completion(**params, bypass_cache=True)
+            except openai.error.OpenAIError as e:
+                return {"message": None, "error": repr(e)}
+
+        return {"message": message, "error": None}
+
+    async def worker(model: ChatModel, f, writer: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+        # workers share the iterator, each takes the next session group
+        for session_group in queue:
+            try:
+                result = await draft(model, session_group)
+            except Exception as e:  # noqa: BLE001
+                # a failed draft does not stop the batch, it is retried on the
+                # next run
+                result = {"message": None, "error": repr(e)}
+            line = json.dumps({"session_group": session_group, **result}) + "\n"
+            # file writes block, they run in order on the writer thread
+            await loop.run_in_executor(writer, _append_line, f, line)
+            summary["failed" if result["error"] else "drafted"] += 1
+
+    model = chat_model or ChatModel(max_concurrency=concurrency)
+    loop = asyncio.get_running_loop()
+    writer = ThreadPoolExecutor(max_workers=1)
+    try:
+        f = await loop.run_in_executor(writer, _open_output, output)
+        workers = [
+            asyncio.create_task(worker(model, f, writer)) for _ in range(concurrency)
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # a failed worker stops the others before the file is closed
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            # after the pending writes
+            await loop.run_in_executor(writer, f.close)
+    finally:
+        writer.shutdown()
+        if chat_model is None:
+            await model.aclose()
+
+    return summary
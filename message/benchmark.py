@@ -0,0 +1,692 @@
+"""Transform engine benchmarks on synthetic data, CLI startup benchmarks and
+the performance regression gate."""
+
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import re
+import resource
+import subprocess
+import sys
+import time
+from datetime import UTC, datetime
+from pathlib import Path
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+
+from message.data import (
+    FeatureIndex,
+    transform_features_arrow,
+    transform_features_parallel,
+    transform_features_py,
+    transform_features_sql,
+    transform_features_stream,
+)
+from message.io import write_features
+from message.metrics import peak_rss_mb
+from message.synthetic import write_exercise_results
+
+
+def _run_arrow(data_dir: Path) -> None:
+    """Run the Arrow engine, which writes features.parquet."""
+    transform_features_arrow(data_dir=data_dir)
+
+
+# every engine takes the data directory and returns the features, or None
+# when it writes them to features.parquet instead
+ENGINES = {
+    "py": transform_features_py,
+    "sql": lambda data_dir: transform_features_sql(data_dir=data_dir),
+    "arrow": _run_arrow,
+    "stream": lambda data_dir: transform_features_stream(data_dir=data_dir),
+    "parallel": lambda data_dir: transform_features_parallel(
+        workers=os.cpu_count() or 1, data_dir=data_dir
+    ),
+}
+
+
+# CLI invocations whose startup is benchmarked, `--help` stops them before
+# they do any work
+STARTUP_COMMANDS = [["--help"], ["transform", "--help"], ["get-message", "--help"]]
+# modules the CLI must not import before a command needs them
+LAZY_MODULES = ["pandas", "duckdb", "pyarrow", "openai", "aiohttp", "message.chat"]
+
+# runs the CLI, then reports the lazy modules it imported on stderr
+_STARTUP_SCRIPT = f"""
+import sys
+try:
+    from message.main import app
+    app(prog_name="message")
+finally:
+    loaded = [module for module in {LAZY_MODULES!r} if module in sys.modules]
+    print("loaded:" + ",".join(loaded), file=sys.stderr)
+"""
+
+
+def measure_startup(args: list[str], repeat: int = 5) -> dict:
+    """Time the startup of a CLI invocation in fresh interpreters.
+
+    Parameters
+    ----------
+    args : list[str]
+        The CLI arguments.
+    repeat : int
+        Number of runs.
+
+    Returns
+    -------
+    dict
+        The best time in seconds, every run time, the modules of
+        `LAZY_MODULES` the invocation imported and its error, if any.
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-c", _STARTUP_SCRIPT, *args],
+            capture_output=True,
+            text=True,
+            # a failed invocation is reported with its error
+            check=False,
+        )
+        runs.append(time.perf_counter() - start)
+
+    *stderr, loaded = process.stderr.rstrip("\n").split("\n")
+    return {
+        "command": " ".join(["message", *args]),
+        "seconds": min(runs),
+        "runs": runs,
+        "loaded": [
+            module for module in loaded.removeprefix("loaded:").split(",") if module
+        ],
+        "error": "\n".join(stderr) if process.returncode else None,
+    }
+
+
+def run_startup_benchmark(
+    commands: list[list[str]] | None = None, repeat: int = 5
+) -> dict:
+    """Time the startup of several CLI invocations.
+
+    Parameters
+    ----------
+    commands : list[list[str]], optional
+        The arguments of each invocation, `STARTUP_COMMANDS` by default.
+    repeat : int
+        Number of runs of each invocation.
+
+    Returns
+    -------
+    dict
+        The benchmark report.
+    """
+    return {
+        "created_at": datetime.now(UTC).isoformat(),
+        "repeat": repeat,
+        "machine": machine_info(),
+        "results": [
+            measure_startup(args, repeat=repeat)
+            for args in commands or STARTUP_COMMANDS
+        ],
+    }
+
+
+# seconds between checks that a measured process is still running
+PROCESS_POLL_SECONDS = 1.0
+
+
+def _measure_in_process(target, *args) -> dict:
+    """Run a measurement in a fresh (spawned) process and get its result.
+
+    The target is called with the arguments and a queue, on which it puts
+    its measurements. A process that exits without putting any, e.g. killed
+    for running out of memory or crashed in a native library, is reported as
+    an error instead of being waited for forever.
+
+    Parameters
+    ----------
+    target : callable
+        Picklable measurement function.
+    *args
+        Arguments of the target, before the queue.
+
+    Returns
+    -------
+    dict
+        The measurements, or ``{"error": ...}``.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    measurements = None
+    try:
+        while measurements is None:
+            try:
+                measurements = queue.get(timeout=PROCESS_POLL_SECONDS)
+            except queue_module.Empty:
+                if process.is_alive():
+                    continue
+                # the measurements may have been put just before it exited
+                try:
+                    measurements = queue.get(timeout=PROCESS_POLL_SECONDS)
+                except queue_module.Empty:
+                    measurements = {"error": f"exit code {process.exitcode}"}
+    finally:
+        if measurements is None:
+            process.terminate()
+        process.join()
+
+    return measurements
+
+
+def _run_engine(engine: str, data_dir: Path, output_file: Path, queue):
+    """Run one engine in a fresh process and report time and peak memory.
+
+    Parameters
+    ----------
+    engine : str
+        Name of the engine in `ENGINES`.
+    data_dir : Path
+        Directory containing the exercise results data.
+    output_file : Path
+        Where the features are written to, for the parity check.
+    queue : multiprocessing.Queue
+        Queue the measurements are put on.
+    """
+    try:
+        baseline_rss_mb = peak_rss_mb()
+        start = time.perf_counter()
+        features = ENGINES[engine](data_dir)
+        seconds = time.perf_counter() - start
+        peak_mb = peak_rss_mb()
+        # largest worker process, if the engine started any (KB on Linux)
+        peak_worker_rss_mb = (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        )
+
+        if features is None:
+            features = pd.read_parquet(Path(data_dir, "features.parquet"))
+        features.to_parquet(output_file, index=False)
+
+        queue.put(
+            {
+                "seconds": seconds,
+                "baseline_rss_mb": baseline_rss_mb,
+                "peak_rss_mb": peak_mb,
+                "peak_worker_rss_mb": peak_worker_rss_mb,
+                "sessions": len(features),
+                "error": None,
+            }
+        )
+    except Exception as e:  # noqa: BLE001
+        # any failure of the engine is reported to the parent process
+        queue.put({"error": repr(e)})
+
+
+def measure_engine(engine: str, data_dir: Path, output_file: Path) -> dict:
+    """Measure one run of an engine in a separate process.
+
+    A fresh (spawned) process per run keeps peak memory readings independent
+    of previous runs.
+
+    Parameters
+    ----------
+    engine : str
+        Name of the engine in `ENGINES`.
+    data_dir : Path
+        Directory containing the exercise results data.
+    output_file : Path
+        Where the features are written to.
+
+    Returns
+    -------
+    dict
+        The measurements of the run.
+    """
+    return _measure_in_process(_run_engine, engine, data_dir, output_file)
+
+
+def features_match(left: pd.DataFrame, right: pd.DataFrame) -> bool:
+    """Check that two engines produced the same features.
+
+    Values are compared regardless of dtype, since engines may write counts
+    as floats, and rows are aligned on session_group.
+
+    Parameters
+    ----------
+    left : pd.DataFrame
+        Features of one engine.
+    right : pd.DataFrame
+        Features of another engine.
+
+    Returns
+    -------
+    bool
+        Whether the features match.
+    """
+    left = left.sort_values("session_group", ignore_index=True)
+    right = right.sort_values("session_group", ignore_index=True)[left.columns]
+    try:
+        pd.testing.assert_frame_equal(left, right, check_dtype=False)
+    except AssertionError:
+        return False
+
+    return True
+
+
+def machine_info() -> dict:
+    """Describe the machine and library versions a benchmark ran with.
+
+    Returns
+    -------
+    dict
+        The machine description.
+    """
+    return {
+        "hostname": platform.node(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "pyarrow": pa.__version__,
+        "duckdb": duckdb.__version__,
+    }
+
+
+def run_benchmark(
+    sizes: list[int],
+    engines: list[str],
+    workdir: str | Path,
+    seed: int = 0,
+    repeat: int = 1,
+) -> dict:
+    """Time every engine on synthetic datasets of several sizes.
+
+    Datasets are generated once per size and seed and reused across runs. The
+    first engine is the reference the others are checked against.
+
+    Parameters
+    ----------
+    sizes : list[int]
+        Number of exercise rows of each dataset.
+    engines : list[str]
+        Names of the engines in `ENGINES` to run.
+    workdir : str or Path
+        Directory for the datasets and engine outputs.
+    seed : int
+        Random seed of the datasets.
+    repeat : int
+        Number of runs of each engine on each dataset.
+
+    Returns
+    -------
+    dict
+        The benchmark report.
+    """
+    results = []
+    for n_rows in sizes:
+        data_dir = Path(workdir, f"rows_{n_rows}_seed_{seed}")
+        if not Path(data_dir, "exercise_results.parquet").exists():
+            write_exercise_results(data_dir, n_rows, seed=seed)
+
+        reference = None
+        for engine in engines:
+            output_file = Path(data_dir, f"features_{engine}.parquet")
+            runs = [
+                measure_engine(engine, data_dir, output_file) for _ in range(repeat)
+            ]
+            errors = [run["error"] for run in runs if run["error"]]
+            result = {"rows": n_rows, "engine": engine, "runs": runs}
+
+            if errors:
+                result["error"] = errors[0]
+            else:
+                features = pd.read_parquet(output_file)
+                reference = features if reference is None else reference
+                result.update(
+                    {
+                        "seconds": min(run["seconds"] for run in runs),
+                        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+                        "sessions": runs[0]["sessions"],
+                        "parity": features_match(reference, features),
+                        "error": None,
+                    }
+                )
+            results.append(result)
+
+    return {
+        "created_at": datetime.now(UTC).isoformat(),
+        "seed": seed,
+        "repeat": repeat,
+        "machine": machine_info(),
+        "results": results,
+    }
+
+
+def save_report(report: dict, path: str | Path):
+    """Save a benchmark report as JSON.
+
+    Parameters
+    ----------
+    report : dict
+        The benchmark report.
+    path : str or Path
+        The report file.
+    """
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def _get_all_features(data_dir: Path) -> None:
+    """Look the features of every session group up, as `get_features` does."""
+    index = FeatureIndex(Path(data_dir, "features.parquet"))
+    for session_group in index.session_groups():
+        index.get(session_group)
+
+
+# cases of the regression gate, each takes the data directory
+REGRESSION_CASES = {
+    "transform_features_py": transform_features_py,
+    "get_features": _get_all_features,
+}
+# rows of the fixed-seed datasets of the regression gate
+REGRESSION_SIZES = [10_000, 100_000, 1_000_000]
+REGRESSION_SEED = 0
+# changes under these are noise, never regressions
+REGRESSION_MIN_SECONDS = 0.1
+REGRESSION_MIN_MB = 16.0
+
+
+def _run_case(case: str, data_dir: Path, repeat: int, queue):
+    """Run a regression case in a fresh process and report its best time and
+    the memory its first run added to the process peak.
+
+    Parameters
+    ----------
+    case : str
+        Name of the case in `REGRESSION_CASES`.
+    data_dir : Path
+        Directory containing the dataset.
+    repeat : int
+        Number of runs.
+    queue : multiprocessing.Queue
+        Queue the measurements are put on.
+    """
+    try:
+        baseline_rss_mb = peak_rss_mb()
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            REGRESSION_CASES[case](data_dir)
+            runs.append(time.perf_counter() - start)
+            if len(runs) == 1:
+                memory_mb = peak_rss_mb() - baseline_rss_mb
+
+        queue.put(
+            {
+                "seconds": min(runs),
+                "runs": runs,
+                "memory_mb": memory_mb,
+                "error": None,
+            }
+        )
+    except Exception as e:  # noqa: BLE001
+        # any failure of the case is reported to the parent process
+        queue.put({"error": repr(e)})
+
+
+def measure_case(case: str, data_dir: Path, repeat: int = 3) -> dict:
+    """Measure a regression case in a separate (spawned) process.
+
+    Parameters
+    ----------
+    case : str
+        Name of the case in `REGRESSION_CASES`.
+    data_dir : Path
+        Directory containing the dataset.
+    repeat : int
+        Number of runs, the best time is kept.
+
+    Returns
+    -------
+    dict
+        The measurements of the case.
+    """
+    return _measure_in_process(_run_case, case, data_dir, repeat)
+
+
+def prepare_regression_data(workdir: str | Path, n_rows: int) -> Path:
+    """Generate the fixed-seed dataset of a regression size, with its
+    features, unless it already exists.
+
+    Parameters
+    ----------
+    workdir : str or Path
+        Directory of the datasets.
+    n_rows : int
+        Number of exercise rows.
+
+    Returns
+    -------
+    Path
+        Directory of the dataset.
+    """
+    data_dir = Path(workdir, f"rows_{n_rows}_seed_{REGRESSION_SEED}")
+    if not Path(data_dir, "exercise_results.parquet").exists():
+        write_exercise_results(data_dir, n_rows, seed=REGRESSION_SEED)
+    features_file = Path(data_dir, "features.parquet")
+    if not features_file.exists():
+        write_features(transform_features_py(data_dir), features_file)
+
+    return data_dir
+
+
+def run_regression_benchmark(
+    workdir: str | Path,
+    sizes: list[int] | None = None,
+    cases: list[str] | None = None,
+    repeat: int = 5,
+) -> dict:
+    """Measure the regression cases on the fixed-seed datasets.
+
+    Parameters
+    ----------
+    workdir : str or Path
+        Directory of the datasets, reused across runs.
+    sizes : list[int], optional
+        Rows of each dataset, `REGRESSION_SIZES` by default.
+    cases : list[str], optional
+        Names of the cases in `REGRESSION_CASES`, all by default.
+    repeat : int
+        Number of runs of each case on each dataset.
+
+    Returns
+    -------
+    dict
+        The benchmark report.
+    """
+    results = []
+    for n_rows in sizes or REGRESSION_SIZES:
+        data_dir = prepare_regression_data(workdir, n_rows)
+        for case in cases or list(REGRESSION_CASES):
+            results.append(
+                {
+                    "case": case,
+                    "rows": n_rows,
+                    **measure_case(case, data_dir, repeat=repeat),
+                }
+            )
+
+    return {
+        "created_at": datetime.now(UTC).isoformat(),
+        "seed": REGRESSION_SEED,
+        "repeat": repeat,
+        "machine": machine_info(),
+        "results": results,
+    }
+
+
+def machine_id() -> str:
+    """Identify this machine for its baselines, by host, architecture and
+    Python version.
+
+    Returns
+    -------
+    str
+        The machine id, usable as a file name.
+    """
+    name = "-".join(
+        [
+            platform.node() or "unknown",
+            platform.machine() or "unknown",
+            f"py{sys.version_info.major}.{sys.version_info.minor}",
+        ]
+    )
+
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+
+
+def baseline_file(directory: str | Path) -> Path:
+    """The baseline file of this machine.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Directory of the baselines.
+
+    Returns
+    -------
+    Path
+        The baseline file.
+    """
+    return Path(directory, f"{machine_id()}.json")
+
+
+def load_baseline(path: str | Path) -> dict | None:
+    """Load a baseline report.
+
+    Parameters
+    ----------
+    path : str or Path
+        The baseline file.
+
+    Returns
+    -------
+    dict or None
+        The baseline report, None if there is none.
+    """
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def compare_to_baseline(
+    report: dict,
+    baseline: dict,
+    time_tolerance: float = 0.5,
+    memory_tolerance: float = 0.25,
+) -> list[dict]:
+    """Compare a regression report to a baseline.
+
+    A metric regresses when it grows by more than its tolerance, relative to
+    the baseline, and by more than `REGRESSION_MIN_SECONDS` or
+    `REGRESSION_MIN_MB`, so that noise on small cases does not fail the gate.
+
+    Parameters
+    ----------
+    report : dict
+        The report of `run_regression_benchmark`.
+    baseline : dict
+        The baseline report.
+    time_tolerance : float
+        Allowed relative growth of the time.
+    memory_tolerance : float
+        Allowed relative growth of the memory.
+
+    Returns
+    -------
+    list[dict]
+        Per case, size and metric, the baseline and current values, the
+        relative change and the status: "ok", "regression", "improved", "new"
+        when there is no baseline for it or "error" when the case failed.
+    """
+    baselines = {
+        (result["case"], result["rows"]): result
+        for result in baseline["results"]
+        if not result.get("error")
+    }
+    metrics = {
+        "seconds": (time_tolerance, REGRESSION_MIN_SECONDS),
+        "memory_mb": (memory_tolerance, REGRESSION_MIN_MB),
+    }
+
+    comparison = []
+    for result in report["results"]:
+        previous = baselines.get((result["case"], result["rows"]))
+        for metric, (tolerance, minimum) in metrics.items():
+            row = {
+                "case": result["case"],
+                "rows": result["rows"],
+                "metric": metric,
+                "baseline": previous[metric] if previous else None,
+                "current": result.get(metric),
+                "change": None,
+                "status": "new",
+            }
+            if result["error"]:
+                row["status"] = "error"
+            elif previous is not None:
+                growth = row["current"] - row["baseline"]
+                row["change"] = growth / row["baseline"] if row["baseline"] else None
+                limit = max(row["baseline"] * tolerance, minimum)
+                if growth > limit:
+                    row["status"] = "regression"
+                elif -growth > limit:
+                    row["status"] = "improved"
+                else:
+                    row["status"] = "ok"
+            comparison.append(row)
+
+    return comparison
+
+
+def format_comparison(comparison: list[dict]) -> str:
+    """Format a baseline comparison as a table, regressions flagged.
+
+    Parameters
+    ----------
+    comparison : list[dict]
+        The comparison of `compare_to_baseline`.
+
+    Returns
+    -------
+    str
+        The table.
+    """
+
+    def value(number: float | None) -> str:
+        return "-" if number is None else f"{number:.3f}"
+
+    header = (
+        f"  {'case':<24} {'rows':>10} {'metric':<10} {'baseline':>10} "
+        f"{'current':>10} {'change':>8}  status"
+    )
+    lines = [header]
+    for row in comparison:
+        flag = "!" if row["status"] in ["regression", "error"] else " "
+        change = "-" if row["change"] is None else f"{row['change']:+.1%}"
+        lines.append(
+            f"{flag} {row['case']:<24} {row['rows']:>10} {row['metric']:<10} "
+            f"{value(row['baseline']):>10} {value(row['current']):>10} "
+            f"{change:>8}  {row['status']}"
+        )
+
+    return "\n".join(lines)
@@ -0,0 +1,188 @@
+"""Persistent LLM response cache."""
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+# request parameters that do not change the completion
+TRANSPORT_PARAMS = {"api_base", "request_timeout", "stream"}
+# eviction frees room down to this share of max_bytes, so a full cache is
+# not scanned again on the next writes
+EVICT_TARGET = 0.9
+
+
+class ResponseCache:
+    """Disk-backed, content-addressed cache of chat completions.
+
+    Each response is stored in its own file named after the hash of the
+    request, so concurrent processes can share the cache directory. Entries
+    older than `max_age` are dropped when read or evicted; once the cache
+    grows over `max_bytes` the least recently used entries are evicted, down
+    to `EVICT_TARGET` of it.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Directory of the cache entries.
+    max_bytes : int
+        Maximum total size of the entries, in bytes.
+    max_age : float
+        Maximum age of an entry, in seconds.
+    """
+
+    def __init__(self, cache_dir: str | Path, max_bytes: int, max_age: float):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        # total size of the entries, scanned on the first write
+        self._size = None
+
+    @staticmethod
+    def key(params: dict) -> str:
+        """Hash the parameters of a request.
+
+        Parameters
+        ----------
+        params : dict
+            The request parameters: model, messages, temperature, etc.
+
+        Returns
+        -------
+        str
+            Hex digest of the canonical JSON of the parameters.
+        """
+        payload = {k: v for k, v in params.items() if k not in TRANSPORT_PARAMS}
+        canonical = json.dumps(
+            payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return Path(self.cache_dir, key[:2], f"{key}.json")
+
+    def _entries(self) -> list[tuple[Path, os.stat_result]]:
+        entries = []
+        for path in self.cache_dir.glob("*/*.json"):
+            try:
+                entries.append((path, path.stat()))
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+
+        return entries
+
+    def get(self, key: str) -> str | None:
+        """Get a cached response.
+
+        Parameters
+        ----------
+        key : str
+            The request hash.
+
+        Returns
+        -------
+        str or None
+            The response, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        if time.time() - entry["created_at"] > self.max_age:
+            path.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+
+        # entries are evicted by access time, the modified time stays the
+        # creation time
+        try:
+            os.utime(path, (time.time(), path.stat().st_mtime))
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+
+        return entry["response"]
+
+    def set(self, key: str, response: str, params: dict | None = None):
+        """Cache a response.
+
+        Parameters
+        ----------
+        key : str
+            The request hash.
+        response : str
+            The response.
+        params : dict, optional
+            The request parameters, stored alongside for inspection.
+        """
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        entry = {"created_at": time.time(), "response": response, "params": params}
+
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_file, path)
+
+        if self._size is None:
+            self._size = sum(stat.st_size for _, stat in self._entries())
+        else:
+            self._size += path.stat().st_size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> int:
+        """Evict expired entries, then the least recently used ones until the
+        cache fits in `EVICT_TARGET` of `max_bytes`.
+
+        Returns
+        -------
+        int
+            Number of evicted entries.
+        """
+        now = time.time()
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_atime)
+        size = sum(stat.st_size for _, stat in entries)
+        target = self.max_bytes * EVICT_TARGET
+        evicted = 0
+        for path, stat in entries:
+            expired = now - stat.st_mtime > self.max_age
+            if not expired and size <= target:
+                continue
+            path.unlink(missing_ok=True)
+            size -= stat.st_size
+            evicted += 1
+
+        self._size = size
+
+        return evicted
+
+    def clear(self):
+        """Remove every entry."""
+        for path, _ in self._entries():
+            path.unlink(missing_ok=True)
+        self._size = 0
+
+    def stats(self) -> dict:
+        """Hit and miss counters of this process, and the size of the cache.
+
+        Returns
+        -------
+        dict
+            The cache statistics.
+        """
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "bytes": sum(stat.st_size for _, stat in entries),
+        }
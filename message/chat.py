@@ -1,24 +1,23 @@
 """Chat"""
 
-from enum import StrEnum
-from message.io import load_chat_history, load_prompts, save_chat_history
+import asyncio
+import sys
+import threading
+from message.io import ChatJournal, chat_file, load_chat_history, load_prompts
 from uuid import uuid4
 from message.config import get_settings
 from message.model import ChatModel
 from message.data import get_features
+from message.feedback import FeedbackOption
+from message.history import compact_history
+from message.render import render_features
+from message.store import ChatStore
+import openai
 import typer
 
 prompts = load_prompts()
-settings = get_settings()
-chat_model = ChatModel()
-
-
-class FeedbackOption(StrEnum):
-    TONE = "tone"
-    GENERIC = "generic"
-    ENGAGEMENT = "engagement"
-    FACTUALITY = "factuality"
-    OTHER = "other"
+# created on first use, see get_chat_model
+chat_model: ChatModel | None = None
 
 
 FEEDBACK_PROMPT_MAP = {
@@ -30,6 +29,64 @@ FEEDBACK_PROMPT_MAP = {
 }
 
 
+# category of each feedback system message, to recognize them in the history
+FEEDBACK_CATEGORY_BY_MESSAGE = {
+    prompts["SYSTEM_FEEDBACK"].format(feedback_prompt=feedback_prompt): category
+    for category, feedback_prompt in FEEDBACK_PROMPT_MAP.items()
+}
+EXTRA_FEEDBACK_PREFIX = prompts["EXTRA_FEEDBACK"].split("{extra_feedback}")[0]
+
+# categories whose revisions are generated speculatively, "other" needs the
+# reviewer's feedback
+SPECULATIVE_CATEGORIES = [
+    FeedbackOption.TONE,
+    FeedbackOption.GENERIC,
+    FeedbackOption.ENGAGEMENT,
+    FeedbackOption.FACTUALITY,
+]
+
+ACCEPTANCE_OPTIONS = ["accept", "edit", "reject"]
+
+
+def get_chat_model() -> ChatModel:
+    """Get the chat model, creating it on first use.
+
+    Returns
+    -------
+    ChatModel
+        The chat model.
+    """
+    global chat_model
+    if chat_model is None:
+        chat_model = ChatModel()
+
+    return chat_model
+
+
+def system_message(features: list[dict]) -> dict[str, str]:
+    """Render the system prompt of a session.
+
+    The static instructions come first and the session data last, so the
+    requests of every session share the same prompt prefix.
+
+    Parameters
+    ----------
+    features : list[dict]
+        The features of the session group.
+
+    Returns
+    -------
+    dict[str, str]
+        The system message.
+    """
+    return {
+        "role": "system",
+        "content": prompts["SYSTEM_BASE"].format(
+            session_data=render_features(features)
+        ),
+    }
+
+
 def prompt_for_acceptance() -> str:
     """Prompt user for message acceptance.
 
@@ -41,16 +98,21 @@ def prompt_for_acceptance() -> str:
     response = None
     while not response:
         response = input("Accept | Edit | Reject: ").strip().lower()
-        if response not in ["accept", "edit", "reject"]:
+        if response not in ACCEPTANCE_OPTIONS:
             print("Invalid response. Please enter 'accept', 'edit', or 'reject'.")
             response = None
 
     return response
 
 
-def prompt_for_edit_feedback() -> tuple[str, str]:
+def prompt_for_edit_feedback(optional: bool = False) -> tuple[str, str]:
     """Prompt user edit for feedback.
 
+    Parameters
+    ----------
+    optional : bool
+        Whether the feedback text may be left empty.
+
     Returns
     -------
     tuple[str, str]
@@ -74,6 +136,9 @@ def prompt_for_edit_feedback() -> tuple[str, str]:
             )
             category = None
 
+    if optional:
+        return category, input("Feedback (optional): ").strip()
+
     feedback = None
     while not feedback:
         feedback = input("Feedback: ").strip()
@@ -82,107 +147,538 @@ def prompt_for_edit_feedback() -> tuple[str, str]:
     return category, feedback
 
 
-def llm(messages: list[dict[str, str]]) -> str:
+def feedback_messages(category: str, feedback: str) -> list[dict[str, str]]:
+    """Build the messages asking for a revision of the last message.
+
+    Parameters
+    ----------
+    category : str
+        The feedback category.
+    feedback : str
+        The reviewer's feedback, none if empty.
+
+    Returns
+    -------
+    list[dict[str, str]]
+        The messages to append to the chat history.
+    """
+    messages = [
+        {
+            "role": "system",
+            "content": prompts["SYSTEM_FEEDBACK"].format(
+                feedback_prompt=FEEDBACK_PROMPT_MAP[FeedbackOption(category)]
+            ),
+        }
+    ]
+    if feedback:
+        messages.append(
+            {
+                "role": "user",
+                "content": prompts["EXTRA_FEEDBACK"].format(extra_feedback=feedback),
+            }
+        )
+
+    return messages
+
+
+async def llm(
+    messages: list[dict[str, str]],
+    bypass_cache: bool = False,
+    model: ChatModel | None = None,
+) -> str:
     """Get a chat completion from the LLM.
 
+    The messages are compacted to the chat history token budget first.
+
     Parameters
     ----------
     messages : list[dict[str, str]]
         The messages to send to the LLM.
+    bypass_cache : bool
+        Whether to skip the response cache lookup.
+    model : ChatModel, optional
+        The chat model, the shared one by default.
 
     Returns
     -------
     str
         The chat completion response.
     """
-    return chat_model.get_completion(
-        temperature=0, model="gpt-4o-mini", messages=messages
+    return await (model or get_chat_model()).aget_completion(
+        temperature=0,
+        model="gpt-4o-mini",
+        messages=compact_messages(messages),
+        bypass_cache=bypass_cache,
+    )
+
+
+def fold_feedback(messages: list[dict[str, str]]) -> dict[str, str]:
+    """Condense older feedback rounds into one instruction message.
+
+    Only the category prompts and the reviewer's feedback are kept, each
+    once; the repeated feedback guidelines are dropped.
+
+    Parameters
+    ----------
+    messages : list[dict[str, str]]
+        The feedback messages of the older rounds.
+
+    Returns
+    -------
+    dict[str, str]
+        The condensed system message.
+    """
+    blocks = []
+    for message in messages:
+        content = message["content"]
+        category = FEEDBACK_CATEGORY_BY_MESSAGE.get(content)
+        if category is not None:
+            content = FEEDBACK_PROMPT_MAP[category]
+        elif content.startswith(EXTRA_FEEDBACK_PREFIX):
+            content = "Reviewer: " + content.removeprefix(EXTRA_FEEDBACK_PREFIX)
+        content = content.strip()
+        if content not in blocks:
+            blocks.append(content)
+
+    return {
+        "role": "system",
+        "content": "## Earlier Feedback\n"
+        "Keep applying the feedback given on the earlier revisions:\n\n"
+        + "\n\n".join(blocks),
+    }
+
+
+def feedback_rounds(chat_history: list[dict[str, str]]) -> list[tuple[str, str]]:
+    """Get the feedback category and text of each edit round of a chat.
+
+    Parameters
+    ----------
+    chat_history : list[dict[str, str]]
+        The chat history.
+
+    Returns
+    -------
+    list[tuple[str, str]]
+        The category and reviewer's feedback of each round, empty if none.
+    """
+    rounds = []
+    for message in chat_history:
+        content = message["content"]
+        category = FEEDBACK_CATEGORY_BY_MESSAGE.get(content)
+        if category is not None:
+            rounds.append((str(category), ""))
+        elif rounds and content.startswith(EXTRA_FEEDBACK_PREFIX):
+            feedback = content.removeprefix(EXTRA_FEEDBACK_PREFIX).strip()
+            rounds[-1] = (rounds[-1][0], feedback)
+
+    return rounds
+
+
+def compact_messages(messages: list[dict[str, str]]) -> list[dict[str, str]]:
+    """Compact the chat history sent to the LLM to the token budget.
+
+    Parameters
+    ----------
+    messages : list[dict[str, str]]
+        The chat history.
+
+    Returns
+    -------
+    list[dict[str, str]]
+        The messages to send.
+    """
+    return compact_history(
+        messages, get_settings().CHAT_HISTORY_TOKEN_BUDGET, fold_feedback
+    )
+
+
+class Speculation:
+    """Revisions generated in the background for the fixed feedback categories.
+
+    Revisions do not depend on the draft, only on the chat history, so they
+    are requested while the reviewer reads it. Every request started counts
+    against the budget, even if it is cancelled.
+
+    Parameters
+    ----------
+    budget : int
+        Maximum number of speculative requests.
+    bypass_cache : bool
+        Whether to skip the response cache lookup.
+    """
+
+    def __init__(self, budget: int, bypass_cache: bool = False):
+        self.budget = budget
+        self.bypass_cache = bypass_cache
+        self.revisions: dict[str, asyncio.Task] = {}
+
+    def start(self, chat_history: list[dict[str, str]]):
+        """Start the revisions of the next message, within the budget.
+
+        Parameters
+        ----------
+        chat_history : list[dict[str, str]]
+            The chat history the next message is generated from.
+        """
+        self.cancel()
+        for category in SPECULATIVE_CATEGORIES[: max(self.budget, 0)]:
+            revision = asyncio.create_task(
+                llm(chat_history + feedback_messages(category, ""), self.bypass_cache)
+            )
+            # failures are handled when the revision is used, if it is
+            revision.add_done_callback(
+                lambda task: task.cancelled() or task.exception()
+            )
+            self.revisions[category] = revision
+            self.budget -= 1
+
+    def take(self, category: str) -> asyncio.Task | None:
+        """Take the revision of a category and cancel the others.
+
+        Parameters
+        ----------
+        category : str
+            The feedback category.
+
+        Returns
+        -------
+        asyncio.Task or None
+            The revision, None if it was not started.
+        """
+        revision = self.revisions.pop(category, None)
+        self.cancel()
+
+        return revision
+
+    def cancel(self):
+        """Cancel the revisions in flight."""
+        for revision in self.revisions.values():
+            revision.cancel()
+        self.revisions.clear()
+
+
+async def read_line() -> str:
+    """Read a line from stdin without blocking the event loop.
+
+    The line is read on a daemon thread, so a pending read never keeps the
+    program from exiting.
+
+    Returns
+    -------
+    str
+        The line, empty at end of file.
+    """
+    loop = asyncio.get_running_loop()
+    line = loop.create_future()
+
+    def read():
+        text = sys.stdin.readline()
+        loop.call_soon_threadsafe(
+            lambda: line.done() or line.set_result(text),
+        )
+
+    threading.Thread(target=read, daemon=True).start()
+
+    return await line
+
+
+async def print_message(
+    messages: list[dict[str, str]], bypass_cache: bool = False
+) -> str:
+    """Stream a chat completion from the LLM, printing tokens as they arrive.
+
+    The messages are compacted to the chat history token budget first.
+
+    Parameters
+    ----------
+    messages : list[dict[str, str]]
+        The messages to send to the LLM.
+    bypass_cache : bool
+        Whether to skip the response cache lookup.
+
+    Returns
+    -------
+    str
+        The full chat completion response.
+    """
+    tokens = []
+    print("Message: ", end="", flush=True)
+    stream = get_chat_model().astream_completion(
+        temperature=0,
+        model="gpt-4o-mini",
+        messages=compact_messages(messages),
+        bypass_cache=bypass_cache,
     )
+    try:
+        async for token in stream:
+            tokens.append(token)
+            print(token, end="", flush=True)
+    finally:
+        await stream.aclose()
+        print()
+
+    return "".join(tokens)
+
 
+async def print_revision(
+    revision: asyncio.Task, messages: list[dict[str, str]], bypass_cache: bool = False
+) -> str:
+    """Print a speculative revision, generating the message again if it failed.
+
+    Parameters
+    ----------
+    revision : asyncio.Task
+        The speculative revision.
+    messages : list[dict[str, str]]
+        The messages the revision was generated from.
+    bypass_cache : bool
+        Whether to skip the response cache lookup.
 
-async def run_chat(session_group: str):
+    Returns
+    -------
+    str
+        The message.
+    """
+    try:
+        message = await revision
+    except openai.error.OpenAIError:
+        return await print_message(messages, bypass_cache)
+
+    print("Message:", message)
+
+    return message
+
+
+async def generate_message(
+    messages: list[dict[str, str]],
+    bypass_cache: bool = False,
+    revision: asyncio.Task | None = None,
+) -> tuple[str | None, str]:
+    """Stream a message while the reviewer can already answer for it.
+
+    The acceptance prompt is shown once the message is complete, but an
+    answer may be typed while it is still streaming: "edit" or "reject"
+    cancel the generation, "accept" waits for the rest of the message.
+
+    Parameters
+    ----------
+    messages : list[dict[str, str]]
+        The messages to send to the LLM.
+    bypass_cache : bool
+        Whether to skip the response cache lookup.
+    revision : asyncio.Task, optional
+        A speculative revision generated from the messages, shown instead of
+        a new generation.
+
+    Returns
+    -------
+    tuple[str | None, str]
+        The message, None if the generation was cancelled, and the response.
+    """
+    generation = asyncio.create_task(
+        print_message(messages, bypass_cache)
+        if revision is None
+        else print_revision(revision, messages, bypass_cache)
+    )
+    answer = asyncio.create_task(read_line())
+    try:
+        await asyncio.wait({generation, answer}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        generation.cancel()
+        raise
+
+    if not answer.done():
+        # the message is complete, or the generation failed and raises here
+        await generation
+        print("Accept | Edit | Reject: ", end="", flush=True)
+    response = (await answer).strip().lower()
+
+    if response in ["edit", "reject"] and not generation.done():
+        generation.cancel()
+        try:
+            await generation
+        except asyncio.CancelledError:
+            pass
+        print("[INFO] Generation cancelled.")
+        return None, response
+
+    message = await generation
+    if response not in ACCEPTANCE_OPTIONS:
+        print("Invalid response. Please enter 'accept', 'edit', or 'reject'.")
+        response = await asyncio.to_thread(prompt_for_acceptance)
+
+    return message, response
+
+
+async def finish_chat(
+    journal: ChatJournal,
+    store: ChatStore,
+    chat_id: str,
+    session_group: str,
+    chat_history: list[dict[str, str]],
+    outcome: str,
+):
+    """Move a finished chat from its journal to the chat store.
+
+    Parameters
+    ----------
+    journal : ChatJournal
+        The journal of the chat, closed.
+    store : ChatStore
+        The chat store.
+    chat_id : str
+        The chat id.
+    session_group : str
+        The session group of the chat.
+    chat_history : list[dict[str, str]]
+        The chat history.
+    outcome : str
+        How the chat ended, "accept" or "reject".
+    """
+    await journal.close()
+    await asyncio.to_thread(
+        store.save_chat,
+        chat_id,
+        session_group=session_group,
+        messages=chat_history,
+        outcome=outcome,
+        feedback_rounds=feedback_rounds(chat_history),
+    )
+    chat_file(chat_id).unlink(missing_ok=True)
+
+
+async def run_chat(
+    session_group: str,
+    cache: bool = True,
+    speculate: bool = False,
+    speculation_budget: int = 8,
+    chat_id: str | None = None,
+):
     """Run the chat.
 
+    Every message is appended to the chat journal as soon as it is added, so
+    an interrupted chat can be resumed from its journal. A finished chat is
+    moved from its journal to the chat store.
+
     Parameters
     ----------
     session_group : str
         The session group to load from file.
+    cache : bool
+        Whether to look messages up in the LLM response cache.
+    speculate : bool
+        Whether to generate the revisions of each feedback category in the
+        background, so a category picked without feedback is shown instantly.
+    speculation_budget : int
+        Maximum number of speculative requests in the chat.
+    chat_id : str, optional
+        Id of an interrupted chat to resume, a new chat by default.
     """
+    settings = get_settings()
+    model = get_chat_model()
+    speculation = Speculation(speculation_budget if speculate else 0, not cache)
+    journal = None
     try:
         print("[INFO] Loading session group:", session_group)
 
         features = get_features(session_group=session_group)  # noqa
 
-        chat_id = str(uuid4())
-        print("[INFO] Starting chat with id:", chat_id)
+        if chat_id is None:
+            chat_id = str(uuid4())
+            print("[INFO] Starting chat with id:", chat_id)
+        else:
+            print("[INFO] Resuming chat with id:", chat_id)
+
+        store = ChatStore(settings.CHAT_STORE_PATH)
+        chat_history = await asyncio.to_thread(store.get_messages, chat_id)
+        if chat_history is None:
+            chat_history = await asyncio.to_thread(load_chat_history, chat_id)
+        if chat_history and chat_history[-1]["role"] == "assistant":
+            print("[INFO] Chat already finished:", chat_history[-1]["content"])
+            return
+
+        journal = ChatJournal(
+            chat_id,
+            fsync=settings.CHAT_JOURNAL_FSYNC,
+            fsync_interval=settings.CHAT_JOURNAL_FSYNC_INTERVAL,
+        )
 
-        chat_history = load_chat_history(chat_id)
+        def add_messages(*messages: dict[str, str]):
+            chat_history.extend(messages)
+            for message in messages:
+                journal.append(message)
 
         if not chat_history:
-            chat_history.append(
-                {
-                    "role": "system",
-                    "content": prompts["SYSTEM_BASE"].format(session_data=features),
-                }
-            )
+            add_messages(system_message(features))
 
         print("[INFO] Starting chat...")
         print("=" * 50)
 
         acceptance = None
+        revision = None
         while acceptance not in ["accept", "reject"]:
-            message = llm(chat_history)
-
-            print("Message:", message)
-
-            acceptance = prompt_for_acceptance()
+            speculation.start(chat_history)
+            message, acceptance = await generate_message(
+                chat_history, bypass_cache=not cache, revision=revision
+            )
+            revision = None
 
             if acceptance == "accept":
-                chat_history.append({"role": "assistant", "content": message})
+                speculation.cancel()
+                add_messages({"role": "assistant", "content": message})
             if acceptance == "edit":
-                category, feedback = prompt_for_edit_feedback()
+                # the event loop keeps running the revisions meanwhile
+                category, feedback = await asyncio.to_thread(
+                    prompt_for_edit_feedback, optional=speculate
+                )
+                revision = speculation.take(category)
+                if feedback and revision is not None:
+                    # the feedback changes the request, the revision is stale
+                    revision.cancel()
+                    revision = None
 
                 # NOTE: could only save accepted messages instead (e.g. use temp_chat_history)
-                chat_history.append(
-                    {
-                        "role": "system",
-                        "content": prompts["SYSTEM_FEEDBACK"].format(
-                            feedback_prompt=FEEDBACK_PROMPT_MAP[
-                                FeedbackOption(category)
-                            ]
-                        ),
-                    }
-                )
-                chat_history.append(
-                    {
-                        "role": "user",
-                        "content": prompts["EXTRA_FEEDBACK"].format(
-                            extra_feedback=feedback
-                        ),
-                    }
-                )
+                add_messages(*feedback_messages(category, feedback))
 
                 print("-" * 50)
             if acceptance == "reject":
+                speculation.cancel()
                 # overwrite llm message
                 message = None
                 while not message:
-                    message = input("Write your answer: ")
+                    message = await asyncio.to_thread(input, "Write your answer: ")
                     if not message.strip():
                         print("Message cannot be empty!")
-                chat_history.append({"role": "assistant", "content": message})
+                add_messages({"role": "assistant", "content": message})
+
+        await finish_chat(
+            journal, store, chat_id, session_group, chat_history, acceptance
+        )
 
         print()
         print("=" * 50)
         print("[INFO] Shutting down...")
-        await save_chat_history(chat_id, chat_history)
         return
     except Exception as e:
         print(e)
         print()
         print("=" * 50)
         print("[INFO] Shutting down...")
-
-        await save_chat_history(chat_id, chat_history)
+        if journal is not None:
+            print("[INFO] Resume the chat with --chat-id", chat_id)
 
         raise typer.Exit()
+    finally:
+        speculation.cancel()
+        if journal is not None:
+            await journal.close()
+        token_counts = model.token_counts
+        print(
+            f"[INFO] LLM tokens: {len(token_counts)} requests, "
+            f"{sum(count['prompt_tokens'] for count in token_counts)} prompt, "
+            f"{sum(count['completion_tokens'] for count in token_counts)} completion"
+        )
+        if model.cache is not None:
+            stats = model.cache.stats()
+            print(f"[INFO] LLM cache: {stats['hits']} hits, {stats['misses']} misses")
+        await model.aclose()
@@ -1,6 +1,7 @@
 import logging
 from functools import lru_cache
 from pathlib import Path
+from typing import Literal
 
 from pydantic_settings import BaseSettings
 
@@ -12,16 +13,41 @@ QUERIES_DIR = Path(BASE_DIR, "queries")
 TESTS_DIR = Path(BASE_DIR, "tests")
 PROMPTS_DIR = Path(BASE_DIR, "prompts")
 
-# create dirs
-BASE_DIR.mkdir(parents=True, exist_ok=True)
-DATA_DIR.mkdir(parents=True, exist_ok=True)
-NOTEBOOKS_DIR.mkdir(parents=True, exist_ok=True)
-QUERIES_DIR.mkdir(parents=True, exist_ok=True)
-TESTS_DIR.mkdir(parents=True, exist_ok=True)
-
 
 class Settings(BaseSettings):
-    OPENAI_API_KEY: str
+    # only needed by the commands calling the LLM
+    OPENAI_API_KEY: str | None = None
+    OPENAI_API_BASE: str | None = None
+    # seconds
+    OPENAI_TIMEOUT: float = 60.0
+    OPENAI_CONNECT_TIMEOUT: float = 10.0
+    OPENAI_MAX_CONCURRENCY: int = 8
+    # estimated tokens of the chat history before older feedback is folded
+    CHAT_HISTORY_TOKEN_BUDGET: int = 2000
+    # when chat journal appends are fsynced, see ChatJournal
+    CHAT_JOURNAL_FSYNC: Literal["always", "batch", "never"] = "batch"
+    # seconds
+    CHAT_JOURNAL_FSYNC_INTERVAL: float = 1.0
+    # feature file the session group lookups read, written by message transform
+    FEATURES_PATH: Path = Path(DATA_DIR, "features.parquet")
+    # finished chats, see ChatStore
+    CHAT_STORE_PATH: Path = Path(".chats", "chats.sqlite")
+    # seconds a chat under review in message serve can stay idle before its
+    # journal is closed, it stays resumable with get-message --chat-id
+    SERVE_CHAT_IDLE_TIMEOUT: float = 30 * 60
+    # whether each command writes its metrics to <command>.prom and .json
+    METRICS_ENABLED: bool = True
+    METRICS_DIR: Path = Path(".metrics")
+    # per-machine baselines of the performance regression gate, and the
+    # allowed relative growth of the time and memory of each case
+    BENCHMARK_BASELINES_DIR: Path = Path(TESTS_DIR, "baselines")
+    BENCHMARK_TIME_TOLERANCE: float = 0.5
+    BENCHMARK_MEMORY_TOLERANCE: float = 0.25
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_DIR: Path = Path(BASE_DIR, ".cache", "llm")
+    LLM_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    # seconds, 30 days
+    LLM_CACHE_MAX_AGE: float = 30 * 24 * 60 * 60
 
     class Config:
         env_file = f"{BASE_DIR}/.env"
@@ -1,16 +1,53 @@
+import bisect
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 import duckdb
+import numpy as np
 import pandas as pd
-from message.config import DATA_DIR, QUERIES_DIR
-from message.io import load_exercise_data
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from message.config import DATA_DIR, QUERIES_DIR, get_settings
+from message.metrics import stage
+from message.io import (
+    EXERCISE_DTYPES,
+    FEATURE_ROW_GROUP_ROWS,
+    buffer_to_table,
+    exercise_table_to_pandas,
+    iter_exercise_data,
+    load_exercise_data,
+    load_exercise_table,
+    load_feature_offsets,
+    load_manifest,
+    parquet_column_max,
+    parquet_fingerprint,
+    parquet_row_group_values,
+    save_manifest,
+    table_to_buffer,
+    write_feature_offsets,
+    write_features,
+)
 from message.transform import (
-    aggregate_session_data,
-    calculate_performance_metrics,
-    add_reason_counts,
-    identify_first_exercise_skipped,
-    identify_most_incorrect_exercise,
-    order_columns,
+    DICTIONARY_COLUMNS,
+    FEATURE_COLUMNS,
+    aggregate_session_partials,
+    build_session_features,
+    build_session_features_arrow,
+    finalize_session_partials,
+    merge_session_partials,
+)
+from message.trends import (
+    TREND_COLUMNS,
+    TREND_WINDOW,
+    add_patient_trends,
+    add_patient_trends_arrow,
+    stale_patients,
+    update_patient_trends,
 )
 
 
@@ -30,42 +67,664 @@ def open_query(query_filename: Path, **kwargs) -> str:
     return open(query_filename, "r").read().format(**kwargs)
 
 
-def transform_features_sql():
+def _sql_path(path: Path) -> str:
+    """Quotes a path for use inside a SQL string literal."""
+    return str(path).replace("'", "''")
+
+
+def _sql_sum_type(schema: pa.Schema, column: str) -> str:
+    """DuckDB type of the sums of an exercise results column.
+
+    Sums of integer columns are integers and sums of fractional columns stay
+    doubles, as with the pandas engine.
+
+    Parameters
+    ----------
+    schema : pa.Schema
+        Schema of the exercise results file.
+    column : str
+        The summed column.
+
+    Returns
+    -------
+    str
+        The DuckDB type.
+    """
+    return "BIGINT" if pa.types.is_integer(schema.field(column).type) else "DOUBLE"
+
+
+def transform_features_sql(
+    data_dir: str | Path = DATA_DIR,
+    threads: int | None = None,
+    memory_limit: str | None = None,
+    temp_directory: str | Path | None = None,
+):
     """Loads the exercise results and transforms
     them into features using the features.sql query.
+
+    DuckDB reads the parquet file directly and writes ``features.parquet``
+    with ``COPY``, so no data goes through pandas; the patient trends are
+    window functions of the query. Aggregations run on all threads and spill
+    to ``temp_directory`` once ``memory_limit`` is reached. The features are
+    laid out like `write_features` does.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+        Directory containing the exercise results data, where the features
+        are written to.
+    threads : int, optional
+        Number of DuckDB threads, all cores by default.
+    memory_limit : str, optional
+        DuckDB memory limit (e.g. ``"4GB"``), 80% of the RAM by default.
+    temp_directory : str or Path, optional
+        Directory used to spill intermediate results to disk.
+    """
+    exercise_file = Path(data_dir, "exercise_results.parquet")
+    schema = pq.read_schema(exercise_file)
+    query = open_query(
+        Path(QUERIES_DIR, "features.sql"),
+        exercise_file=_sql_path(exercise_file),
+        trend_preceding=TREND_WINDOW - 1,
+        prescribed_repeats_type=_sql_sum_type(schema, "prescribed_repeats"),
+        training_time_type=_sql_sum_type(schema, "training_time"),
+    )
+
+    # rows are explicitly ordered, so insertion order need not be preserved
+    config = {"preserve_insertion_order": False}
+    if threads is not None:
+        config["threads"] = threads
+    if memory_limit is not None:
+        config["memory_limit"] = memory_limit
+    if temp_directory is not None:
+        config["temp_directory"] = str(temp_directory)
+
+    features_file = _sql_path(Path(data_dir, "features.parquet"))
+    with duckdb.connect(config=config) as connection:
+        connection.execute(
+            f"COPY ({query}) TO '{features_file}' "
+            f"(FORMAT PARQUET, ROW_GROUP_SIZE {FEATURE_ROW_GROUP_ROWS})"
+        )
+    write_feature_offsets(Path(data_dir, "features.parquet"))
+
+
+def transform_features_py(data_dir: str | Path = DATA_DIR) -> pd.DataFrame:
+    """Loads the exercise results and transforms them into features, with
+    the patient trends.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+        Directory containing the exercise results data.
+
+    Returns
+    -------
+    pd.DataFrame
+        The transformed features.
+    """
+
+    with stage("load_exercise_data") as record:
+        df = load_exercise_data(data_dir)
+        record["rows_out"] = len(df)
+    with stage("build_session_features", rows_in=len(df)) as record:
+        grouped = build_session_features(df)
+        record["rows_out"] = len(grouped)
+    with stage("add_patient_trends", rows_in=len(grouped)) as record:
+        grouped = add_patient_trends(grouped)
+        record["rows_out"] = len(grouped)
+
+    return grouped
+
+
+def transform_features_arrow(data_dir: str | Path = DATA_DIR) -> pa.Table:
+    """Loads the exercise results and transforms them into features with
+    Arrow compute kernels, writing ``features.parquet`` with the patient
+    trends.
+
+    String columns are read as dictionaries and stay dictionary encoded up to
+    the parquet write; callers that need pandas convert the returned table.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+        Directory containing the exercise results data, where the features
+        are written to.
+
+    Returns
+    -------
+    pa.Table
+        The transformed features.
+    """
+    with stage("load_exercise_table") as record:
+        table = load_exercise_table(
+            data_dir, columns=list(EXERCISE_DTYPES), read_dictionary=DICTIONARY_COLUMNS
+        )
+        record["rows_out"] = table.num_rows
+    with stage("build_session_features_arrow", rows_in=table.num_rows) as record:
+        features = build_session_features_arrow(table)
+        record["rows_out"] = features.num_rows
+    with stage("add_patient_trends", rows_in=features.num_rows) as record:
+        features = add_patient_trends_arrow(features)
+        record["rows_out"] = features.num_rows
+
+    # without the Arrow schema, readers get plain strings back instead of
+    # categoricals; the parquet columns are dictionary encoded either way
+    with stage("write_features", rows_in=features.num_rows):
+        write_features(features, Path(data_dir, "features.parquet"), store_schema=False)
+
+    return features
+
+
+def transform_features_stream(
+    batch_rows: int = 100_000, data_dir: str | Path = DATA_DIR
+) -> pd.DataFrame:
+    """Loads the exercise results in batches and transforms them into features.
+
+    Each batch is reduced to per-session partial aggregates, which are merged
+    once the pending partials outgrow the merged state, so peak memory depends
+    on the number of sessions rather than on the number of exercise rows.
+    The patient trends are added once all sessions are merged.
+
+    Parameters
+    ----------
+    batch_rows : int
+        Maximum number of exercise rows read per batch.
+    data_dir : str or Path
+        Directory containing the exercise results data.
+
+    Returns
+    -------
+    pd.DataFrame
+        The transformed features.
+    """
+    merged = None
+    pending = []
+    pending_sessions = 0
+
+    for batch in iter_exercise_data(data_dir, batch_rows):
+        partials = aggregate_session_partials(batch)
+        pending.append(partials)
+        pending_sessions += len(partials.sessions)
+
+        if merged is None or pending_sessions >= len(merged.sessions):
+            merged = merge_session_partials(
+                ([merged] if merged is not None else []) + pending
+            )
+            pending = []
+            pending_sessions = 0
+
+    if merged is None:
+        # empty file, nothing to stream
+        return add_patient_trends(build_session_features(load_exercise_data(data_dir)))
+    if pending:
+        merged = merge_session_partials([merged] + pending)
+
+    return add_patient_trends(finalize_session_partials(merged))
+
+
+def partition_exercise_table(table: pa.Table, partitions: int) -> list[pa.Table]:
+    """Hash-partitions the exercise results by session group.
+
+    All rows of a session group land in the same partition and keep their
+    original relative order.
+
+    Parameters
+    ----------
+    table : pa.Table
+        Raw exercise results data.
+    partitions : int
+        Number of partitions.
+
+    Returns
+    -------
+    list[pa.Table]
+        The partitions.
+    """
+    sessions = table.column("session_group").combine_chunks().dictionary_encode()
+    # hash the distinct session groups only, then broadcast to the rows
+    dictionary_partition = pd.util.hash_array(
+        sessions.dictionary.to_numpy(zero_copy_only=False)
+    ) % np.uint64(partitions)
+    row_partition = dictionary_partition[
+        sessions.indices.fill_null(0).to_numpy()
+    ].astype("int64")
+
+    return [
+        table.take(np.flatnonzero(row_partition == partition))
+        for partition in range(partitions)
+    ]
+
+
+def _transform_partition(buffer: pa.Buffer) -> pa.Buffer:
+    """Transforms one partition of exercise results into features.
+
+    Runs in a worker process; input and output travel as Arrow IPC buffers.
+
+    Parameters
+    ----------
+    buffer : pa.Buffer
+        A partition of the raw exercise results data.
+
+    Returns
+    -------
+    pa.Buffer
+        The features of the partition.
+    """
+    grouped = build_session_features(exercise_table_to_pandas(buffer_to_table(buffer)))
+
+    return table_to_buffer(pa.Table.from_pandas(grouped, preserve_index=False))
+
+
+def transform_features_parallel(
+    workers: int, data_dir: str | Path = DATA_DIR
+) -> pd.DataFrame:
+    """Loads the exercise results and transforms them into features with a
+    pool of worker processes, one hash partition of session groups each.
+
+    The patient trends are added once the partitions are merged, since the
+    sessions of a patient can be in several partitions.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes.
+    data_dir : str or Path
+        Directory containing the exercise results data.
+
+    Returns
+    -------
+    pd.DataFrame
+        The transformed features, sorted by session_group.
     """
-    exercise = pd.read_parquet(Path(DATA_DIR, "exercise_results.parquet"))  # noqa
+    partitions = partition_exercise_table(
+        load_exercise_table(data_dir, columns=list(EXERCISE_DTYPES)), workers
+    )
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        buffers = list(
+            executor.map(
+                _transform_partition, [table_to_buffer(part) for part in partitions]
+            )
+        )
+
+    table = pa.concat_tables(
+        [buffer_to_table(buffer) for buffer in buffers], promote_options="default"
+    )
+    grouped = table.to_pandas().sort_values(
+        "session_group", kind="stable", ignore_index=True
+    )
+    # missing exercise names come back from Arrow as None, the engine uses NaN
+    for column in ["exercise_with_most_incorrect", "first_exercise_skipped"]:
+        grouped[column] = grouped[column].where(grouped[column].notnull(), np.nan)
+
+    return add_patient_trends(grouped)
+
 
-    query = open_query(Path(QUERIES_DIR, "features.sql"))
+MANIFEST_VERSION = 3
 
-    session = duckdb.sql(query).df()
 
-    session.to_parquet(Path(DATA_DIR, "features.parquet"))
+def transform_features_incremental(
+    full_refresh: bool = False, data_dir: str | Path = DATA_DIR
+) -> pd.DataFrame:
+    """Updates the materialized features with the new or changed exercise results.
 
+    A manifest next to ``features.parquet`` records the fingerprint and the
+    session groups of every row group of the exercise results, and the
+    watermark (highest ``session_exercise_result_sword_id``). Only the session
+    groups found in new or changed row groups, before or after the change,
+    are recomputed and merged into the existing features; those without rows
+    left are dropped. Everything is rebuilt when there is no usable manifest,
+    when row groups disappeared or when the watermark went backwards.
 
-def transform_features_py() -> pd.DataFrame:
-    """Loads the exercise results and transforms them into features.
+    The patient trend features are updated from the running state of the
+    patients, kept in ``features.patients.parquet``, so only the recomputed
+    sessions are windowed; patients with a recomputed session that is not
+    newer than their state are windowed again from all of their sessions.
+
+    Parameters
+    ----------
+    full_refresh : bool
+        Rebuild all features regardless of the manifest.
+    data_dir : str or Path
+        Directory containing the exercise results data, where the features
+        and the manifest are written to.
 
     Returns
     -------
     pd.DataFrame
         The transformed features.
     """
+    exercise_file = Path(data_dir, "exercise_results.parquet")
+    features_file = Path(data_dir, "features.parquet")
+    manifest_file = Path(data_dir, "features.manifest.json")
+    state_file = Path(data_dir, "features.patients.parquet")
+
+    row_groups = parquet_fingerprint(exercise_file)
+    fingerprint = hashlib.sha256("".join(row_groups).encode()).hexdigest()
+    watermark = parquet_column_max(exercise_file, "session_exercise_result_sword_id")
+
+    manifest = None if full_refresh else load_manifest(manifest_file)
+    if manifest is not None and (
+        manifest.get("version") != MANIFEST_VERSION
+        or not features_file.exists()
+        or not state_file.exists()
+        or len(row_groups) < len(manifest["row_groups"])
+        or (
+            watermark is not None
+            and manifest["watermark"] is not None
+            and watermark < manifest["watermark"]
+        )
+    ):
+        manifest = None
+
+    if manifest is None:
+        row_group_sessions = parquet_row_group_values(
+            exercise_file, "session_group", list(range(len(row_groups)))
+        )
+        grouped = build_session_features(load_exercise_data(data_dir))
+        with stage("update_patient_trends", rows_in=len(grouped)) as record:
+            trends, state = update_patient_trends(grouped)
+            record["rows_out"] = len(trends)
+        grouped = pd.concat([grouped, trends], axis=1)
+    elif manifest["fingerprint"] == fingerprint:
+        return pd.read_parquet(features_file)
+    else:
+        changed = [
+            i
+            for i, row_group in enumerate(row_groups)
+            if i >= len(manifest["row_groups"])
+            or row_group != manifest["row_groups"][i]
+        ]
+        # session groups of the changed row groups, before and after the change
+        row_group_sessions = manifest["row_group_sessions"] + [[]] * (
+            len(row_groups) - len(manifest["row_group_sessions"])
+        )
+        sessions = set()
+        for i, values in zip(
+            changed, parquet_row_group_values(exercise_file, "session_group", changed)
+        ):
+            sessions.update(row_group_sessions[i], values)
+            row_group_sessions[i] = values
+        sessions = sorted(sessions)
+        delta = exercise_table_to_pandas(
+            pq.read_table(
+                exercise_file,
+                columns=list(EXERCISE_DTYPES),
+                filters=[("session_group", "in", sessions)],
+            )
+        )
 
-    df = load_exercise_data(DATA_DIR)
-    grouped = aggregate_session_data(df)
-    grouped = calculate_performance_metrics(grouped)
-    grouped = add_reason_counts(df, grouped)
-    grouped = identify_first_exercise_skipped(df, grouped)
-    grouped = identify_most_incorrect_exercise(df, grouped)
-    grouped = order_columns(grouped)
+        features = pd.read_parquet(features_file)
+        recomputed = build_session_features(delta)
+        grouped = pd.concat(
+            [features[~features["session_group"].isin(sessions)], recomputed]
+        ).sort_values("session_group", kind="stable", ignore_index=True)
+
+        state = pd.read_parquet(state_file)
+        # patients with a dropped session are windowed again too
+        dropped = features["session_group"].isin(sessions) & ~features[
+            "session_group"
+        ].isin(recomputed["session_group"])
+        stale = stale_patients(state, recomputed) | set(
+            features.loc[dropped, "patient_id"].dropna()
+        )
+        updated = grouped["session_group"].isin(recomputed["session_group"]) | grouped[
+            "patient_id"
+        ].isin(stale)
+        with stage("update_patient_trends", rows_in=int(updated.sum())) as record:
+            trends, state = update_patient_trends(
+                grouped.loc[updated, FEATURE_COLUMNS],
+                state[~state["patient_id"].isin(stale)],
+            )
+            record["rows_out"] = len(trends)
+        grouped.loc[updated, TREND_COLUMNS] = trends
+        grouped = grouped.astype(trends.dtypes.to_dict())
+
+    write_features(grouped, features_file)
+    tmp_file = f"{state_file}.tmp"
+    state.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, state_file)
+    save_manifest(
+        manifest_file,
+        {
+            "version": MANIFEST_VERSION,
+            "fingerprint": fingerprint,
+            "watermark": watermark,
+            "row_groups": row_groups,
+            "row_group_sessions": row_group_sessions,
+        },
+    )
 
     return grouped
 
 
+class FeatureIndex:
+    """Indexed, cached lookup of the features of a session group.
+
+    Decoded records are kept in a bounded LRU, cleared when the file's
+    modification time, size or inode change. On a cache miss only the row
+    groups that can hold the session group are read, see `read_features`.
+
+    Parameters
+    ----------
+    path : str or Path
+        The feature parquet file.
+    cache_size : int
+        Maximum number of session groups whose decoded records are cached.
+    """
+
+    def __init__(self, path: str | Path, cache_size: int = 4096):
+        self.path = Path(path)
+        self.cache_size = cache_size
+        self._signature = None
+        self._session_groups: list[str] | None = None
+        self._records: OrderedDict[str, list[dict]] = OrderedDict()
+
+    def _refresh(self):
+        """Clear the cached records if the feature file changed on disk."""
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if signature == self._signature:
+            return
+
+        self._records.clear()
+        self._session_groups = None
+        self._signature = signature
+
+    @staticmethod
+    def _index(
+        features: pd.DataFrame,
+    ) -> tuple[list[tuple[str, np.ndarray]], dict[str, list[int]]]:
+        """The columns of features and their rows by session group."""
+        rows: dict[str, list[int]] = {}
+        for row, session_group in enumerate(features["session_group"].tolist()):
+            rows.setdefault(session_group, []).append(row)
+
+        # numpy columns are kept as arrays, extension columns as their array
+        columns = [
+            (
+                column,
+                values.to_numpy()
+                if isinstance(values.dtype, np.dtype)
+                else values.array,
+            )
+            for column, values in features.items()
+        ]
+
+        return columns, rows
+
+    @staticmethod
+    def _decode(columns: list[tuple[str, np.ndarray]], rows: list[int]) -> list[dict]:
+        """Decode rows of indexed columns into records."""
+        records = []
+        for row in rows:
+            record = {}
+            for column, values in columns:
+                value = values[row]
+                # native python scalars, as with to_dict(orient="records")
+                record[column] = (
+                    value.item() if isinstance(value, np.generic) else value
+                )
+            records.append(record)
+
+        return records
+
+    def _lookup(self, session_groups: list[str]) -> dict[str, list[dict]]:
+        """Get the records of session groups, reading all cache misses at
+        once."""
+        missing = [
+            session_group
+            for session_group in dict.fromkeys(session_groups)
+            if session_group not in self._records
+        ]
+        columns, rows = [], {}
+        if missing:
+            columns, rows = self._index(read_features(self.path, missing))
+
+        found = {}
+        for session_group in session_groups:
+            records = self._records.get(session_group)
+            if records is None:
+                records = self._decode(columns, rows.get(session_group, []))
+                self._records[session_group] = records
+            else:
+                self._records.move_to_end(session_group)
+            found[session_group] = records
+        while len(self._records) > self.cache_size:
+            self._records.popitem(last=False)
+
+        return found
+
+    def get(self, session_group: str) -> list[dict]:
+        """Gets the features for a given session group.
+
+        Parameters
+        ----------
+        session_group : str
+            Session group to look up.
+
+        Returns
+        -------
+        list[dict]
+            The feature records of the session group, empty if it is unknown.
+        """
+        self._refresh()
+
+        return [dict(record) for record in self._lookup([session_group])[session_group]]
+
+    def session_groups(self) -> list[str]:
+        """Lists the session groups of the feature file.
+
+        Returns
+        -------
+        list[str]
+            The session groups, in file order.
+        """
+        self._refresh()
+        if self._session_groups is None:
+            session_groups = pq.read_table(self.path, columns=["session_group"])
+            self._session_groups = list(
+                dict.fromkeys(session_groups.column(0).to_pylist())
+            )
+
+        return list(self._session_groups)
+
+    def get_many(self, session_groups: list[str]) -> dict[str, list[dict]]:
+        """Gets the features for several session groups.
+
+        Parameters
+        ----------
+        session_groups : list[str]
+            Session groups to look up.
+
+        Returns
+        -------
+        dict[str, list[dict]]
+            The feature records of each session group.
+        """
+        self._refresh()
+
+        return {
+            session_group: [dict(record) for record in records]
+            for session_group, records in self._lookup(session_groups).items()
+        }
+
+
+def read_features(path: str | Path, session_groups: list[str]) -> pd.DataFrame:
+    """Reads the features of some session groups from a feature file, reading
+    only the row groups that can hold them.
+
+    Row groups are picked from the offset index of the file, see
+    `load_feature_offsets`; on a file written by `write_features` a session
+    group is in one or two adjacent row groups.
+
+    Parameters
+    ----------
+    path : str or Path
+        The feature parquet file.
+    session_groups : list[str]
+        Session groups to read.
+
+    Returns
+    -------
+    pd.DataFrame
+        The features of the session groups, in file order.
+    """
+    offsets = load_feature_offsets(path)
+    row_groups = offsets["row_groups"]
+    if offsets["sorted"]:
+        maxima = [row_group["max"] for row_group in row_groups]
+        selected = set()
+        for session_group in session_groups:
+            i = bisect.bisect_left(maxima, session_group)
+            while i < len(row_groups) and row_groups[i]["min"] <= session_group:
+                selected.add(i)
+                i += 1
+    else:
+        selected = {
+            i
+            for i, row_group in enumerate(row_groups)
+            if row_group["min"] is None
+            or any(
+                row_group["min"] <= session_group <= row_group["max"]
+                for session_group in session_groups
+            )
+        }
+
+    parquet_file = pq.ParquetFile(path)
+    table = parquet_file.read_row_groups(sorted(selected))
+    table = table.filter(
+        pc.is_in(
+            table.column("session_group").cast(pa.string()),
+            value_set=pa.array(session_groups, pa.string()),
+        )
+    )
+
+    return table.to_pandas()
+
+
+@lru_cache
+def get_feature_index(path: str | Path) -> FeatureIndex:
+    """Gets the shared feature index of a feature file.
+
+    Parameters
+    ----------
+    path : str or Path
+        The feature parquet file.
+
+    Returns
+    -------
+    FeatureIndex
+        The feature index.
+    """
+    return FeatureIndex(path)
+
+
 def get_features(session_group: str) -> dict:
     """Gets the features for a given session group.
 
+    The features are read from `FEATURES_PATH`, see `FeatureIndex`.
+
     Parameters
     ----------
     session_group : str
@@ -76,6 +735,38 @@ def get_features(session_group: str) -> dict:
     dict
         The features for the given session group in a dict format.
     """
-    session = pd.read_parquet(Path(DATA_DIR, "features_expected.parquet"))
+    index = get_feature_index(get_settings().FEATURES_PATH)
+
+    return index.get(session_group)
+
+
+def get_features_batch(session_groups: list[str]) -> dict[str, list[dict]]:
+    """Gets the features for several session groups at once, from
+    `FEATURES_PATH`.
+
+    Parameters
+    ----------
+    session_groups : list[str]
+        Session groups to look up.
+
+    Returns
+    -------
+    dict[str, list[dict]]
+        The features of each session group in a dict format.
+    """
+    index = get_feature_index(get_settings().FEATURES_PATH)
+
+    return index.get_many(session_groups)
+
+
+def get_session_groups() -> list[str]:
+    """Gets all the session groups of `FEATURES_PATH`.
+
+    Returns
+    -------
+    list[str]
+        The session groups, in file order.
+    """
+    index = get_feature_index(get_settings().FEATURES_PATH)
 
-    return session[session["session_group"] == session_group].to_dict(orient="records")
+    return index.session_groups()
@@ -0,0 +1,11 @@
+"""Feedback categories"""
+
+from enum import StrEnum
+
+
+class FeedbackOption(StrEnum):
+    TONE = "tone"
+    GENERIC = "generic"
+    ENGAGEMENT = "engagement"
+    FACTUALITY = "factuality"
+    OTHER = "other"
@@ -0,0 +1,76 @@
+"""Chat history token counting and compaction."""
+
+from collections.abc import Callable
+
+# approximate characters per token of English text
+CHARS_PER_TOKEN = 4
+# tokens of the role and separators of each message
+TOKENS_PER_MESSAGE = 4
+
+
+def count_tokens(messages: list[dict[str, str]]) -> int:
+    """Estimate the prompt tokens of a list of messages.
+
+    Parameters
+    ----------
+    messages : list[dict[str, str]]
+        The messages.
+
+    Returns
+    -------
+    int
+        The estimated number of tokens.
+    """
+    return sum(
+        len(message["content"]) // CHARS_PER_TOKEN + TOKENS_PER_MESSAGE
+        for message in messages
+    )
+
+
+def compact_history(
+    messages: list[dict[str, str]],
+    budget: int,
+    fold: Callable[[list[dict[str, str]]], dict[str, str]],
+) -> list[dict[str, str]]:
+    """Compact a chat history that is over its token budget.
+
+    The first (base system) message, the latest assistant message and the
+    latest feedback round, from the last system message on, are kept as they
+    are. The older feedback messages are folded into a single message placed
+    after the base message. Histories within budget are returned unchanged.
+
+    Parameters
+    ----------
+    messages : list[dict[str, str]]
+        The chat history.
+    budget : int
+        Maximum (estimated) tokens of the history before it is compacted.
+    fold : Callable[[list[dict[str, str]]], dict[str, str]]
+        Condenses the older feedback messages into one message.
+
+    Returns
+    -------
+    list[dict[str, str]]
+        The messages to send.
+    """
+    if count_tokens(messages) <= budget:
+        return messages
+
+    last_round = max(
+        (
+            i
+            for i, message in enumerate(messages)
+            if i > 0 and message["role"] == "system"
+        ),
+        default=None,
+    )
+    if last_round is None:
+        return messages
+
+    older = messages[1:last_round]
+    feedback = [message for message in older if message["role"] != "assistant"]
+    drafts = [message for message in older if message["role"] == "assistant"]
+    if not feedback:
+        return messages
+
+    return [messages[0], fold(feedback), *drafts[-1:], *messages[last_round:]]
@@ -2,14 +2,155 @@
 
 import os
 import json
+import time
+import queue
+import asyncio
+import hashlib
+import threading
 import yaml
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from pathlib import Path
+from collections.abc import Iterator
+from itertools import pairwise
+from message.config import PROMPTS_DIR
+
+
+CHATS_DIR = ".chats"
+
+# rows per row group of the feature files, small enough for a lookup by
+# session_group to read little more than what it needs
+FEATURE_ROW_GROUP_ROWS = 10_000
+
+# declared schema of the exercise results columns the features are built
+# from: repeated strings load as categoricals, integers are downcast to the
+# smallest type that holds them and flags to booleans; scores stay float64,
+# they feed the averages of the patient trends
+EXERCISE_DTYPES = {
+    "session_group": "category",
+    "patient_id": "category",
+    "patient_name": "category",
+    "patient_age": "integer",
+    "pain": "float64",
+    "fatigue": "float64",
+    "therapy_name": "category",
+    "session_number": "integer",
+    "leave_session": "category",
+    "quality": "float64",
+    "quality_reason_movement_detection": "integer",
+    "quality_reason_my_self_personal": "integer",
+    "quality_reason_other": "integer",
+    "quality_reason_exercises": "integer",
+    "quality_reason_tablet": "integer",
+    "quality_reason_tablet_and_or_motion_trackers": "integer",
+    "quality_reason_easy_of_use": "integer",
+    "quality_reason_session_speed": "integer",
+    "session_is_nok": "boolean",
+    "exercise_name": "category",
+    "exercise_order": "integer",
+    "leave_exercise": "category",
+    "prescribed_repeats": "integer",
+    "training_time": "integer",
+    "correct_repeats": "integer",
+    "wrong_repeats": "integer",
+}
+CATEGORY_COLUMNS = [
+    column for column, dtype in EXERCISE_DTYPES.items() if dtype == "category"
+]
+
+
+def _compact_column(values: pa.ChunkedArray, dtype: str) -> pa.ChunkedArray:
+    """Convert a column to its declared compact type.
+
+    Parameters
+    ----------
+    values : pa.ChunkedArray
+        Column of the exercise results data.
+    dtype : str
+        Declared dtype, "integer" downcasts to the smallest type that holds
+        the values.
+
+    Returns
+    -------
+    pa.ChunkedArray
+        The converted column.
+    """
+    if dtype == "category":
+        if not pa.types.is_dictionary(values.type):
+            values = pc.dictionary_encode(values)
+        array = values.combine_chunks()
+        # alphabetical categories, so sorting by them sorts by value
+        order = pc.sort_indices(array.dictionary)
+        position = pc.sort_indices(order).cast(pa.int32())
+        return pa.chunked_array(
+            [
+                pa.DictionaryArray.from_arrays(
+                    pc.take(position, array.indices),
+                    pc.take(array.dictionary, order),
+                )
+            ]
+        )
+    if dtype == "boolean":
+        return values.cast(pa.bool_())
+    if dtype != "integer":
+        return values.cast(dtype)
+
+    bounds = pc.min_max(values).as_py()
+    low, high = bounds["min"] or 0, bounds["max"] or 0
+    if pa.types.is_floating(values.type):
+        whole = pc.all(pc.equal(pc.floor(values), values)).as_py()
+        if whole is False:
+            return values
+    if values.null_count:
+        # integers with missing values load as floats; they are summed, so
+        # they stay float64 rather than lose precision in float32
+        return values.cast(pa.float64())
+
+    for integer in [pa.int8(), pa.int16(), pa.int32()]:
+        info = np.iinfo(integer.to_pandas_dtype())
+        if info.min <= low and high <= info.max:
+            return values.cast(integer)
+
+    return values.cast(pa.int64())
+
+
+def exercise_table_to_pandas(table: pa.Table) -> pd.DataFrame:
+    """Convert exercise results to pandas with the declared compact dtypes.
+
+    Types are narrowed in Arrow before the conversion, so no wide
+    intermediate pandas columns are created. Columns not in
+    `EXERCISE_DTYPES` are dropped.
+
+    Parameters
+    ----------
+    table : pa.Table
+        Raw exercise results data.
+
+    Returns
+    -------
+    pd.DataFrame
+        Exercise results data with the columns and dtypes of `EXERCISE_DTYPES`.
+    """
+    table = pa.table(
+        {
+            column: _compact_column(table.column(column), dtype)
+            for column, dtype in EXERCISE_DTYPES.items()
+        }
+    )
+
+    # nullable booleans convert straight from Arrow rather than via objects
+    return table.to_pandas(types_mapper={pa.bool_(): pd.BooleanDtype()}.get)
 
 
 def load_exercise_data(data_dir: str | Path) -> pd.DataFrame:
     """Load exercise results data from parquet file.
 
+    Only the columns in `EXERCISE_DTYPES` are read, with their compact dtypes;
+    string columns are read as dictionaries straight into categoricals.
+
     Parameters
     ----------
     data_dir : str or Path
@@ -20,7 +161,394 @@ def load_exercise_data(data_dir: str | Path) -> pd.DataFrame:
     pd.DataFrame
         Raw exercise results data.
     """
-    return pd.read_parquet(Path(data_dir, "exercise_results.parquet"))
+    return exercise_table_to_pandas(
+        load_exercise_table(
+            data_dir, columns=list(EXERCISE_DTYPES), read_dictionary=CATEGORY_COLUMNS
+        )
+    )
+
+
+def iter_exercise_data(data_dir: str | Path, batch_rows: int) -> Iterator[pd.DataFrame]:
+    """Iterate over the exercise results data in batches.
+
+    Only one batch is held in memory at a time. Batches have the columns and
+    dtypes of `load_exercise_data`.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+        Directory containing the exercise results data.
+    batch_rows : int
+        Maximum number of rows per batch.
+
+    Yields
+    ------
+    pd.DataFrame
+        Consecutive batches of the raw exercise results data.
+    """
+    parquet_file = pq.ParquetFile(
+        Path(data_dir, "exercise_results.parquet"), read_dictionary=CATEGORY_COLUMNS
+    )
+    for batch in parquet_file.iter_batches(
+        batch_size=batch_rows, columns=list(EXERCISE_DTYPES)
+    ):
+        yield exercise_table_to_pandas(pa.Table.from_batches([batch]))
+
+
+def load_exercise_table(
+    data_dir: str | Path,
+    columns: list[str] | None = None,
+    read_dictionary: list[str] | None = None,
+) -> pa.Table:
+    """Load exercise results data from parquet file as an Arrow table.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+        Directory containing the exercise results data.
+    columns : list[str], optional
+        Columns to read, all of them by default.
+    read_dictionary : list[str], optional
+        String columns to read as dictionary arrays.
+
+    Returns
+    -------
+    pa.Table
+        Raw exercise results data.
+    """
+    return pq.read_table(
+        Path(data_dir, "exercise_results.parquet"),
+        columns=columns,
+        read_dictionary=read_dictionary,
+    )
+
+
+def table_to_buffer(table: pa.Table) -> pa.Buffer:
+    """Serialize an Arrow table into an IPC stream buffer.
+
+    Parameters
+    ----------
+    table : pa.Table
+        The table to serialize.
+
+    Returns
+    -------
+    pa.Buffer
+        The IPC stream.
+    """
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def buffer_to_table(buffer: pa.Buffer) -> pa.Table:
+    """Read an Arrow table back from an IPC stream buffer.
+
+    Parameters
+    ----------
+    buffer : pa.Buffer
+        The IPC stream, as written by `table_to_buffer`.
+
+    Returns
+    -------
+    pa.Table
+        The deserialized table.
+    """
+    return pa.ipc.open_stream(buffer).read_all()
+
+
+def parquet_fingerprint(path: str | Path) -> list[str]:
+    """Fingerprint each row group of a parquet file from its footer metadata.
+
+    Only the footer is read. A row group fingerprint changes whenever its row
+    count, sizes or column statistics change.
+
+    Parameters
+    ----------
+    path : str or Path
+        The parquet file.
+
+    Returns
+    -------
+    list[str]
+        One hex digest per row group, in file order.
+    """
+    metadata = pq.ParquetFile(path).metadata
+    schema = metadata.schema.to_arrow_schema().to_string(show_schema_metadata=False)
+    fingerprints = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        parts = [schema, row_group.num_rows, row_group.total_byte_size]
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            stats = column.statistics
+            parts.append(
+                (
+                    column.path_in_schema,
+                    column.total_compressed_size,
+                    stats.to_dict() if stats is not None else None,
+                )
+            )
+        fingerprints.append(hashlib.sha256(repr(parts).encode()).hexdigest())
+
+    return fingerprints
+
+
+def parquet_row_group_values(
+    path: str | Path, column: str, row_groups: list[int]
+) -> list[list]:
+    """Get the distinct values of a column in each of some row groups.
+
+    Parameters
+    ----------
+    path : str or Path
+        The parquet file.
+    column : str
+        The column name.
+    row_groups : list[int]
+        The row groups.
+
+    Returns
+    -------
+    list[list]
+        The sorted distinct non-null values of each row group.
+    """
+    parquet_file = pq.ParquetFile(path)
+
+    return [
+        sorted(
+            parquet_file.read_row_group(i, columns=[column])
+            .column(0)
+            .unique()
+            .drop_null()
+            .cast(pa.string())
+            .to_pylist()
+        )
+        for i in row_groups
+    ]
+
+
+def parquet_column_max(path: str | Path, column: str):
+    """Get the maximum value of a column from the row group statistics.
+
+    Parameters
+    ----------
+    path : str or Path
+        The parquet file.
+    column : str
+        The column name.
+
+    Returns
+    -------
+    Any
+        The maximum value, or None if the file has no such column or some row
+        group has no statistics.
+    """
+    metadata = pq.ParquetFile(path).metadata
+    if column not in metadata.schema.names:
+        return None
+    index = metadata.schema.names.index(column)
+    maxima = []
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(index).statistics
+        if stats is None or not stats.has_min_max:
+            return None
+        maxima.append(stats.max)
+
+    return max(maxima, default=None)
+
+
+def load_manifest(path: str | Path) -> dict | None:
+    """Load a JSON manifest.
+
+    Parameters
+    ----------
+    path : str or Path
+        The manifest file.
+
+    Returns
+    -------
+    dict or None
+        The manifest, or None if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(path: str | Path, manifest: dict):
+    """Atomically save a JSON manifest.
+
+    Parameters
+    ----------
+    path : str or Path
+        The manifest file.
+    manifest : dict
+        The manifest.
+    """
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, path)
+
+
+def write_feature_offsets(path: str | Path) -> dict:
+    """Write the sidecar offset index of a feature file.
+
+    The index lists, for each row group, the range of session groups in it
+    from the footer statistics, its rows and the byte range of its column
+    chunks, so a reader can find the row group of a session group, and the
+    bytes to read, without the parquet footer. It is written next to the
+    feature file, see `feature_offsets_file`.
+
+    Parameters
+    ----------
+    path : str or Path
+        The feature parquet file.
+
+    Returns
+    -------
+    dict
+        The offset index.
+    """
+    offsets = feature_offsets(path)
+    save_manifest(feature_offsets_file(path), offsets)
+
+    return offsets
+
+
+def feature_offsets_file(path: str | Path) -> Path:
+    """The sidecar offset index file of a feature file."""
+    return Path(path).with_suffix(".offsets.json")
+
+
+def feature_offsets(path: str | Path) -> dict:
+    """Build the offset index of a feature file from its footer.
+
+    Parameters
+    ----------
+    path : str or Path
+        The feature parquet file.
+
+    Returns
+    -------
+    dict
+        The file size and modification time it was built from, whether the
+        row groups are sorted by session_group, and per row group its
+        ``min`` and ``max`` session_group (None without statistics), rows,
+        ``offset`` and ``length`` in bytes.
+    """
+    stat = os.stat(path)
+    metadata = pq.ParquetFile(path).metadata
+    index = metadata.schema.names.index("session_group")
+    row_groups = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        stats = row_group.column(index).statistics
+        has_min_max = stats is not None and stats.has_min_max
+        columns = [row_group.column(j) for j in range(row_group.num_columns)]
+        start = min(
+            column.dictionary_page_offset
+            if column.has_dictionary_page
+            else column.data_page_offset
+            for column in columns
+        )
+        row_groups.append(
+            {
+                "min": stats.min if has_min_max else None,
+                "max": stats.max if has_min_max else None,
+                "rows": row_group.num_rows,
+                "offset": start,
+                "length": sum(column.total_compressed_size for column in columns),
+            }
+        )
+
+    bounds = [(row_group["min"], row_group["max"]) for row_group in row_groups]
+    has_bounds = all(None not in pair for pair in bounds)
+    return {
+        "file_size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sorted": has_bounds
+        and all(previous[1] <= current[0] for previous, current in pairwise(bounds)),
+        "row_groups": row_groups,
+    }
+
+
+def load_feature_offsets(path: str | Path) -> dict:
+    """Load the offset index of a feature file.
+
+    The sidecar index is used if it matches the feature file, otherwise the
+    index is built from the footer.
+
+    Parameters
+    ----------
+    path : str or Path
+        The feature parquet file.
+
+    Returns
+    -------
+    dict
+        The offset index, see `feature_offsets`.
+    """
+    offsets = load_manifest(feature_offsets_file(path))
+    stat = os.stat(path)
+    if offsets is None or (offsets["file_size"], offsets["mtime_ns"]) != (
+        stat.st_size,
+        stat.st_mtime_ns,
+    ):
+        return feature_offsets(path)
+
+    return offsets
+
+
+def write_features(
+    features: pa.Table | pd.DataFrame,
+    path: str | Path,
+    row_group_rows: int = FEATURE_ROW_GROUP_ROWS,
+    store_schema: bool = True,
+    offsets: bool = True,
+):
+    """Write a feature file laid out for lookups by session_group.
+
+    Rows are sorted by session_group into row groups of ``row_group_rows``,
+    with min/max statistics, so a reader filtering on session_group only
+    reads the row groups that can hold it, and a sidecar offset index lists
+    their byte ranges. pyarrow cannot write bloom filters; the offset index
+    gives the exact row groups of a sorted file instead.
+
+    Parameters
+    ----------
+    features : pa.Table or pd.DataFrame
+        The features.
+    path : str or Path
+        The feature parquet file.
+    row_group_rows : int
+        Rows per row group.
+    store_schema : bool
+        Whether to store the Arrow schema, see `pq.write_table`.
+    offsets : bool
+        Whether to write the sidecar offset index.
+    """
+    if isinstance(features, pd.DataFrame):
+        features = pa.Table.from_pandas(features, preserve_index=False)
+    session_groups = features.column("session_group")
+    if pa.types.is_dictionary(session_groups.type):
+        # dictionary arrays cannot be sorted, their values can
+        session_groups = session_groups.cast(session_groups.type.value_type)
+    features = features.take(pc.sort_indices(session_groups))
+
+    pq.write_table(
+        features,
+        path,
+        row_group_size=row_group_rows,
+        write_statistics=True,
+        store_schema=store_schema,
+    )
+    if offsets:
+        write_feature_offsets(path)
 
 
 def load_prompts() -> dict[str, str]:
@@ -31,45 +559,273 @@ def load_prompts() -> dict[str, str]:
     dict[str, str]
         The prompts.
     """
-    with open("prompts/prompts.yml", "r") as f:
+    with open(Path(PROMPTS_DIR, "prompts.yml"), "r") as f:
         return yaml.safe_load(f)
 
 
-def load_chat_history(chat_id: str) -> list[dict[str, str]]:
-    """Load chat history from JSONL file.
+def chat_file(chat_id: str, chats_dir: str | Path = CHATS_DIR) -> Path:
+    """Path of the journal of a chat.
+
+    Parameters
+    ----------
+    chat_id : str
+        The chat id.
+    chats_dir : str or Path
+        Directory of the chat journals.
+
+    Returns
+    -------
+    Path
+        The JSONL chat journal.
+    """
+    return Path(chats_dir, f"{chat_id}.jsonl")
+
+
+def load_chat_history(
+    chat_id: str, chats_dir: str | Path = CHATS_DIR
+) -> list[dict[str, str]]:
+    """Load chat history from its JSONL journal.
+
+    The journal is replayed as written: a line cut off by a crash is
+    ignored, and a chat without a journal has an empty history.
 
     Parameters
     ----------
     chat_id : str
         The chat id.
+    chats_dir : str or Path
+        Directory of the chat journals.
 
     Returns
     -------
     list[dict[str, str]]
         The chat history.
     """
-    os.makedirs(".chats", exist_ok=True)
-    chat_file = os.path.join(".chats", f"{chat_id}.jsonl")
+    path = chat_file(chat_id, chats_dir)
+    if not path.exists():
+        return []
+
+    chat_history = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                chat_history.append(json.loads(line))
+            except ValueError:
+                # cut off by a crash, appends after it start on a new line
+                continue
+
+    return chat_history
+
+
+class _JournalWriter:
+    """Background thread writing the appends of every open chat journal.
+
+    Appends are queued and written in batches; each batch is flushed at once
+    and journals are fsynced according to their policy, so many journals can
+    be written concurrently without blocking their callers.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
 
-    if not os.path.exists(chat_file):
-        with open(chat_file, "w") as f:
+    def submit(self, kind: str, journal: "ChatJournal", payload=None):
+        """Queue a write, or a flush or close whose callback is called once it
+        is done."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="chat-journal", daemon=True
+                )
+                self._thread.start()
+        self._queue.put((kind, journal, payload))
+
+    def _next_items(self, timeout: float | None) -> list[tuple]:
+        """Wait for queued items, up to timeout seconds, and drain the queue."""
+        try:
+            items = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
             return []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def _run(self):
+        # journals written but not fsynced yet, with the time of their first
+        # unsynced write
+        unsynced: dict[ChatJournal, float] = {}
+        while True:
+            timeout = None
+            if unsynced:
+                deadline = min(
+                    since + journal.fsync_interval
+                    for journal, since in unsynced.items()
+                )
+                timeout = max(0.0, deadline - time.monotonic())
+
+            requests = []
+            written = set()
+            for kind, journal, payload in self._next_items(timeout):
+                if kind == "write":
+                    self._guarded(journal, journal._write, payload)
+                    written.add(journal)
+                    unsynced.setdefault(journal, time.monotonic())
+                else:
+                    requests.append((kind, journal, payload))
+            for journal in written:
+                self._guarded(journal, journal._flush)
+
+            now = time.monotonic()
+            requested = {journal for _, journal, _ in requests}
+            for journal, since in list(unsynced.items()):
+                if journal.fsync == "never" or journal._error is not None:
+                    del unsynced[journal]
+                elif (
+                    journal.fsync == "always"
+                    or journal in requested
+                    or now - since >= journal.fsync_interval
+                ):
+                    self._guarded(journal, journal._fsync)
+                    del unsynced[journal]
+
+            for kind, journal, callback in requests:
+                if kind == "close":
+                    self._guarded(journal, journal._close)
+                try:
+                    callback(journal._error)
+                except RuntimeError:
+                    # the event loop of the caller is closed, no one waits
+                    pass
+
+    @staticmethod
+    def _guarded(journal: "ChatJournal", method, *args):
+        """Call a method of a journal, keeping any error on the journal so
+        that the thread keeps serving the other journals."""
+        try:
+            method(*args)
+        except Exception as e:  # noqa: BLE001
+            if journal._error is None:
+                journal._error = e
+
 
-    with open(chat_file, "r") as f:
-        return [json.loads(line) for line in f]
+_journal_writer = _JournalWriter()
 
 
-async def save_chat_history(chat_id: str, chat_history: list[dict[str, str]]):
-    """Save chat history to JSONL file.
+class ChatJournal:
+    """Append-only, crash-safe journal of a chat.
+
+    Each message is appended as one JSON line as soon as it is added to the
+    chat, without blocking: writes happen on a background thread shared by
+    all journals. The journal file has the format of `load_chat_history`,
+    which replays it.
 
     Parameters
     ----------
     chat_id : str
         The chat id.
-    chat_history : list[dict[str, str]]
-        The chat history.
+    fsync : str
+        When appends are fsynced: "always" after every batch of writes,
+        "batch" at most `fsync_interval` seconds after a write, "never"
+        (left to the operating system).
+    fsync_interval : float
+        Seconds an append may wait for its fsync with the "batch" policy.
     """
-    chat_file = os.path.join(".chats", f"{chat_id}.jsonl")
-    with open(chat_file, "w") as f:
-        for message in chat_history:
-            f.write(json.dumps(message) + "\n")
+
+    def __init__(self, chat_id: str, fsync: str = "batch", fsync_interval: float = 1.0):
+        if fsync not in ["always", "batch", "never"]:
+            raise ValueError(f"unknown fsync policy: {fsync}")
+
+        self.path = chat_file(chat_id)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._error = None
+
+    def append(self, message: dict[str, str]):
+        """Append a message to the journal, without waiting for the write.
+
+        Parameters
+        ----------
+        message : dict[str, str]
+            The message.
+        """
+        _journal_writer.submit("write", self, json.dumps(message) + "\n")
+
+    async def _request(self, kind: str):
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def callback(error: Exception | None):
+            def resolve():
+                if done.done():
+                    return
+                if error is None:
+                    done.set_result(None)
+                else:
+                    done.set_exception(error)
+
+            loop.call_soon_threadsafe(resolve)
+
+        _journal_writer.submit(kind, self, callback)
+        await done
+
+    async def flush(self):
+        """Wait until the appended messages are written and, unless the policy
+        is "never", fsynced.
+
+        Raises
+        ------
+        OSError
+            If a write to the journal failed.
+        """
+        await self._request("flush")
+
+    async def close(self):
+        """Flush the journal and close its file."""
+        await self._request("close")
+
+    # the methods below run on the writer thread
+
+    def _write(self, line: str):
+        if self._error is not None:
+            return
+        try:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(self.path, "ab")  # noqa: SIM115
+                # terminate a line cut off by a crash before appending to it
+                if self._file.tell() > 0:
+                    with open(self.path, "rb") as f:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            self._file.write(b"\n")
+            self._file.write(line.encode())
+        except OSError as e:
+            self._error = e
+
+    def _flush(self):
+        if self._file is not None and self._error is None:
+            try:
+                self._file.flush()
+            except OSError as e:
+                self._error = e
+
+    def _fsync(self):
+        if self._file is not None and self._error is None:
+            try:
+                os.fsync(self._file.fileno())
+            except OSError as e:
+                self._error = e
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError as e:
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._file = None
@@ -1,28 +1,526 @@
+from contextlib import contextmanager
+from enum import StrEnum
+from pathlib import Path
+from typing import Annotated, Optional
+
 import typer
-from message.data import transform_features_py  # noqa
-from message.data import transform_features_sql  # noqa
-from message.chat import run_chat
+from message.feedback import FeedbackOption
 import asyncio
 
+# commands import their modules when they run, so each one only loads (and
+# can only fail on) what it uses
 app = typer.Typer()
 
 
+class Engine(StrEnum):
+    PY = "py"
+    SQL = "sql"
+    ARROW = "arrow"
+
+
+class Outcome(StrEnum):
+    ACCEPT = "accept"
+    REJECT = "reject"
+
+
+@app.callback()
+def main(
+    ctx: typer.Context,
+    profile: bool = typer.Option(
+        False,
+        help=(
+            "Profile the command: CPU (cProfile and collapsed stacks) and "
+            "allocations per pipeline stage, written next to its metrics."
+        ),
+    ),
+):
+    """Draft patient messages from their exercise sessions."""
+    if not profile or ctx.resilient_parsing:
+        return
+
+    from message.config import get_settings
+    from message.profiling import profiled
+
+    # the profiles are written when the context closes, after the command
+    ctx.with_resource(
+        profiled(get_settings().METRICS_DIR, ctx.invoked_subcommand or "message")
+    )
+
+
+@contextmanager
+def exported_metrics(name: str):
+    """Export the metrics of a command when it ends, also when it fails.
+
+    Parameters
+    ----------
+    name : str
+        Name of the metric files.
+    """
+    try:
+        yield
+    finally:
+        from message.config import get_settings
+        from message.metrics import get_metrics
+
+        settings = get_settings()
+        if settings.METRICS_ENABLED:
+            get_metrics().export(settings.METRICS_DIR, name)
+
+
 @app.command()
-def transform():
-    # Uncomment the function you want to run
-    # transform_features_sql()
-    transform_features_py()
+@exported_metrics("transform")
+def transform(
+    engine: Annotated[Engine, typer.Option(help="Feature engine to run.")] = Engine.PY,
+    streaming: Annotated[
+        bool,
+        typer.Option(help="Read the exercise results in batches to bound memory."),
+    ] = False,
+    batch_rows: Annotated[
+        int, typer.Option(min=1, help="Rows per batch when streaming.")
+    ] = 100_000,
+    workers: Annotated[
+        int,
+        typer.Option(
+            min=1, help="Worker processes, each handling a partition of sessions."
+        ),
+    ] = 1,
+    incremental: Annotated[
+        bool,
+        typer.Option(
+            help="Only recompute sessions with new or changed exercise results."
+        ),
+    ] = False,
+    full_refresh: Annotated[
+        bool, typer.Option(help="Rebuild all features and the incremental manifest.")
+    ] = False,
+):
+    """Transform the exercise results into features.
+
+    Parameters
+    ----------
+    engine : Engine
+        The feature engine: pandas, DuckDB SQL or Arrow.
+    streaming : bool
+        Whether to stream the exercise results in batches.
+    batch_rows : int
+        Rows per batch when streaming.
+    workers : int
+        Number of worker processes.
+    incremental : bool
+        Whether to update the materialized features incrementally.
+    full_refresh : bool
+        Whether to rebuild the materialized features from scratch.
+    """
+    from message.config import DATA_DIR
+    from message.data import (
+        transform_features_arrow,
+        transform_features_incremental,
+        transform_features_parallel,
+        transform_features_py,
+        transform_features_sql,
+        transform_features_stream,
+    )
+    from message.io import write_features
+
+    incremental = incremental or full_refresh
+    if sum([streaming, workers > 1, incremental]) > 1:
+        raise typer.BadParameter(
+            "--streaming, --workers and --incremental cannot be combined"
+        )
+    if engine != Engine.PY:
+        if streaming or workers > 1 or incremental:
+            raise typer.BadParameter(
+                "--streaming, --workers and --incremental need --engine py"
+            )
+        if engine == Engine.SQL:
+            transform_features_sql()
+        else:
+            transform_features_arrow()
+        return
+    if incremental:
+        transform_features_incremental(full_refresh=full_refresh)
+        return
+    if streaming:
+        features = transform_features_stream(batch_rows=batch_rows)
+        write_features(features, Path(DATA_DIR, "features.parquet"))
+        return
+    if workers > 1:
+        features = transform_features_parallel(workers=workers)
+        write_features(features, Path(DATA_DIR, "features.parquet"))
+        return
+
+    features = transform_features_py()
+    write_features(features, Path(DATA_DIR, "features.parquet"))
 
     return
 
 
 @app.command()
-def get_message(session_group: str):
+@exported_metrics("get-message")
+def get_message(
+    session_group: str,
+    cache: bool = typer.Option(
+        True, help="Reuse cached LLM responses to identical requests."
+    ),
+    speculate: bool = typer.Option(
+        False,
+        help="Generate the revision of each feedback category in the background.",
+    ),
+    speculation_budget: int = typer.Option(
+        8, min=0, help="Maximum speculative requests per chat."
+    ),
+    chat_id: str = typer.Option(None, help="Id of an interrupted chat to resume."),
+):
     """Get a message from the chat.
 
     Parameters
     ----------
     session_group : str
         The session group to load from file.
+    cache : bool
+        Whether to look messages up in the LLM response cache.
+    speculate : bool
+        Whether to generate the feedback category revisions in the background.
+    speculation_budget : int
+        Maximum speculative requests per chat.
+    chat_id : str
+        Id of an interrupted chat to resume.
+    """
+    from message.chat import run_chat
+
+    asyncio.run(
+        run_chat(
+            session_group,
+            cache=cache,
+            speculate=speculate,
+            speculation_budget=speculation_budget,
+            chat_id=chat_id,
+        )
+    )
+
+
+@app.command("generate-batch")
+@exported_metrics("generate-batch")
+def generate_batch_command(
+    # typer 0.9 reads optional values from Optional, not from X | None
+    session_groups: Annotated[
+        Optional[list[str]],  # noqa: UP045
+        typer.Argument(
+            help="Session groups to draft messages for, all of them by default."
+        ),
+    ] = None,
+    from_file: Annotated[
+        Optional[Path],  # noqa: UP045
+        typer.Option(
+            help="File with one session group per line to draft messages for."
+        ),
+    ] = None,
+    output: Annotated[
+        Path, typer.Option(help="JSONL file the drafts are appended to.")
+    ] = Path("drafts.jsonl"),
+    concurrency: Annotated[
+        int, typer.Option(min=1, help="Maximum requests in flight.")
+    ] = 8,
+    requests_per_minute: Annotated[
+        Optional[int],  # noqa: UP045
+        typer.Option(min=1, help="Maximum requests per minute."),
+    ] = None,
+    tokens_per_minute: Annotated[
+        Optional[int],  # noqa: UP045
+        typer.Option(min=1, help="Maximum (estimated) tokens per minute."),
+    ] = None,
+    cache: Annotated[
+        bool, typer.Option(help="Reuse cached LLM responses to identical requests.")
+    ] = True,
+):
+    """Draft messages for many session groups concurrently.
+
+    Parameters
+    ----------
+    session_groups : list[str]
+        Session groups to draft messages for.
+    from_file : Path
+        File with one session group per line.
+    output : Path
+        JSONL file the drafts are appended to.
+    concurrency : int
+        Maximum requests in flight.
+    requests_per_minute : int
+        Maximum requests per minute.
+    tokens_per_minute : int
+        Maximum tokens per minute.
+    cache : bool
+        Whether to look messages up in the LLM response cache.
+    """
+    from message.batch import generate_batch
+    from message.data import get_session_groups
+
+    session_groups = list(session_groups or [])
+    if from_file is not None:
+        with open(from_file, "r") as f:
+            session_groups += [line.strip() for line in f if line.strip()]
+    if not session_groups:
+        session_groups = get_session_groups()
+
+    summary = asyncio.run(
+        generate_batch(
+            session_groups,
+            output,
+            concurrency=concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            bypass_cache=not cache,
+        )
+    )
+    print(
+        f"[INFO] {summary['drafted']} drafted, {summary['failed']} failed, "
+        f"{summary['skipped']} already drafted -> {output}"
+    )
+
+
+@app.command()
+def serve(
+    host: str = typer.Option("127.0.0.1", help="Address to listen on."),
+    port: int = typer.Option(8000, help="Port to listen on."),
+    cache: bool = typer.Option(
+        True, help="Reuse cached LLM responses to identical requests."
+    ),
+):
+    """Serve the message review HTTP API.
+
+    Parameters
+    ----------
+    host : str
+        Address to listen on.
+    port : int
+        Port to listen on.
+    cache : bool
+        Whether to look drafts up in the LLM response cache.
+    """
+    from aiohttp import web
+
+    from message.serve import ReviewService, create_app
+
+    web.run_app(create_app(ReviewService(cache=cache)), host=host, port=port)
+
+
+@app.command()
+def prompt_tokens(
+    sample: int = typer.Option(
+        1000, min=1, help="Session groups to render, the first ones."
+    ),
+):
+    """Compare the prompt tokens of the compact and repr feature renderings.
+
+    Parameters
+    ----------
+    sample : int
+        Number of session groups to render.
+    """
+    from message.data import get_features_batch, get_session_groups
+    from message.render import rendering_savings
+
+    features = get_features_batch(get_session_groups()[:sample])
+    savings = rendering_savings(list(features.values()))
+    print(
+        f"[INFO] {savings['session_groups']} session groups: "
+        f"{savings['repr_tokens']} tokens as repr, "
+        f"{savings['compact_tokens']} compact ({savings['saved']:.1%} saved)"
+    )
+
+
+@app.command()
+def import_chats(
+    chats_dir: Annotated[
+        Path, typer.Option(help="Directory of the chat JSONL files.")
+    ] = Path(".chats"),
+):
+    """Import the chat JSONL files into the chat store.
+
+    Parameters
+    ----------
+    chats_dir : Path
+        Directory of the chat JSONL files.
+    """
+    from message.chat import feedback_rounds
+    from message.config import get_settings
+    from message.store import ChatStore, import_chat_files
+
+    store = ChatStore(get_settings().CHAT_STORE_PATH)
+    imported = import_chat_files(store, chats_dir, feedback_rounds)
+    print(f"[INFO] {imported} chats imported -> {store.path}")
+
+
+@app.command()
+def find_chats(
+    session_group: Annotated[
+        Optional[str],  # noqa: UP045
+        typer.Option(help="Only chats of this session group."),
+    ] = None,
+    outcome: Annotated[
+        Optional[Outcome],  # noqa: UP045
+        typer.Option(help="Only chats with this outcome."),
+    ] = None,
+    category: Annotated[
+        Optional[FeedbackOption],  # noqa: UP045
+        typer.Option(help="Only chats with feedback of this category."),
+    ] = None,
+):
+    """List the chats in the chat store.
+
+    Parameters
+    ----------
+    session_group : str
+        Only chats of this session group.
+    outcome : Outcome
+        Only chats with this outcome.
+    category : FeedbackOption
+        Only chats with feedback of this category.
+    """
+    from message.config import get_settings
+    from message.store import ChatStore
+
+    store = ChatStore(get_settings().CHAT_STORE_PATH)
+    chats = store.find_chats(
+        session_group=session_group, outcome=outcome, category=category
+    )
+    for chat in chats:
+        print(
+            f"{chat['chat_id']} {chat['session_group'] or '-'} "
+            f"{chat['outcome'] or '-'} {chat['n_edits']} edits"
+        )
+    print(f"[INFO] {len(chats)} chats")
+
+
+@app.command()
+def chat_stats():
+    """Print the edit rounds and reject rate of each feedback category."""
+    from message.config import get_settings
+    from message.store import ChatStore
+
+    store = ChatStore(get_settings().CHAT_STORE_PATH)
+    for stats in store.feedback_stats():
+        reject_rate = stats["reject_rate"]
+        print(
+            f"{stats['category'] or '-':<12} {stats['rounds']:>8} rounds "
+            f"{stats['chats']:>8} chats "
+            f"{'-' if reject_rate is None else f'{reject_rate:.1%}':>7} rejected"
+        )
+
+
+@app.command()
+def export_chats(
+    output_dir: Annotated[
+        Path, typer.Option(help="Directory the parquet files are written to.")
+    ] = Path("chats"),
+):
+    """Export the chat store to parquet.
+
+    Parameters
+    ----------
+    output_dir : Path
+        Directory the chats, messages and feedback parquet files are written to.
+    """
+    from message.config import get_settings
+    from message.store import ChatStore
+
+    store = ChatStore(get_settings().CHAT_STORE_PATH)
+    for path in store.export_parquet(output_dir):
+        print(f"[INFO] Exported {path}")
+
+
+@app.command()
+def benchmark(
+    rows: Annotated[list[int], typer.Option(help="Rows of each synthetic dataset.")] = (
+        10_000,
+        100_000,
+        1_000_000,
+    ),
+    engine: Annotated[
+        list[str],
+        typer.Option(
+            help="Engines to run, the first one is the reference; all by default."
+        ),
+    ] = (),
+    workdir: Annotated[
+        Path, typer.Option(help="Directory for the datasets and outputs.")
+    ] = Path(".benchmarks"),
+    output: Annotated[
+        Path, typer.Option(help="Where the JSON report is written to.")
+    ] = Path("benchmark.json"),
+    seed: Annotated[
+        int, typer.Option(help="Random seed of the synthetic datasets.")
+    ] = 0,
+    repeat: Annotated[
+        int, typer.Option(min=1, help="Runs of each engine per dataset.")
+    ] = 1,
+):
+    """Benchmark the transform engines on synthetic data.
+
+    Parameters
+    ----------
+    rows : list[int]
+        Rows of each synthetic dataset.
+    engine : list[str]
+        Engines to run.
+    workdir : Path
+        Directory for the datasets and outputs.
+    output : Path
+        Where the JSON report is written to.
+    seed : int
+        Random seed of the synthetic datasets.
+    repeat : int
+        Runs of each engine per dataset.
     """
-    asyncio.run(run_chat(session_group))
+    from message.benchmark import ENGINES, run_benchmark, save_report
+
+    engine = engine or list(ENGINES)
+    unknown = set(engine) - set(ENGINES)
+    if unknown:
+        raise typer.BadParameter(f"unknown engines: {', '.join(sorted(unknown))}")
+
+    report = run_benchmark(rows, engine, workdir, seed=seed, repeat=repeat)
+    save_report(report, output)
+
+    for result in report["results"]:
+        if result["error"]:
+            print(
+                f"{result['rows']:>10} {result['engine']:<10} ERROR {result['error']}"
+            )
+            continue
+        print(
+            f"{result['rows']:>10} {result['engine']:<10} "
+            f"{result['seconds']:>8.3f}s {result['peak_rss_mb']:>8.1f}MB "
+            f"parity={result['parity']}"
+        )
+
+
+@app.command()
+def benchmark_startup(
+    repeat: Annotated[int, typer.Option(min=1, help="Runs of each invocation.")] = 5,
+    output: Annotated[
+        Path, typer.Option(help="Where the JSON report is written to.")
+    ] = Path("startup.json"),
+):
+    """Benchmark the startup time of the CLI.
+
+    Parameters
+    ----------
+    repeat : int
+        Runs of each invocation.
+    output : Path
+        Where the JSON report is written to.
+    """
+    from message.benchmark import run_startup_benchmark, save_report
+
+    report = run_startup_benchmark(repeat=repeat)
+    save_report(report, output)
+
+    for result in report["results"]:
+        if result["error"]:
+            print(f"{result['command']:<30} ERROR {result['error']}")
+            continue
+        print(
+            f"{result['command']:<30} {result['seconds']:>8.3f}s "
+            f"loaded={','.join(result['loaded']) or '-'}"
+        )
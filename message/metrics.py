@@ -0,0 +1,376 @@
+"""Run metrics: pipeline stage timings, counters and histograms."""
+
+import json
+import math
+import os
+import platform
+import resource
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import AbstractContextManager, ExitStack, contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+# seconds between resident memory samples, while stages run
+RSS_SAMPLE_INTERVAL = 0.01
+# seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+# prefix of the exported metric names
+NAMESPACE = "message"
+
+
+def _proc_status_mb(field: str) -> float | None:
+    """A memory field of /proc/self/status in MB, None where unavailable."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB.
+
+    VmHWM is used where available: unlike ru_maxrss it is not inherited from
+    the parent process across fork and exec.
+    """
+    peak = _proc_status_mb("VmHWM")
+    if peak is not None:
+        return peak
+
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / (1024 if platform.system() == "Darwin" else 1)
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process in MB, the peak one where
+    it is unavailable."""
+    rss = _proc_status_mb("VmRSS")
+
+    return peak_rss_mb() if rss is None else rss
+
+
+def _escape(value) -> str:
+    """Escape a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    """Prometheus label set of a metric."""
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in sorted(labels.items())
+    )
+
+    return "{" + pairs + "}"
+
+
+class Metrics:
+    """Metrics of a run, exported as a Prometheus text file and JSON.
+
+    Stages record their wall time, rows in and out and the peak resident
+    memory of the process while they ran; repeated stages are accumulated.
+    The peak is the process high-water mark when it grew during the stage,
+    otherwise the highest resident memory sampled every
+    `RSS_SAMPLE_INTERVAL` seconds while the stage ran. The high-water mark
+    of the process is never reset, so `peak_rss_mb` stays valid for the
+    whole run. Counters and histograms are identified by name and labels.
+
+    Stage hooks are context managers entered around every stage, called with
+    the stage name, e.g. to attribute a profile to the stages.
+    """
+
+    def __init__(self):
+        self.stages: dict[str, dict] = {}
+        self.counters: dict[tuple, float] = {}
+        self.histograms: dict[tuple, dict] = {}
+        self.stage_hooks: list[Callable[[str], AbstractContextManager]] = []
+        self._lock = threading.Lock()
+        # records of the running stages, of every thread, by id
+        self._running: dict[int, dict] = {}
+        self._sampler: threading.Thread | None = None
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int | None = None) -> Iterator[dict]:
+        """Time a pipeline stage.
+
+        Parameters
+        ----------
+        name : str
+            The stage name.
+        rows_in : int, optional
+            Rows the stage reads.
+
+        Yields
+        ------
+        dict
+            The stage record, set its ``rows_out``.
+        """
+        # hooks are entered outside of the timed block, so their own work is
+        # not timed in the stage
+        with ExitStack() as hooks:
+            for hook in list(self.stage_hooks):
+                hooks.enter_context(hook(name))
+            with self._timed_stage(name, rows_in) as record:
+                yield record
+
+    @contextmanager
+    def _timed_stage(self, name: str, rows_in: int | None) -> Iterator[dict]:
+        record = {"rows_in": rows_in, "rows_out": None, "peak_rss_mb": 0.0}
+        peak_before = peak_rss_mb()
+        with self._lock:
+            self._running[id(record)] = record
+            self._add_rss(rss_mb())
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+                self._sampler.start()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            peak_after = peak_rss_mb()
+            with self._lock:
+                self._add_rss(rss_mb())
+                del self._running[id(record)]
+                if peak_after > peak_before:
+                    # the process peak was reached while the stage ran
+                    record["peak_rss_mb"] = peak_after
+            self._add_stage(name, seconds, record)
+
+    def _sample_rss(self):
+        """Sample the resident memory into the running stages, until none
+        runs."""
+        while True:
+            time.sleep(RSS_SAMPLE_INTERVAL)
+            rss = rss_mb()
+            with self._lock:
+                if not self._running:
+                    self._sampler = None
+                    return
+                self._add_rss(rss)
+
+    def _add_rss(self, rss: float):
+        """Add a resident memory reading to the running stages, the lock
+        held."""
+        for record in self._running.values():
+            record["peak_rss_mb"] = max(record["peak_rss_mb"], rss)
+
+    def _add_stage(self, name: str, seconds: float, record: dict):
+        with self._lock:
+            stage = self.stages.setdefault(
+                name,
+                {
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "rows_in": None,
+                    "rows_out": None,
+                    "peak_rss_mb": 0.0,
+                },
+            )
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            for rows in ["rows_in", "rows_out"]:
+                if record[rows] is not None:
+                    stage[rows] = (stage[rows] or 0) + int(record[rows])
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], record["peak_rss_mb"])
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        """Increase a counter.
+
+        Parameters
+        ----------
+        name : str
+            The counter name.
+        value : float
+            The increase.
+        **labels : str
+            The labels of the counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        **labels: str,
+    ):
+        """Add an observation to a histogram.
+
+        Parameters
+        ----------
+        name : str
+            The histogram name.
+        value : float
+            The observed value.
+        buckets : tuple[float, ...]
+            Upper bounds of the buckets, used when the histogram is created.
+        **labels : str
+            The labels of the histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.setdefault(
+                key,
+                {"buckets": list(buckets), "counts": [0] * len(buckets), "sum": 0.0},
+            )
+            for i, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+
+    def to_dict(self) -> dict:
+        """The metrics as a JSON serializable dict.
+
+        Returns
+        -------
+        dict
+            The stages, counters and histograms.
+        """
+        with self._lock:
+            return {
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "buckets": [
+                            "+Inf" if math.isinf(bound) else bound
+                            for bound in histogram["buckets"]
+                        ],
+                        "counts": list(histogram["counts"]),
+                        "count": histogram["counts"][-1],
+                        "sum": histogram["sum"],
+                    }
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+
+    def to_prometheus(self) -> str:
+        """The metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+        str
+            The metrics.
+        """
+        metrics = self.to_dict()
+        lines = []
+
+        stage_fields = {
+            "calls": "stage_calls",
+            "seconds": "stage_seconds",
+            "rows_in": "stage_rows_in",
+            "rows_out": "stage_rows_out",
+            "peak_rss_mb": "stage_peak_rss_mb",
+        }
+        for field, metric in stage_fields.items():
+            samples = [
+                (name, stage[field])
+                for name, stage in metrics["stages"].items()
+                if stage[field] is not None
+            ]
+            if not samples:
+                continue
+            lines.append(f"# TYPE {NAMESPACE}_{metric} gauge")
+            lines += [
+                f"{NAMESPACE}_{metric}{_labels({'stage': name})} {value}"
+                for name, value in samples
+            ]
+
+        typed = set()
+        for counter in metrics["counters"]:
+            name = f"{NAMESPACE}_{counter['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_labels(counter['labels'])} {counter['value']}")
+
+        for histogram in metrics["histograms"]:
+            name = f"{NAMESPACE}_{histogram['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                labels = _labels({**histogram["labels"], "le": bound})
+                lines.append(f"{name}_bucket{labels} {count}")
+            labels = _labels(histogram["labels"])
+            lines.append(f"{name}_sum{labels} {histogram['sum']}")
+            lines.append(f"{name}_count{labels} {histogram['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, directory: str | Path, name: str) -> list[Path]:
+        """Write the metrics to ``<name>.prom`` and ``<name>.json``.
+
+        Files are replaced atomically, so a Prometheus textfile collector
+        never reads a partial file.
+
+        Parameters
+        ----------
+        directory : str or Path
+            Directory of the metric files.
+        name : str
+            Name of the run, e.g. the command.
+
+        Returns
+        -------
+        list[Path]
+            The written files.
+        """
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        contents = {
+            "prom": self.to_prometheus(),
+            "json": json.dumps(
+                {"exported_at": time.time(), **self.to_dict()}, indent=2
+            ),
+        }
+        paths = []
+        for suffix, content in contents.items():
+            path = Path(directory, f"{name}.{suffix}")
+            tmp_file = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(content)
+            os.replace(tmp_file, path)
+            paths.append(path)
+
+        return paths
+
+    def clear(self):
+        """Remove every metric."""
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.histograms.clear()
+
+
+@lru_cache
+def get_metrics() -> Metrics:
+    """Gets the metrics of this process.
+
+    Returns
+    -------
+    Metrics
+        The metrics.
+    """
+    return Metrics()
+
+
+def stage(name: str, rows_in: int | None = None):
+    """Time a pipeline stage in the metrics of this process, see
+    `Metrics.stage`."""
+    return get_metrics().stage(name, rows_in=rows_in)
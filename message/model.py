@@ -1,5 +1,15 @@
+import asyncio
+import time
+from collections.abc import AsyncIterator, Iterator
+from contextlib import contextmanager
+from typing import Self
+
+import aiohttp
 import openai
+from message.cache import ResponseCache
 from message.config import get_settings
+from message.history import CHARS_PER_TOKEN, count_tokens
+from message.metrics import get_metrics
 
 
 class OpenAIKeys(str):
@@ -9,16 +19,224 @@ class OpenAIKeys(str):
 
 
 class ChatModel:
-    def __init__(self):
+    """Chat completions client.
+
+    The async API shares one pooled HTTP session across requests, keeping
+    connections alive between them, and caps the number of requests in
+    flight. Timeouts, the concurrency limit and the API base default to the
+    settings.
+
+    Completions are looked up in a persistent response cache first, keyed by
+    the model, parameters and messages; pass ``bypass_cache=True`` to a
+    request to always call the API (the fresh response is still cached).
+
+    The token counts of every request are recorded in `token_counts`: the
+    ones reported by the API when available, estimates otherwise. Request
+    counts by status, errors, latencies, queueing and tokens are also
+    recorded in the process metrics, see `message.metrics`.
+
+    Parameters
+    ----------
+    api_base : str, optional
+        Base URL of the API, e.g. a local server for tests.
+    timeout : float, optional
+        Total timeout of a request, in seconds.
+    connect_timeout : float, optional
+        Timeout to establish a connection, in seconds.
+    max_concurrency : int, optional
+        Maximum number of requests (and connections) in flight.
+    cache : ResponseCache, optional
+        The response cache, by default the one configured in the settings, if
+        enabled.
+    """
+
+    def __init__(
+        self,
+        api_base: str | None = None,
+        timeout: float | None = None,
+        connect_timeout: float | None = None,
+        max_concurrency: int | None = None,
+        cache: ResponseCache | None = None,
+    ):
         settings = get_settings()
         openai.api_key = settings.OPENAI_API_KEY
 
+        self.api_base = api_base or settings.OPENAI_API_BASE
+        self.timeout = timeout or settings.OPENAI_TIMEOUT
+        self.connect_timeout = connect_timeout or settings.OPENAI_CONNECT_TIMEOUT
+        self.max_concurrency = max_concurrency or settings.OPENAI_MAX_CONCURRENCY
+        if cache is None and settings.LLM_CACHE_ENABLED:
+            cache = ResponseCache(
+                settings.LLM_CACHE_DIR,
+                max_bytes=settings.LLM_CACHE_MAX_BYTES,
+                max_age=settings.LLM_CACHE_MAX_AGE,
+            )
+        self.cache = cache
+        self.token_counts: list[dict] = []
+        self.metrics = get_metrics()
+
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+
+    def _request_kwargs(self, kwargs: dict) -> dict:
+        """Add the client defaults to the parameters of a request."""
+        kwargs.setdefault("request_timeout", (self.connect_timeout, self.timeout))
+        if self.api_base:
+            kwargs.setdefault("api_base", self.api_base)
+
+        return kwargs
+
+    def _cache_lookup(self, kwargs: dict) -> tuple[str | None, str | None]:
+        """Look a request up in the response cache.
+
+        Parameters
+        ----------
+        kwargs : dict
+            The request parameters, ``bypass_cache`` is removed from them.
+
+        Returns
+        -------
+        tuple[str | None, str | None]
+            The cache key, None without a cache, and the cached response,
+            None on a miss or bypass.
+        """
+        bypass = kwargs.pop("bypass_cache", False)
+        if self.cache is None:
+            return None, None
+
+        key = self.cache.key(kwargs)
+        if bypass:
+            return key, None
+
+        response = self.cache.get(key)
+        if response is not None:
+            self.metrics.inc(
+                "llm_requests_total", model=kwargs.get("model", ""), status="cached"
+            )
+            self._record_tokens(kwargs, response, cached=True)
+
+        return key, response
+
+    def _record_tokens(
+        self, kwargs: dict, response: str, cached: bool, usage: dict | None = None
+    ):
+        """Record the token counts of a request."""
+        if usage is None:
+            usage = {
+                "prompt_tokens": count_tokens(kwargs.get("messages", [])),
+                "completion_tokens": len(response) // CHARS_PER_TOKEN,
+            }
+        self.token_counts.append(
+            {
+                "prompt_tokens": usage["prompt_tokens"],
+                "completion_tokens": usage["completion_tokens"],
+                "cached": cached,
+            }
+        )
+        labels = {"model": kwargs.get("model", ""), "cached": str(cached).lower()}
+        self.metrics.inc("llm_prompt_tokens_total", usage["prompt_tokens"], **labels)
+        self.metrics.inc(
+            "llm_completion_tokens_total", usage["completion_tokens"], **labels
+        )
+
+    @contextmanager
+    def _observe_request(self, kwargs: dict, stream: bool = False) -> Iterator[None]:
+        """Record the latency and outcome of a request sent to the API."""
+        labels = {"model": kwargs.get("model", ""), "stream": str(stream).lower()}
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except (asyncio.CancelledError, GeneratorExit):
+            status = "cancelled"
+            raise
+        except Exception as e:
+            status = "error"
+            self.metrics.inc("llm_errors_total", error=type(e).__name__, **labels)
+            raise
+        finally:
+            self.metrics.inc("llm_requests_total", status=status, **labels)
+            self.metrics.observe(
+                "llm_request_seconds", time.perf_counter() - start, **labels
+            )
+
+    async def _acquire_slot(self, kwargs: dict):
+        """Wait for a free concurrency slot, recording the wait."""
+        start = time.perf_counter()
+        await self._semaphore.acquire()
+        self.metrics.observe(
+            "llm_queue_seconds",
+            time.perf_counter() - start,
+            model=kwargs.get("model", ""),
+        )
+
+    def _completed(
+        self,
+        key: str | None,
+        kwargs: dict,
+        response: str,
+        usage: dict | None = None,
+    ):
+        """Record a completed request and store its response in the cache."""
+        self._record_tokens(kwargs, response, cached=False, usage=usage)
+        if key is not None:
+            self.cache.set(key, response, params=kwargs)
+
+    async def _acompleted(
+        self,
+        key: str | None,
+        kwargs: dict,
+        response: str,
+        usage: dict | None = None,
+    ):
+        """Record a completed request and store its response in the cache,
+        writing it, and evicting, in a thread."""
+        self._record_tokens(kwargs, response, cached=False, usage=usage)
+        if key is not None:
+            await asyncio.to_thread(self.cache.set, key, response, params=kwargs)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """The pooled session of the running event loop.
+
+        Sessions and semaphores are bound to an event loop, so they are
+        created again when the client is used from a new loop.
+
+        Returns
+        -------
+        aiohttp.ClientSession
+            The HTTP session.
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency)
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+
+        return self._session
+
+    def get_cached_completion(self, **kwargs) -> str | None:
+        """Looks a chat completion up in the response cache.
+
+        Returns
+        -------
+        str or None
+            The cached chat completion response, None on a miss or without a
+            cache.
+        """
+        return self._cache_lookup(kwargs)[1]
+
     def get_completion(
         self,
         **kwargs,
     ) -> str:
         """Creates a new chat completion for the provided messages and parameters.
 
+        Blocks until the completion is done, use `aget_completion` from async
+        code.
+
         See https://platform.openai.com/docs/api-reference/chat/create
         for a list of valid parameters.
 
@@ -28,6 +246,127 @@ class ChatModel:
             The chat completion response.
         """
 
-        chat_completion = openai.ChatCompletion.create(**kwargs)
+        key, response = self._cache_lookup(kwargs)
+        if response is not None:
+            return response
+
+        with self._observe_request(kwargs):
+            chat_completion = openai.ChatCompletion.create(
+                **self._request_kwargs(dict(kwargs))
+            )
+        response = chat_completion.choices[0].message[OpenAIKeys.CONTENT]
+        self._completed(key, kwargs, response, usage=chat_completion.get("usage"))
+
+        return response
+
+    async def aget_completion(
+        self,
+        **kwargs,
+    ) -> str:
+        """Creates a new chat completion without blocking the event loop.
+
+        Requests wait for a free slot once `max_concurrency` are in flight.
+
+        See https://platform.openai.com/docs/api-reference/chat/create
+        for a list of valid parameters.
+
+        Returns
+        -------
+        str
+            The chat completion response.
+        """
+        key, response = self._cache_lookup(kwargs)
+        if response is not None:
+            return response
+
+        session = self._get_session()
+        await self._acquire_slot(kwargs)
+        try:
+            # openai picks the session up from this context variable
+            token = openai.aiosession.set(session)
+            try:
+                with self._observe_request(kwargs):
+                    chat_completion = await openai.ChatCompletion.acreate(
+                        **self._request_kwargs(dict(kwargs))
+                    )
+            finally:
+                openai.aiosession.reset(token)
+        finally:
+            self._semaphore.release()
+
+        response = chat_completion.choices[0].message[OpenAIKeys.CONTENT]
+        await self._acompleted(
+            key, kwargs, response, usage=chat_completion.get("usage")
+        )
+
+        return response
+
+    async def astream_completion(
+        self,
+        **kwargs,
+    ) -> AsyncIterator[str]:
+        """Streams a new chat completion, token by token.
+
+        The request holds its concurrency slot until the stream is exhausted
+        or closed; closing the generator stops the generation. A cached
+        response is yielded whole, and only complete streams are cached.
+
+        See https://platform.openai.com/docs/api-reference/chat/create
+        for a list of valid parameters.
+
+        Yields
+        ------
+        str
+            The content of each chunk of the completion, in order.
+        """
+        key, response = self._cache_lookup(kwargs)
+        if response is not None:
+            yield response
+            return
+
+        session = self._get_session()
+        tokens = []
+        await self._acquire_slot(kwargs)
+        try:
+            with self._observe_request(kwargs, stream=True):
+                start = time.perf_counter()
+                # the session is only looked up when the request is sent
+                token = openai.aiosession.set(session)
+                try:
+                    chunks = await openai.ChatCompletion.acreate(
+                        stream=True, **self._request_kwargs(dict(kwargs))
+                    )
+                finally:
+                    openai.aiosession.reset(token)
+
+                try:
+                    async for chunk in chunks:
+                        content = chunk.choices[0].delta.get(OpenAIKeys.CONTENT)
+                        if content:
+                            if not tokens:
+                                self.metrics.observe(
+                                    "llm_first_token_seconds",
+                                    time.perf_counter() - start,
+                                    model=kwargs.get("model", ""),
+                                )
+                            tokens.append(content)
+                            yield content
+                finally:
+                    await chunks.aclose()
+        finally:
+            self._semaphore.release()
+
+        # streamed responses do not report their usage
+        await self._acompleted(key, kwargs, "".join(tokens))
+
+    async def aclose(self):
+        """Close the HTTP session and its connections."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self) -> Self:
+        return self
 
-        return chat_completion.choices[0].message[OpenAIKeys.CONTENT]
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
@@ -0,0 +1,333 @@
+"""CPU and memory profiles of a command, attributed to the pipeline stages."""
+
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from message.metrics import Metrics, get_metrics
+
+# seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+# frames kept by tracemalloc for each allocation
+TRACEMALLOC_FRAMES = 1
+# functions and allocation sites listed in the summary
+TOP = 20
+# collapsed stack frame prefix of the pipeline stages
+STAGE_PREFIX = "stage:"
+
+
+def _frame_label(code) -> str:
+    """Collapsed stack label of a code object."""
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+def _function_label(function: tuple[str, int, str]) -> str:
+    """Label of a `pstats` function key."""
+    filename, line, name = function
+    if filename == "~":
+        # built-in functions
+        return name
+
+    return f"{name} ({Path(filename).name}:{line})"
+
+
+class Profiler:
+    """Profiles the thread that starts it, until it is stopped.
+
+    Three profiles are taken at once:
+
+    - cProfile, for exact call counts and cumulative times per function
+    - stack samples every `SAMPLE_INTERVAL` seconds, written as collapsed
+      stacks for flamegraph tools, rooted at the stages they were taken in
+    - tracemalloc, for the peak traced memory and the allocation sites that
+      grew the most during each stage
+
+    Stages are the ones timed with `Metrics.stage`. The profilers slow the
+    command down, tracemalloc the most, so compare profiled runs between
+    themselves rather than with the metrics of unprofiled runs. The time
+    spent taking and comparing the tracemalloc snapshots of the stages is not
+    sampled, and it is subtracted from the stage times of the summary. Worker
+    processes are not profiled.
+
+    Parameters
+    ----------
+    metrics : Metrics, optional
+        The metrics whose stages are profiled, those of this process by
+        default.
+    interval : float
+        Seconds between stack samples.
+    """
+
+    def __init__(
+        self, metrics: Metrics | None = None, interval: float = SAMPLE_INTERVAL
+    ):
+        self.metrics = metrics or get_metrics()
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+        self.stages: dict[str, dict] = {}
+        self._profile = cProfile.Profile()
+        self._stack: list[dict] = []
+        self._thread_id: int | None = None
+        self._stop = threading.Event()
+        self._sampler: threading.Thread | None = None
+        self._started_at = 0.0
+        # bytes, peak traced memory before the last reset
+        self._peak = 0
+        # whether the stack samples are paused, while taking snapshots
+        self._paused = False
+        self.seconds = 0.0
+        # seconds spent taking and comparing snapshots
+        self.overhead_seconds = 0.0
+        self.peak_traced_mb = 0.0
+
+    def start(self):
+        """Start profiling the current thread."""
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.metrics.stage_hooks.append(self._stage)
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self._started_at = time.perf_counter()
+        self._profile.enable()
+
+    def stop(self):
+        """Stop profiling."""
+        self._profile.disable()
+        self.seconds = time.perf_counter() - self._started_at
+        self._stop.set()
+        self._sampler.join()
+        self.metrics.stage_hooks.remove(self._stage)
+        peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+        self.peak_traced_mb = peak / 1024**2
+        tracemalloc.stop()
+
+    @contextmanager
+    def _overhead(self) -> Iterator[None]:
+        """Pause the stack samples, adding the time of the block to the
+        overhead of the run and of the enclosing stages."""
+        self._paused = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._paused = False
+            self.overhead_seconds += seconds
+            for entry in self._stack:
+                entry["overhead"] += seconds
+
+    @contextmanager
+    def _stage(self, name: str) -> Iterator[None]:
+        """Stage hook measuring the traced memory of the stage."""
+        if threading.get_ident() != self._thread_id:
+            yield
+            return
+
+        # the run and the enclosing stage keep their peak from before the reset
+        peak = tracemalloc.get_traced_memory()[1]
+        self._peak = max(self._peak, peak)
+        if self._stack:
+            self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+        entry = {"name": name, "peak": 0, "overhead": 0.0}
+        with self._overhead():
+            before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        self._stack.append(entry)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            entry["peak"] = max(entry["peak"], tracemalloc.get_traced_memory()[1])
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], entry["peak"])
+            with self._overhead():
+                growth = tracemalloc.take_snapshot().compare_to(before, "lineno")
+                self._add_stage(name, entry, growth)
+
+    def _add_stage(
+        self, name: str, entry: dict, growth: list[tracemalloc.StatisticDiff]
+    ):
+        stage = self.stages.setdefault(
+            name, {"peak_traced_mb": 0.0, "overhead_seconds": 0.0, "allocations": {}}
+        )
+        stage["peak_traced_mb"] = max(stage["peak_traced_mb"], entry["peak"] / 1024**2)
+        stage["overhead_seconds"] += entry["overhead"]
+        for statistic in growth:
+            if statistic.size_diff <= 0:
+                continue
+            frame = statistic.traceback[0]
+            location = f"{frame.filename}:{frame.lineno}"
+            allocation = stage["allocations"].setdefault(
+                location, {"location": location, "size_mb": 0.0, "count": 0}
+            )
+            allocation["size_mb"] += statistic.size_diff / 1024**2
+            allocation["count"] += statistic.count_diff
+
+    def _sample(self):
+        """Sample the stack of the profiled thread until stopped."""
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None or self._paused:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            stages = [f"{STAGE_PREFIX}{entry['name']}" for entry in list(self._stack)]
+            self.samples[";".join(stages + labels[::-1])] += 1
+
+    def stage_samples(self) -> dict[str, int]:
+        """Count the stack samples taken in each stage, nested ones included.
+
+        Returns
+        -------
+        dict[str, int]
+            Samples per stage.
+        """
+        counts = Counter()
+        for stack, count in self.samples.items():
+            stages = {
+                label.removeprefix(STAGE_PREFIX)
+                for label in stack.split(";")
+                if label.startswith(STAGE_PREFIX)
+            }
+            for stage in stages:
+                counts[stage] += count
+
+        return dict(counts)
+
+    def summary(self) -> dict:
+        """Summarize the profiles.
+
+        Returns
+        -------
+        dict
+            Wall time, samples and peak traced memory of the run, the
+            functions with the highest cumulative time and, per stage, its
+            time without the snapshot overhead, share of the samples, peak
+            traced memory and the allocation sites that grew the most.
+        """
+        stats = pstats.Stats(self._profile)
+        functions = sorted(
+            stats.stats.items(), key=lambda item: item[1][3], reverse=True
+        )
+        total_samples = sum(self.samples.values())
+        stage_samples = self.stage_samples()
+        stage_metrics = self.metrics.to_dict()["stages"]
+
+        stages = {}
+        for name in dict.fromkeys([*stage_metrics, *self.stages]):
+            profile = self.stages.get(
+                name,
+                {"peak_traced_mb": 0.0, "overhead_seconds": 0.0, "allocations": {}},
+            )
+            seconds = stage_metrics.get(name, {}).get("seconds")
+            allocations = sorted(
+                profile["allocations"].values(),
+                key=lambda allocation: allocation["size_mb"],
+                reverse=True,
+            )
+            samples = stage_samples.get(name, 0)
+            stages[name] = {
+                "seconds": (
+                    None
+                    if seconds is None
+                    else max(seconds - profile["overhead_seconds"], 0.0)
+                ),
+                "samples": samples,
+                "sample_share": samples / total_samples if total_samples else 0.0,
+                "peak_traced_mb": profile["peak_traced_mb"],
+                "allocations": allocations[:TOP],
+            }
+
+        return {
+            "seconds": self.seconds - self.overhead_seconds,
+            "overhead_seconds": self.overhead_seconds,
+            "samples": total_samples,
+            "sample_interval": self.interval,
+            "peak_traced_mb": self.peak_traced_mb,
+            "functions": [
+                {
+                    "function": _function_label(function),
+                    "calls": calls,
+                    "self_seconds": self_seconds,
+                    "cumulative_seconds": cumulative_seconds,
+                }
+                for function, (_, calls, self_seconds, cumulative_seconds, _) in (
+                    functions[:TOP]
+                )
+            ],
+            "stages": stages,
+        }
+
+    def write(self, directory: str | Path, name: str) -> list[Path]:
+        """Write the profiles and their summary.
+
+        - ``<name>.prof``: the cProfile stats, for `pstats` or snakeviz
+        - ``<name>.collapsed``: the stack samples, for flamegraph.pl or
+          speedscope
+        - ``<name>.profile.json``: the summary, see `summary`
+
+        Parameters
+        ----------
+        directory : str or Path
+            Directory of the profile files.
+        name : str
+            Name of the run, e.g. the command.
+
+        Returns
+        -------
+        list[Path]
+            The written files.
+        """
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        prof_file = Path(directory, f"{name}.prof")
+        self._profile.dump_stats(prof_file)
+
+        collapsed_file = Path(directory, f"{name}.collapsed")
+        with open(collapsed_file, "w") as f:
+            f.writelines(
+                f"{stack} {count}\n" for stack, count in sorted(self.samples.items())
+            )
+
+        summary_file = Path(directory, f"{name}.profile.json")
+        with open(summary_file, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+        return [prof_file, collapsed_file, summary_file]
+
+
+@contextmanager
+def profiled(directory: str | Path, name: str) -> Iterator[Profiler]:
+    """Profile a block and write the profiles when it ends, also when it
+    fails.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Directory of the profile files.
+    name : str
+        Name of the run, e.g. the command.
+
+    Yields
+    ------
+    Profiler
+        The profiler.
+    """
+    profiler = Profiler()
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        for path in profiler.write(directory, name):
+            print(f"[INFO] Profile written to {path}")
@@ -0,0 +1,131 @@
+"""Compact rendering of the session features for the prompts."""
+
+import math
+
+import pandas as pd
+
+from message.history import CHARS_PER_TOKEN
+from message.transform import FEATURE_COLUMNS
+
+# opaque ids, of no use to write the message
+HIDDEN_COLUMNS = {"patient_id", "session_group"}
+# flag columns rendered as one line listing the set flags, by prefix
+FLAG_GROUPS = {
+    "quality_reason_": "quality_reasons",
+    "leave_exercise_": "leave_exercise",
+}
+# decimals of the float features
+FLOAT_DECIMALS = 2
+
+
+def _format_value(value) -> str | None:
+    """Format a feature value, None if it is missing."""
+    # numpy scalars
+    if hasattr(value, "item"):
+        value = value.item()
+    if value is None or value is pd.NA:
+        return None
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        return f"{round(value, FLOAT_DECIMALS):g}"
+
+    return str(value)
+
+
+def _flag_group(column: str) -> tuple[str, str] | None:
+    """The flag group and flag name of a column, None if it is not a flag."""
+    for prefix, group in FLAG_GROUPS.items():
+        if column.startswith(prefix):
+            return group, column.removeprefix(prefix)
+
+    return None
+
+
+def render_session(features: dict) -> str:
+    """Render the features of a session as ``name: value`` lines.
+
+    Features are in the `FEATURE_COLUMNS` order, then the others sorted, so
+    equal features always render the same. Ids and missing values are
+    dropped, floats are rounded, and each flag group is one line listing the
+    flags that are set, with their count if over one, or dropped if none is.
+
+    Parameters
+    ----------
+    features : dict
+        The features of the session.
+
+    Returns
+    -------
+    str
+        The rendered features.
+    """
+    columns = [column for column in FEATURE_COLUMNS if column in features]
+    columns += sorted(set(features) - set(FEATURE_COLUMNS))
+
+    lines = {}
+    for column in columns:
+        if column in HIDDEN_COLUMNS:
+            continue
+        value = _format_value(features[column])
+        flag = _flag_group(column)
+        if flag is None:
+            if value is not None:
+                lines[column] = value
+            continue
+
+        group, name = flag
+        flags = lines.setdefault(group, [])
+        if value is not None and float(value) > 0:
+            flags.append(name if float(value) == 1 else f"{name} {value}")
+
+    return "\n".join(
+        f"{name}: {', '.join(value) if isinstance(value, list) else value}"
+        for name, value in lines.items()
+        if value
+    )
+
+
+def render_features(features: list[dict]) -> str:
+    """Render the features of a session group for the prompt.
+
+    Parameters
+    ----------
+    features : list[dict]
+        The features of each session of the group.
+
+    Returns
+    -------
+    str
+        The rendered features, sessions separated by a blank line.
+    """
+    return "\n\n".join(render_session(session) for session in features)
+
+
+def rendering_savings(features: list[list[dict]]) -> dict:
+    """Compare the estimated tokens of the compact and ``repr`` renderings.
+
+    Parameters
+    ----------
+    features : list[list[dict]]
+        The features of several session groups.
+
+    Returns
+    -------
+    dict
+        Estimated tokens of each rendering over all the session groups, and
+        the share of tokens saved.
+    """
+    repr_tokens = sum(len(repr(group)) // CHARS_PER_TOKEN for group in features)
+    compact_tokens = sum(
+        len(render_features(group)) // CHARS_PER_TOKEN for group in features
+    )
+
+    return {
+        "session_groups": len(features),
+        "repr_tokens": repr_tokens,
+        "compact_tokens": compact_tokens,
+        "saved": 1 - compact_tokens / repr_tokens if repr_tokens else 0.0,
+    }
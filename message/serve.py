@@ -0,0 +1,400 @@
+"""HTTP service to draft and review messages."""
+
+import asyncio
+import json
+import time
+from uuid import uuid4
+
+import openai
+from aiohttp import web
+
+from message.chat import (
+    ACCEPTANCE_OPTIONS,
+    FeedbackOption,
+    feedback_messages,
+    finish_chat,
+    llm,
+    system_message,
+)
+from message.config import get_settings
+from message.data import get_features, get_session_groups
+from message.io import ChatJournal
+from message.model import ChatModel
+from message.store import ChatStore
+
+# seconds between looks for idle chats, at most
+IDLE_CHECK_INTERVAL = 60.0
+
+
+def _error(status: type[web.HTTPError], message: str) -> web.HTTPError:
+    """An HTTP error with a JSON body."""
+    return status(text=json.dumps({"error": message}), content_type="application/json")
+
+
+class ReviewChat:
+    """A chat whose draft is under review.
+
+    Parameters
+    ----------
+    chat_id : str
+        The chat id.
+    session_group : str
+        The session group of the chat.
+    journal : ChatJournal
+        The journal of the chat.
+    """
+
+    def __init__(self, chat_id: str, session_group: str, journal: ChatJournal):
+        self.chat_id = chat_id
+        self.session_group = session_group
+        self.journal = journal
+        self.chat_history: list[dict[str, str]] = []
+        self.draft: str | None = None
+        # actions on a chat are applied one at a time
+        self.lock = asyncio.Lock()
+        self.last_active = time.monotonic()
+
+    def add_messages(self, *messages: dict[str, str]):
+        """Add messages to the chat history and its journal."""
+        self.last_active = time.monotonic()
+        self.chat_history.extend(messages)
+        for message in messages:
+            self.journal.append(message)
+
+    def to_dict(self) -> dict:
+        return {
+            "chat_id": self.chat_id,
+            "session_group": self.session_group,
+            "status": "review",
+            "outcome": None,
+            "draft": self.draft,
+            "messages": self.chat_history,
+        }
+
+
+class ReviewService:
+    """Drafts messages and applies the reviewer's actions, for many chats at
+    once.
+
+    The prompts and the feature index stay loaded, and all chats share one
+    chat model and its connection pool. Chats under review are kept in
+    memory and journaled like in `run_chat`; finished chats are moved to the
+    chat store. Chats idle for longer than the idle timeout are no longer
+    reviewed here, see `evict_idle`.
+
+    Parameters
+    ----------
+    chat_model : ChatModel, optional
+        The chat model, by default one configured from the settings.
+    store : ChatStore, optional
+        The chat store, by default the one configured in the settings.
+    cache : bool
+        Whether to look drafts up in the LLM response cache.
+    idle_timeout : float, optional
+        Seconds a chat under review can stay idle, by default
+        ``SERVE_CHAT_IDLE_TIMEOUT``.
+    """
+
+    def __init__(
+        self,
+        chat_model: ChatModel | None = None,
+        store: ChatStore | None = None,
+        cache: bool = True,
+        idle_timeout: float | None = None,
+    ):
+        settings = get_settings()
+        self._owns_model = chat_model is None
+        self.chat_model = chat_model or ChatModel()
+        self.store = store or ChatStore(settings.CHAT_STORE_PATH)
+        self.cache = cache
+        self.idle_timeout = (
+            settings.SERVE_CHAT_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        )
+        self.chats: dict[str, ReviewChat] = {}
+
+    async def _draft(self, messages: list[dict[str, str]]) -> str:
+        try:
+            return await llm(
+                messages, bypass_cache=not self.cache, model=self.chat_model
+            )
+        except openai.error.OpenAIError as e:
+            raise _error(web.HTTPBadGateway, f"draft failed: {e}") from e
+
+    async def start_chat(self, session_group: str) -> ReviewChat:
+        """Start a chat and draft its first message.
+
+        Parameters
+        ----------
+        session_group : str
+            The session group.
+
+        Returns
+        -------
+        ReviewChat
+            The chat.
+        """
+        features = await asyncio.to_thread(get_features, session_group=session_group)
+        if not features:
+            raise _error(web.HTTPNotFound, f"unknown session group: {session_group}")
+
+        messages = [system_message(features)]
+        draft = await self._draft(messages)
+
+        settings = get_settings()
+        chat_id = str(uuid4())
+        chat = ReviewChat(
+            chat_id,
+            session_group,
+            ChatJournal(
+                chat_id,
+                fsync=settings.CHAT_JOURNAL_FSYNC,
+                fsync_interval=settings.CHAT_JOURNAL_FSYNC_INTERVAL,
+            ),
+        )
+        chat.add_messages(*messages)
+        chat.draft = draft
+        self.chats[chat_id] = chat
+
+        return chat
+
+    async def act(
+        self,
+        chat_id: str,
+        action: str,
+        category: str | None = None,
+        feedback: str = "",
+        message: str = "",
+    ) -> dict:
+        """Apply the reviewer's action to the draft of a chat.
+
+        Parameters
+        ----------
+        chat_id : str
+            The chat id.
+        action : str
+            "accept" the draft, "edit" it with feedback, which drafts a
+            revision, or "reject" it for the reviewer's own message.
+        category : str, optional
+            The feedback category of an edit, "other" by default.
+        feedback : str
+            The feedback of an edit, optional.
+        message : str
+            The reviewer's message replacing a rejected draft.
+
+        Returns
+        -------
+        dict
+            The chat.
+        """
+        if action not in ACCEPTANCE_OPTIONS:
+            raise _error(
+                web.HTTPBadRequest, f"action must be one of {ACCEPTANCE_OPTIONS}"
+            )
+        if action == "edit":
+            try:
+                category = FeedbackOption(category or FeedbackOption.OTHER)
+            except ValueError as e:
+                raise _error(web.HTTPBadRequest, str(e)) from e
+        if action == "reject" and not message.strip():
+            raise _error(web.HTTPBadRequest, "a rejected draft needs a message")
+
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            raise _error(web.HTTPNotFound, f"no chat under review: {chat_id}")
+
+        async with chat.lock:
+            if self.chats.get(chat_id) is not chat:
+                raise _error(web.HTTPConflict, f"chat already finished: {chat_id}")
+
+            if action == "edit":
+                messages = feedback_messages(category, feedback.strip())
+                # the feedback is only kept once the revision is drafted
+                draft = await self._draft(chat.chat_history + messages)
+                chat.add_messages(*messages)
+                chat.draft = draft
+                return chat.to_dict()
+
+            content = chat.draft if action == "accept" else message
+            chat.add_messages({"role": "assistant", "content": content})
+            await finish_chat(
+                chat.journal,
+                self.store,
+                chat_id,
+                chat.session_group,
+                chat.chat_history,
+                action,
+            )
+            del self.chats[chat_id]
+
+        return {
+            **chat.to_dict(),
+            "status": "finished",
+            "outcome": action,
+            "draft": None,
+        }
+
+    async def get_chat(self, chat_id: str) -> dict:
+        """Get a chat under review or finished.
+
+        Parameters
+        ----------
+        chat_id : str
+            The chat id.
+
+        Returns
+        -------
+        dict
+            The chat.
+        """
+        chat = self.chats.get(chat_id)
+        if chat is not None:
+            chat.last_active = time.monotonic()
+            return chat.to_dict()
+
+        stored = await asyncio.to_thread(self.store.get_chat, chat_id)
+        if stored is None:
+            raise _error(web.HTTPNotFound, f"unknown chat: {chat_id}")
+
+        return {
+            "chat_id": chat_id,
+            "session_group": stored["session_group"],
+            "status": "finished",
+            "outcome": stored["outcome"],
+            "draft": None,
+            "messages": await asyncio.to_thread(self.store.get_messages, chat_id),
+        }
+
+    async def evict_idle(self) -> list[str]:
+        """Close the journals of the chats idle for longer than the idle
+        timeout and stop reviewing them. They stay resumable with
+        `get-message --chat-id`.
+
+        Returns
+        -------
+        list[str]
+            The ids of the evicted chats.
+        """
+        now = time.monotonic()
+        evicted = []
+        for chat_id, chat in list(self.chats.items()):
+            # chats with an action in progress are not idle
+            if chat.lock.locked() or now - chat.last_active < self.idle_timeout:
+                continue
+            async with chat.lock:
+                if self.chats.get(chat_id) is not chat:
+                    continue
+                del self.chats[chat_id]
+                await chat.journal.close()
+            evicted.append(chat_id)
+
+        return evicted
+
+    async def evict_idle_periodically(self):
+        """Evict the idle chats until cancelled, see `evict_idle`."""
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, IDLE_CHECK_INTERVAL))
+            evicted = await self.evict_idle()
+            if evicted:
+                print(f"[INFO] Closed {len(evicted)} idle chats")
+
+    async def close(self):
+        """Close the journals of the chats under review, which stay resumable
+        with `get-message --chat-id`, and the chat model."""
+        await asyncio.gather(*[chat.journal.close() for chat in self.chats.values()])
+        self.chats.clear()
+        if self._owns_model:
+            await self.chat_model.aclose()
+
+    # request handlers
+
+    async def _json(self, request: web.Request) -> dict:
+        try:
+            body = await request.json()
+        except ValueError as e:
+            raise _error(web.HTTPBadRequest, "invalid JSON body") from e
+        if not isinstance(body, dict):
+            raise _error(web.HTTPBadRequest, "the JSON body must be an object")
+
+        return body
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "chats": len(self.chats)})
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.chat_model.metrics.to_prometheus(),
+            content_type="text/plain",
+        )
+
+    async def handle_start(self, request: web.Request) -> web.Response:
+        body = await self._json(request)
+        session_group = body.get("session_group")
+        if not isinstance(session_group, str):
+            raise _error(web.HTTPBadRequest, "session_group is required")
+
+        chat = await self.start_chat(session_group)
+
+        return web.json_response(chat.to_dict(), status=201)
+
+    async def handle_action(self, request: web.Request) -> web.Response:
+        body = await self._json(request)
+        chat = await self.act(
+            request.match_info["chat_id"],
+            str(body.get("action", "")).strip().lower(),
+            category=body.get("category"),
+            feedback=str(body.get("feedback") or ""),
+            message=str(body.get("message") or ""),
+        )
+
+        return web.json_response(chat)
+
+    async def handle_get(self, request: web.Request) -> web.Response:
+        return web.json_response(await self.get_chat(request.match_info["chat_id"]))
+
+
+def create_app(service: ReviewService | None = None) -> web.Application:
+    """Create the review web application.
+
+    Routes:
+
+    - ``GET /health``
+    - ``GET /metrics``: the process metrics in the Prometheus text format
+    - ``POST /chats`` ``{"session_group"}``: start a chat and draft a message
+    - ``GET /chats/{chat_id}``: the chat, its draft and history
+    - ``POST /chats/{chat_id}/actions`` ``{"action", "category", "feedback",
+      "message"}``: accept, edit or reject the draft
+
+    Parameters
+    ----------
+    service : ReviewService, optional
+        The review service, by default one configured from the settings.
+
+    Returns
+    -------
+    web.Application
+        The application.
+    """
+    service = service or ReviewService()
+    app = web.Application()
+    tasks = []
+
+    async def startup(app: web.Application):
+        # load the feature index before the first request
+        await asyncio.to_thread(get_session_groups)
+        tasks.append(asyncio.create_task(service.evict_idle_periodically()))
+
+    async def cleanup(app: web.Application):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await service.close()
+
+    app.on_startup.append(startup)
+    app.on_cleanup.append(cleanup)
+    app.router.add_get("/health", service.handle_health)
+    app.router.add_get("/metrics", service.handle_metrics)
+    app.router.add_post("/chats", service.handle_start)
+    app.router.add_get("/chats/{chat_id}", service.handle_get)
+    app.router.add_post("/chats/{chat_id}/actions", service.handle_action)
+
+    return app
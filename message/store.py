@@ -0,0 +1,334 @@
+"""Consolidated chat store."""
+
+import sqlite3
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from message.io import load_chat_history
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    session_group TEXT,
+    outcome TEXT,
+    n_messages INTEGER NOT NULL,
+    n_edits INTEGER NOT NULL,
+    finished_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (chat_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS feedback (
+    chat_id TEXT NOT NULL,
+    round INTEGER NOT NULL,
+    category TEXT,
+    feedback TEXT,
+    PRIMARY KEY (chat_id, round)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chats_session_group ON chats (session_group);
+CREATE INDEX IF NOT EXISTS chats_outcome ON chats (outcome);
+CREATE INDEX IF NOT EXISTS feedback_category ON feedback (category, chat_id);
+"""
+CHAT_COLUMNS = [
+    "chat_id",
+    "session_group",
+    "outcome",
+    "n_messages",
+    "n_edits",
+    "finished_at",
+]
+
+
+class ChatStore:
+    """Finished chats in one SQLite database, indexed for analysis.
+
+    Chats are indexed by chat id, session_group, outcome ("accept" or
+    "reject", None if unknown) and the feedback category of each edit round.
+    The database is in WAL mode, so reads do not block the chats being saved.
+
+    Parameters
+    ----------
+    path : str or Path
+        The database file.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """A connection committing on success, so the store can be used from
+        several threads."""
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def save_chat(
+        self,
+        chat_id: str,
+        session_group: str | None,
+        messages: list[dict[str, str]],
+        outcome: str | None,
+        feedback_rounds: list[tuple[str | None, str]],
+        finished_at: float | None = None,
+    ):
+        """Save a chat, replacing any previous version of it.
+
+        Parameters
+        ----------
+        chat_id : str
+            The chat id.
+        session_group : str, optional
+            The session group of the chat.
+        messages : list[dict[str, str]]
+            The chat history.
+        outcome : str, optional
+            How the chat ended, "accept" or "reject".
+        feedback_rounds : list[tuple[str | None, str]]
+            Feedback category and text of each edit round.
+        finished_at : float, optional
+            Unix time the chat finished at, now by default.
+        """
+        with self._connect() as connection:
+            connection.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+            connection.execute("DELETE FROM feedback WHERE chat_id = ?", (chat_id,))
+            connection.execute(
+                "INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    chat_id,
+                    session_group,
+                    outcome,
+                    len(messages),
+                    len(feedback_rounds),
+                    finished_at if finished_at is not None else time.time(),
+                ),
+            )
+            connection.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?)",
+                [
+                    (chat_id, position, message["role"], message["content"])
+                    for position, message in enumerate(messages)
+                ],
+            )
+            connection.executemany(
+                "INSERT INTO feedback VALUES (?, ?, ?, ?)",
+                [
+                    (chat_id, i, category, feedback)
+                    for i, (category, feedback) in enumerate(feedback_rounds)
+                ],
+            )
+
+    def get_chat(self, chat_id: str) -> dict | None:
+        """Get the summary of a chat.
+
+        Parameters
+        ----------
+        chat_id : str
+            The chat id.
+
+        Returns
+        -------
+        dict or None
+            The chat, with the columns of `CHAT_COLUMNS`, None if it is not in
+            the store.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                f"SELECT {', '.join(CHAT_COLUMNS)} FROM chats WHERE chat_id = ?",
+                (chat_id,),
+            ).fetchone()
+
+        return dict(row) if row is not None else None
+
+    def get_messages(self, chat_id: str) -> list[dict[str, str]] | None:
+        """Get the history of a chat.
+
+        Parameters
+        ----------
+        chat_id : str
+            The chat id.
+
+        Returns
+        -------
+        list[dict[str, str]] or None
+            The chat history, None if the chat is not in the store.
+        """
+        with self._connect() as connection:
+            if not connection.execute(
+                "SELECT 1 FROM chats WHERE chat_id = ?", (chat_id,)
+            ).fetchone():
+                return None
+            rows = connection.execute(
+                "SELECT role, content FROM messages WHERE chat_id = ? ORDER BY position",
+                (chat_id,),
+            ).fetchall()
+
+        return [{"role": row["role"], "content": row["content"]} for row in rows]
+
+    def find_chats(
+        self,
+        session_group: str | None = None,
+        outcome: str | None = None,
+        category: str | None = None,
+    ) -> list[dict]:
+        """Find chats by session group, outcome and feedback category.
+
+        Parameters
+        ----------
+        session_group : str, optional
+            Only chats of this session group.
+        outcome : str, optional
+            Only chats with this outcome.
+        category : str, optional
+            Only chats with an edit round of this feedback category.
+
+        Returns
+        -------
+        list[dict]
+            The chats, oldest first, with the columns of `CHAT_COLUMNS`.
+        """
+        conditions, params = [], []
+        if session_group is not None:
+            conditions.append("session_group = ?")
+            params.append(session_group)
+        if outcome is not None:
+            conditions.append("outcome = ?")
+            params.append(outcome)
+        if category is not None:
+            conditions.append(
+                "chat_id IN (SELECT chat_id FROM feedback WHERE category = ?)"
+            )
+            params.append(category)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"SELECT {', '.join(CHAT_COLUMNS)} FROM chats {where} "
+                "ORDER BY finished_at, chat_id",
+                params,
+            ).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def feedback_stats(self) -> list[dict]:
+        """Count the edit rounds of each feedback category.
+
+        Returns
+        -------
+        list[dict]
+            Per category, the number of edit rounds, of chats and the share of
+            those chats that ended rejected.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                """
+                SELECT
+                    feedback.category,
+                    COUNT(*) AS rounds,
+                    COUNT(DISTINCT feedback.chat_id) AS chats,
+                    AVG(chats.outcome = 'reject') AS reject_rate
+                FROM feedback JOIN chats USING (chat_id)
+                GROUP BY feedback.category
+                ORDER BY rounds DESC, feedback.category
+                """
+            ).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def export_parquet(self, output_dir: str | Path) -> list[Path]:
+        """Export the store to parquet, one file per table.
+
+        Parameters
+        ----------
+        output_dir : str or Path
+            Directory the chats, messages and feedback files are written to.
+
+        Returns
+        -------
+        list[Path]
+            The written files.
+        """
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        paths = []
+        with self._connect() as connection:
+            for table in ["chats", "messages", "feedback"]:
+                cursor = connection.execute(f"SELECT * FROM {table}")
+                columns = [column[0] for column in cursor.description]
+                rows = cursor.fetchall()
+                data = pa.table(
+                    {
+                        column: [row[i] for row in rows]
+                        for i, column in enumerate(columns)
+                    }
+                )
+                path = Path(output_dir, f"{table}.parquet")
+                pq.write_table(data, path)
+                paths.append(path)
+
+        return paths
+
+
+def import_chat_files(
+    store: ChatStore,
+    chats_dir: str | Path,
+    parse_feedback: Callable[[list[dict[str, str]]], list[tuple[str | None, str]]],
+) -> int:
+    """Import the one-file-per-chat JSONL histories into a chat store.
+
+    Files do not record the session group nor whether the last message was
+    accepted or written by the reviewer, so both are left unknown. Chats
+    already in the store are skipped, and so are chats in progress, whose
+    last message is not from the assistant: they stay resumable from their
+    file.
+
+    Parameters
+    ----------
+    store : ChatStore
+        The chat store.
+    chats_dir : str or Path
+        Directory of the ``<chat_id>.jsonl`` files.
+    parse_feedback : Callable
+        Gets the feedback rounds of a chat history.
+
+    Returns
+    -------
+    int
+        Number of imported chats.
+    """
+    known = {chat["chat_id"] for chat in store.find_chats()}
+    imported = 0
+    for path in sorted(Path(chats_dir).glob("*.jsonl")):
+        chat_id = path.stem
+        if chat_id in known:
+            continue
+        messages = load_chat_history(chat_id, chats_dir)
+        if not messages or messages[-1]["role"] != "assistant":
+            continue
+        store.save_chat(
+            chat_id,
+            session_group=None,
+            messages=messages,
+            outcome=None,
+            feedback_rounds=parse_feedback(messages),
+            finished_at=path.stat().st_mtime,
+        )
+        imported += 1
+
+    return imported
@@ -0,0 +1,304 @@
+"""Synthetic exercise results data.
+
+Generates data with the schema of ``exercise_results.parquet`` and
+distributions matched to the sessions in ``features_expected.parquet``:
+about 15 exercises per session with repeated exercises, ~1% of exercises left
+for one of the leave exercise reasons (null otherwise), ~8% of sessions
+without pain, fatigue and quality scores, ~16% of nok sessions.
+"""
+
+import base64
+from collections.abc import Iterator
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from message.transform import LEAVE_EXERCISE_REASONS
+
+EXERCISES = [
+    "ankle_alphabet",
+    "bridge",
+    "child's_pose",
+    "chin_tucks",
+    "clamshells",
+    "elbow_flexion",
+    "heel_raises",
+    "hip_abduction",
+    "hip_hyperextension",
+    "knee_extension",
+    "lunge",
+    "mini_squat",
+    "neck_rotation",
+    "pelvic_anterior_posterior_tilt",
+    "pelvic_side_tilt",
+    "plank",
+    "prayer_position_stretch",
+    "prone_press_ups",
+    "scapular_retraction",
+    "shoulder_abduction",
+    "shoulder_flexion",
+    "side_lying_clamshells",
+    "side_step",
+    "squat",
+    "straight_leg_raise",
+    "wris_prono_supination",
+]
+EXERCISE_SIDES = ["center", "left", "right", "bilateral"]
+THERAPIES = {
+    "low_back": 0.33,
+    "shoulder": 0.166,
+    "knee": 0.149,
+    "hip": 0.128,
+    "neck": 0.104,
+    "ankle": 0.056,
+    "wrist_hand": 0.038,
+    "elbow": 0.029,
+}
+# share of exercises left for each reason, the rest is null
+LEAVE_EXERCISE_RATES = [0.0039, 0.0032, 0.0023, 0.0015, 0.0006, 0.0002, 0.0002]
+LEAVE_SESSION_RATES = {
+    "other": 0.0136,
+    "system_problem": 0.0013,
+    "pain": 0.0012,
+    "tired": 0.001,
+}
+PAIN_RATES = {0: 0.269, 2: 0.37, 4: 0.236, 6: 0.103, 8: 0.02, 10: 0.002}
+FATIGUE_RATES = {0: 0.438, 2: 0.321, 4: 0.161, 6: 0.067, 8: 0.01, 10: 0.003}
+QUALITY_RATES = {1: 0.008, 2: 0.019, 3: 0.095, 4: 0.216, 5: 0.662}
+QUALITY_REASON_RATES = {
+    "movement_detection": 0.1164,
+    "my_self_personal": 0.0675,
+    "other": 0.0487,
+    "exercises": 0.0461,
+    "tablet_and_or_motion_trackers": 0.0316,
+    "easy_of_use": 0.0191,
+    "tablet": 0.0139,
+    "session_speed": 0.0099,
+}
+MISSING_SURVEY_RATE = 0.083
+NOK_RATE = 0.16
+MISSING_NOK_RATE = 0.014
+SESSIONS_PER_PATIENT = 6.5
+SCHEMA = pa.schema(
+    [
+        ("session_exercise_result_sword_id", pa.int64()),
+        ("session_group", pa.string()),
+        ("patient_id", pa.string()),
+        ("therapy_name", pa.string()),
+        ("exercise_name", pa.string()),
+        ("exercise_side", pa.string()),
+        ("exercise_order", pa.int64()),
+        ("prescribed_repeats", pa.int64()),
+        ("training_time", pa.int64()),
+        ("correct_repeats", pa.int64()),
+        ("wrong_repeats", pa.int64()),
+        ("leave_exercise", pa.string()),
+        ("leave_session", pa.string()),
+        ("pain", pa.float64()),
+        ("fatigue", pa.float64()),
+        ("quality", pa.float64()),
+        *[(f"quality_reason_{reason}", pa.int64()) for reason in QUALITY_REASON_RATES],
+        ("session_number", pa.int64()),
+        ("session_is_nok", pa.bool_()),
+        ("patient_name", pa.string()),
+        ("patient_age", pa.int64()),
+    ]
+)
+FIRST_NAMES = ["Ann", "Bob", "Carla", "David", "Eve", "Frank", "Grace", "Hector"]
+LAST_NAMES = ["Berg", "Contreras", "Greer", "Harris", "Moreno", "Vargas", "Walter"]
+
+
+def _random_ids(rng: np.random.Generator, n: int) -> np.ndarray:
+    """Random base64 identifiers shaped like the ones in the real data."""
+    raw = rng.integers(0, 256, size=(n, 20), dtype=np.uint8)
+    return np.array(
+        [base64.b64encode(row.tobytes()).decode() for row in raw], dtype=object
+    )
+
+
+def _choice(rng: np.random.Generator, rates: dict, n: int) -> np.ndarray:
+    """Draw n values with the given probabilities (normalized)."""
+    values = list(rates)
+    p = np.array(list(rates.values()), dtype="float64")
+    return np.array(values, dtype=object)[
+        rng.choice(len(values), size=n, p=p / p.sum())
+    ]
+
+
+def _generate_sessions(
+    rng: np.random.Generator, n_sessions: int, first_id: int
+) -> pd.DataFrame:
+    """Generate the exercise results of n_sessions sessions.
+
+    Parameters
+    ----------
+    rng : np.random.Generator
+        Random generator.
+    n_sessions : int
+        Number of sessions to generate.
+    first_id : int
+        First session_exercise_result_sword_id.
+
+    Returns
+    -------
+    pd.DataFrame
+        Exercise results, grouped by session.
+    """
+    n_patients = max(1, int(n_sessions / SESSIONS_PER_PATIENT))
+    patient_ids = _random_ids(rng, n_patients)
+    patient = rng.integers(0, n_patients, n_sessions)
+    patient_names = np.array(
+        [
+            f"{FIRST_NAMES[i % len(FIRST_NAMES)]} {LAST_NAMES[i % len(LAST_NAMES)]}"
+            for i in rng.integers(0, len(FIRST_NAMES) * len(LAST_NAMES), n_patients)
+        ],
+        dtype=object,
+    )
+    patient_ages = rng.integers(18, 100, n_patients)
+
+    # number of exercises, and the size of the pool they are drawn from, which
+    # leaves about 6 repeated exercises per session
+    n_exercises = np.clip(rng.normal(15, 5.5, n_sessions).round(), 1, 54).astype(int)
+    pool_size = np.maximum(1, (n_exercises * 0.65).round()).astype(int)
+    pool_offset = rng.integers(0, len(EXERCISES), n_sessions)
+
+    survey_missing = rng.random(n_sessions) < MISSING_SURVEY_RATE
+    pain = _choice(rng, PAIN_RATES, n_sessions).astype("float64")
+    fatigue = _choice(rng, FATIGUE_RATES, n_sessions).astype("float64")
+    quality = _choice(rng, QUALITY_RATES, n_sessions).astype("float64")
+    pain[survey_missing] = np.nan
+    fatigue[survey_missing] = np.nan
+    quality[survey_missing] = np.nan
+
+    nok = np.where(rng.random(n_sessions) < NOK_RATE, True, False).astype(object)
+    nok[rng.random(n_sessions) < MISSING_NOK_RATE] = None
+    leave_session = _choice(
+        rng,
+        {None: 1 - sum(LEAVE_SESSION_RATES.values()), **LEAVE_SESSION_RATES},
+        n_sessions,
+    )
+
+    session = np.repeat(np.arange(n_sessions), n_exercises)
+    n_rows = len(session)
+    row_patient = patient[session]
+
+    # exercise_order is a random permutation of 1..n within each session
+    starts = np.repeat(np.cumsum(n_exercises) - n_exercises, n_exercises)
+    shuffled = np.lexsort((rng.random(n_rows), session))
+    exercise_order = np.empty(n_rows, dtype="int64")
+    exercise_order[shuffled] = np.arange(n_rows) - starts + 1
+
+    pool = rng.integers(0, pool_size[session])
+    exercise = (pool_offset[session] + pool) % len(EXERCISES)
+    prescribed_repeats = rng.integers(1, 18, n_rows)
+    wrong_repeats = rng.binomial(prescribed_repeats, 0.023)
+    leave_exercise = _choice(
+        rng,
+        {
+            None: 1 - sum(LEAVE_EXERCISE_RATES),
+            **dict(zip(LEAVE_EXERCISE_REASONS, LEAVE_EXERCISE_RATES)),
+        },
+        n_rows,
+    )
+
+    df = pd.DataFrame(
+        {
+            "session_exercise_result_sword_id": first_id + np.arange(n_rows),
+            "session_group": _random_ids(rng, n_sessions)[session],
+            "patient_id": patient_ids[row_patient],
+            "therapy_name": _choice(rng, THERAPIES, n_sessions)[session],
+            "exercise_name": np.array(EXERCISES, dtype=object)[exercise],
+            "exercise_side": np.array(EXERCISE_SIDES, dtype=object)[
+                rng.integers(0, len(EXERCISE_SIDES), n_rows)
+            ],
+            "exercise_order": exercise_order,
+            "prescribed_repeats": prescribed_repeats,
+            "training_time": (prescribed_repeats * rng.gamma(4.0, 1.1, n_rows))
+            .round()
+            .astype("int64"),
+            "correct_repeats": prescribed_repeats - wrong_repeats,
+            "wrong_repeats": wrong_repeats,
+            "leave_exercise": leave_exercise,
+            "leave_session": leave_session[session],
+            "pain": pain[session],
+            "fatigue": fatigue[session],
+            "quality": quality[session],
+        }
+    )
+    for reason, rate in QUALITY_REASON_RATES.items():
+        flags = (rng.random(n_sessions) < rate).astype("int64")
+        df[f"quality_reason_{reason}"] = flags[session]
+    df["session_number"] = rng.geometric(1 / 28.5, n_sessions)[session]
+    df["session_is_nok"] = nok[session]
+    df["patient_name"] = patient_names[row_patient]
+    df["patient_age"] = patient_ages[row_patient]
+
+    return df
+
+
+def generate_exercise_results(
+    n_rows: int, seed: int = 0, chunk_rows: int = 1_000_000
+) -> Iterator[pd.DataFrame]:
+    """Generate synthetic exercise results in chunks of whole sessions.
+
+    Parameters
+    ----------
+    n_rows : int
+        Approximate total number of rows; the last session may overshoot it.
+    seed : int
+        Random seed, the same seed always yields the same data.
+    chunk_rows : int
+        Approximate number of rows per chunk.
+
+    Yields
+    ------
+    pd.DataFrame
+        Consecutive chunks of exercise results.
+    """
+    rng = np.random.default_rng(seed)
+    generated = 0
+    while generated < n_rows:
+        # 15 exercises per session on average
+        n_sessions = max(1, min(chunk_rows, n_rows - generated) // 15)
+        df = _generate_sessions(rng, n_sessions, first_id=generated)
+        generated += len(df)
+        yield df
+
+
+def write_exercise_results(
+    data_dir: str | Path, n_rows: int, seed: int = 0, chunk_rows: int = 1_000_000
+) -> Path:
+    """Write synthetic exercise results to ``exercise_results.parquet``.
+
+    The data is generated and written one chunk (and row group) at a time, so
+    memory does not grow with n_rows.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+        Directory to write the exercise results to.
+    n_rows : int
+        Approximate total number of rows.
+    seed : int
+        Random seed.
+    chunk_rows : int
+        Approximate number of rows per chunk and row group.
+
+    Returns
+    -------
+    Path
+        The written parquet file.
+    """
+    path = Path(data_dir, "exercise_results.parquet")
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with pq.ParquetWriter(path, SCHEMA) as writer:
+        for df in generate_exercise_results(n_rows, seed=seed, chunk_rows=chunk_rows):
+            writer.write_table(
+                pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False)
+            )
+
+    return path
@@ -1,8 +1,164 @@
 """Data Transformations"""
 
+from typing import NamedTuple
+
 from message.config import DATA_DIR
+from message.metrics import stage
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+LEAVE_EXERCISE_REASONS = [
+    "system_problem",
+    "other",
+    "unable_perform",
+    "pain",
+    "tired",
+    "technical_issues",
+    "difficulty",
+]
+
+# session level columns taken from the first non-null row, and their dtype
+# in the features whatever the (compact) input dtype
+SESSION_FIRST_COLUMNS = {
+    "patient_id": "object",
+    "patient_name": "object",
+    "patient_age": "int64",
+    "pain": "float64",
+    "fatigue": "float64",
+    "therapy_name": "object",
+    "session_number": "int64",
+    "leave_session": "object",
+    "quality": "float64",
+    "session_is_nok": "object",
+    "quality_reason_movement_detection": "int64",
+    "quality_reason_my_self_personal": "int64",
+    "quality_reason_other": "int64",
+    "quality_reason_exercises": "int64",
+    "quality_reason_tablet": "int64",
+    "quality_reason_tablet_and_or_motion_trackers": "int64",
+    "quality_reason_easy_of_use": "int64",
+    "quality_reason_session_speed": "int64",
+}
+
+SESSION_SUM_COLUMNS = [
+    "prescribed_repeats",
+    "training_time",
+    "correct_repeats",
+    "wrong_repeats",
+]
+
+# feature columns, in the order they are written
+FEATURE_COLUMNS = [
+    "session_group",
+    "patient_id",
+    "patient_name",
+    "patient_age",
+    "pain",
+    "fatigue",
+    "therapy_name",
+    "session_number",
+    "leave_session",
+    "quality",
+    "quality_reason_movement_detection",
+    "quality_reason_my_self_personal",
+    "quality_reason_other",
+    "quality_reason_exercises",
+    "quality_reason_tablet",
+    "quality_reason_tablet_and_or_motion_trackers",
+    "quality_reason_easy_of_use",
+    "quality_reason_session_speed",
+    "session_is_nok",
+    "leave_exercise_system_problem",
+    "leave_exercise_other",
+    "leave_exercise_unable_perform",
+    "leave_exercise_pain",
+    "leave_exercise_tired",
+    "leave_exercise_technical_issues",
+    "leave_exercise_difficulty",
+    "prescribed_repeats",
+    "training_time",
+    "perc_correct_repeats",
+    "number_exercises",
+    "number_of_distinct_exercises",
+    "exercise_with_most_incorrect",
+    "first_exercise_skipped",
+]
+
+
+def _cast_feature(values: pd.Series, dtype: str) -> pd.Series:
+    """Cast aggregated values to their feature dtype.
+
+    Missing values are None in object columns, and integer columns with
+    missing values stay floats.
+
+    Parameters
+    ----------
+    values : pd.Series
+        Aggregated values of one feature.
+    dtype : str
+        The feature dtype.
+
+    Returns
+    -------
+    pd.Series
+        The values with the feature dtype.
+    """
+    missing = values.isna()
+    if dtype == "object":
+        values = values.astype(object)
+        if missing.any():
+            values[missing] = None
+        return values
+    if missing.any() and pd.api.types.is_integer_dtype(dtype):
+        return values.astype("float64")
+
+    return values.astype(dtype)
+
+
+def _category_codes(
+    df: pd.DataFrame, columns: list[str]
+) -> tuple[dict[str, pd.Series], dict[str, pd.Index]]:
+    """Codes of the categorical columns, to aggregate instead of the values.
+
+    A groupby first runs a Python loop per group on categoricals but not on
+    their codes. Missing values get NaN codes, which first skips.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Exercise results data.
+    columns : list[str]
+        Columns to take the codes of, if categorical.
+
+    Returns
+    -------
+    tuple[dict[str, pd.Series], dict[str, pd.Index]]
+        The codes and the categories of each categorical column.
+    """
+    categories = {
+        column: df[column].cat.categories
+        for column in columns
+        if isinstance(df[column].dtype, pd.CategoricalDtype)
+    }
+    codes = {
+        column: df[column].cat.codes.where(df[column].notna()) for column in categories
+    }
+
+    return codes, categories
+
+
+def _decode_codes(codes: pd.Series, categories: pd.Index) -> pd.Series:
+    """Turn aggregated codes back into values, None where missing."""
+    values = np.full(len(codes), None, dtype=object)
+    present = codes.notna().to_numpy()
+    values[present] = categories.to_numpy(dtype=object)[
+        codes[present].to_numpy(dtype="int64")
+    ]
+
+    return pd.Series(values, index=codes.index)
 
 
 def aggregate_session_data(df: pd.DataFrame) -> pd.DataFrame:
@@ -18,8 +174,10 @@ def aggregate_session_data(df: pd.DataFrame) -> pd.DataFrame:
     pd.DataFrame
         Data aggregated by session_group.
     """
+    codes, categories = _category_codes(df, SESSION_FIRST_COLUMNS)
     grouped = (
-        df.groupby("session_group")
+        df.assign(**codes)
+        .groupby("session_group", observed=True)
         .agg(
             patient_id=("patient_id", "first"),
             patient_name=("patient_name", "first"),
@@ -55,34 +213,15 @@ def aggregate_session_data(df: pd.DataFrame) -> pd.DataFrame:
             quality_reason_easy_of_use=("quality_reason_easy_of_use", "first"),
             quality_reason_session_speed=("quality_reason_session_speed", "first"),
         )
+        # categorical keys grouped with observed=True come out unsorted
+        .sort_index()
         .reset_index()
     )
 
-    grouped["session_is_nok"] = grouped["session_is_nok"].astype("object")
-    grouped["pain"] = grouped["pain"].astype("float64")
-    grouped["fatigue"] = grouped["fatigue"].astype("float64")
-    grouped["session_number"] = grouped["session_number"].astype("int64")
-    grouped["quality"] = grouped["quality"].astype("float64")
-    grouped["quality_reason_movement_detection"] = grouped[
-        "quality_reason_movement_detection"
-    ].astype("int64")
-    grouped["quality_reason_my_self_personal"] = grouped[
-        "quality_reason_my_self_personal"
-    ].astype("int64")
-    grouped["quality_reason_other"] = grouped["quality_reason_other"].astype("int64")
-    grouped["quality_reason_exercises"] = grouped["quality_reason_exercises"].astype(
-        "int64"
-    )
-    grouped["quality_reason_tablet"] = grouped["quality_reason_tablet"].astype("int64")
-    grouped["quality_reason_tablet_and_or_motion_trackers"] = grouped[
-        "quality_reason_tablet_and_or_motion_trackers"
-    ].astype("int64")
-    grouped["quality_reason_easy_of_use"] = grouped[
-        "quality_reason_easy_of_use"
-    ].astype("int64")
-    grouped["quality_reason_session_speed"] = grouped[
-        "quality_reason_session_speed"
-    ].astype("int64")
+    for column, values in categories.items():
+        grouped[column] = _decode_codes(grouped[column], values)
+    for column, dtype in SESSION_FIRST_COLUMNS.items():
+        grouped[column] = _cast_feature(grouped[column], dtype)
 
     return grouped
 
@@ -121,15 +260,7 @@ def add_reason_counts(df: pd.DataFrame, grouped: pd.DataFrame) -> pd.DataFrame:
     pd.DataFrame
         Session data with reason counts added.
     """
-    leave_exercise_reasons = [
-        "system_problem",
-        "other",
-        "unable_perform",
-        "pain",
-        "tired",
-        "technical_issues",
-        "difficulty",
-    ]
+    leave_exercise_reasons = LEAVE_EXERCISE_REASONS
 
     df.set_index("session_group", inplace=True)
     grouped.set_index("session_group", inplace=True)
@@ -138,7 +269,7 @@ def add_reason_counts(df: pd.DataFrame, grouped: pd.DataFrame) -> pd.DataFrame:
         grouped[f"leave_exercise_{reason}"] = 0
         df_leave_exercise = (
             df[df["leave_exercise"] == reason]
-            .groupby("session_group")["leave_exercise"]
+            .groupby("session_group", observed=True)["leave_exercise"]
             .count()
         )
         grouped.loc[df_leave_exercise.index, f"leave_exercise_{reason}"] = (
@@ -169,12 +300,15 @@ def identify_most_incorrect_exercise(
     """
 
     grouped_wrong_reps = (
-        df.groupby(["session_group", "exercise_name"])["wrong_repeats"]
+        df.groupby(["session_group", "exercise_name"], observed=True)["wrong_repeats"]
         .sum()
+        .sort_index()
         .reset_index()
     )
     grouped_incorrect_ex = grouped_wrong_reps.loc[
-        grouped_wrong_reps.groupby("session_group")["wrong_repeats"].idxmax()
+        grouped_wrong_reps.groupby("session_group", observed=True)[
+            "wrong_repeats"
+        ].idxmax()
     ].drop(columns="wrong_repeats", axis=1)
     grouped = grouped.merge(grouped_incorrect_ex, on="session_group", how="left")
     grouped = grouped.rename(columns={"exercise_name": "exercise_with_most_incorrect"})
@@ -203,7 +337,7 @@ def identify_first_exercise_skipped(
         by=["session_group", "exercise_order"]
     )
     first_skipped = (
-        skipped_exercises.groupby("session_group")
+        skipped_exercises.groupby("session_group", observed=True)
         .first()
         .reset_index()[["session_group", "exercise_name"]]
     )
@@ -225,41 +359,549 @@ def order_columns(grouped: pd.DataFrame) -> pd.DataFrame:
     pd.DataFrame
         Session data with columns in the specified order.
     """
-    columns_order = [
-        "session_group",
-        "patient_id",
-        "patient_name",
-        "patient_age",
-        "pain",
-        "fatigue",
-        "therapy_name",
-        "session_number",
-        "leave_session",
-        "quality",
-        "quality_reason_movement_detection",
-        "quality_reason_my_self_personal",
-        "quality_reason_other",
-        "quality_reason_exercises",
-        "quality_reason_tablet",
-        "quality_reason_tablet_and_or_motion_trackers",
-        "quality_reason_easy_of_use",
-        "quality_reason_session_speed",
-        "session_is_nok",
-        "leave_exercise_system_problem",
-        "leave_exercise_other",
-        "leave_exercise_unable_perform",
-        "leave_exercise_pain",
-        "leave_exercise_tired",
-        "leave_exercise_technical_issues",
-        "leave_exercise_difficulty",
-        "prescribed_repeats",
-        "training_time",
-        "perc_correct_repeats",
-        "number_exercises",
-        "number_of_distinct_exercises",
-        "exercise_with_most_incorrect",
-        "first_exercise_skipped",
-    ]
-    grouped = grouped[columns_order]
+    grouped = grouped[FEATURE_COLUMNS]
+
+    return grouped
+
+
+def _segment_first(
+    values: pd.Series, order: np.ndarray, starts: np.ndarray, ends: np.ndarray
+) -> pd.Series:
+    """Take the first non-null value of each session segment.
+
+    Parameters
+    ----------
+    values : pd.Series
+        Column of the raw exercise results data.
+    order : np.ndarray
+        Row positions that sort the data by session code (stable).
+    starts : np.ndarray
+        Start offset of each session segment in ``order``.
+    ends : np.ndarray
+        End offset (exclusive) of each session segment in ``order``.
+
+    Returns
+    -------
+    pd.Series
+        One value per session, null where the session has no non-null value.
+    """
+    candidates = np.flatnonzero(values.notna().to_numpy()[order])
+    if len(candidates) == 0:
+        return pd.Series([None] * len(starts), dtype=values.dtype)
+
+    pos = np.minimum(np.searchsorted(candidates, starts), len(candidates) - 1)
+    found = (candidates[pos] >= starts) & (candidates[pos] < ends)
+
+    first = values.take(order[candidates[pos]]).reset_index(drop=True)
+    if not found.all():
+        # keep None for object columns, as groupby first does
+        if first.dtype == object:
+            first[~found] = None
+        else:
+            first = first.where(found)
+
+    return first
+
+
+def build_session_features(df: pd.DataFrame) -> pd.DataFrame:
+    """Build every session feature from a single factorization of session_group.
+
+    Rows are sorted once by session code and every feature is computed as a
+    reduction over the resulting segments: first values and sums with
+    ``reduceat``/``searchsorted``, reason counts with a single categorical
+    crosstab, and the first skipped and most incorrect exercises with
+    sort-based segment reductions. The raw data is not mutated.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Raw exercise results data.
+
+    Returns
+    -------
+    pd.DataFrame
+        Session data with all features, sorted by session_group and with
+        columns in the order given by `order_columns`.
+    """
+    with stage("aggregate_session_data", rows_in=len(df)) as record:
+        codes, sessions = pd.factorize(df["session_group"], sort=True)
+        if (codes < 0).any():
+            df = df[codes >= 0]
+            codes = codes[codes >= 0]
+
+        n_sessions = len(sessions)
+        order = np.argsort(codes, kind="stable")
+        starts = np.searchsorted(codes[order], np.arange(n_sessions))
+        ends = np.append(starts[1:], len(order)).astype(starts.dtype)
+
+        grouped = {"session_group": sessions.to_numpy(dtype=object)}
+
+        for column, dtype in SESSION_FIRST_COLUMNS.items():
+            first = _segment_first(df[column], order, starts, ends)
+            grouped[column] = _cast_feature(first, dtype)
+
+        for column in SESSION_SUM_COLUMNS:
+            values = df[column]
+            dtype = "int64" if pd.api.types.is_integer_dtype(values) else "float64"
+            filled = values.fillna(0).to_numpy(dtype=dtype)[order]
+            grouped[column] = (
+                np.add.reduceat(filled, starts) if n_sessions else filled[:0]
+            )
+        record["rows_out"] = n_sessions
+
+    # leave exercise reasons: one crosstab of session code x reason category
+    with stage("add_reason_counts", rows_in=len(df)) as record:
+        reasons = pd.Categorical(
+            df["leave_exercise"], categories=LEAVE_EXERCISE_REASONS
+        )
+        has_reason = reasons.codes >= 0
+        n_reasons = len(LEAVE_EXERCISE_REASONS)
+        crosstab = np.bincount(
+            codes[has_reason] * n_reasons + reasons.codes[has_reason],
+            minlength=n_sessions * n_reasons,
+        ).reshape(n_sessions, n_reasons)
+        for i, reason in enumerate(LEAVE_EXERCISE_REASONS):
+            grouped[f"leave_exercise_{reason}"] = crosstab[:, i]
+        record["rows_out"] = n_sessions
+
+    with stage("identify_most_incorrect_exercise", rows_in=len(df)) as record:
+        # exercise names are factorized in sorted order so ties resolve
+        # alphabetically, as with groupby + idxmax
+        exercise_codes, exercises = pd.factorize(df["exercise_name"], sort=True)
+        exercises = exercises.to_numpy(dtype=object)
+        named = exercise_codes >= 0
+        grouped["number_exercises"] = np.bincount(codes[named], minlength=n_sessions)
+
+        # (session, exercise) pairs, sorted by session then exercise
+        n_exercises = max(len(exercises), 1)
+        pairs, pair_index = np.unique(
+            codes[named].astype("int64") * n_exercises + exercise_codes[named],
+            return_inverse=True,
+        )
+        pair_sessions = pairs // n_exercises
+        pair_exercises = pairs % n_exercises
+        grouped["number_of_distinct_exercises"] = np.bincount(
+            pair_sessions, minlength=n_sessions
+        )
+
+        wrong_repeats = df["wrong_repeats"].fillna(0).to_numpy(dtype="float64")
+        pair_wrong = np.bincount(pair_index, weights=wrong_repeats[named])
+        by_wrong = np.lexsort((-pair_wrong, pair_sessions))
+        most_incorrect = np.full(n_sessions, np.nan, dtype=object)
+        segment_head = np.r_[True, np.diff(pair_sessions[by_wrong]) != 0]
+        best = by_wrong[segment_head[: len(by_wrong)]]
+        most_incorrect[pair_sessions[best]] = exercises[pair_exercises[best]]
+        grouped["exercise_with_most_incorrect"] = most_incorrect
+        record["rows_out"] = n_sessions
+
+    # first skipped: skipped rows sorted by (session, exercise_order)
+    with stage("identify_first_exercise_skipped", rows_in=len(df)) as record:
+        skipped = np.flatnonzero(df["leave_exercise"].notna().to_numpy() & named)
+        exercise_order = df["exercise_order"].to_numpy(dtype="float64", na_value=np.nan)
+        skipped = skipped[np.lexsort((exercise_order[skipped], codes[skipped]))]
+        first_skipped = np.full(n_sessions, np.nan, dtype=object)
+        segment_head = np.r_[True, np.diff(codes[skipped]) != 0]
+        head = skipped[segment_head[: len(skipped)]]
+        first_skipped[codes[head]] = exercises[exercise_codes[head]]
+        grouped["first_exercise_skipped"] = first_skipped
+        record["rows_out"] = n_sessions
+
+    grouped = pd.DataFrame(grouped)
+    with stage("calculate_performance_metrics", rows_in=n_sessions) as record:
+        grouped = calculate_performance_metrics(grouped)
+        record["rows_out"] = len(grouped)
+    with stage("order_columns", rows_in=n_sessions) as record:
+        grouped = order_columns(grouped)
+        record["rows_out"] = len(grouped)
+
+    return grouped
+
+
+class SessionPartials(NamedTuple):
+    """Mergeable per-session partial aggregates.
+
+    Attributes
+    ----------
+    sessions : pd.DataFrame
+        First values, sums and counts, indexed by session_group.
+    pairs : pd.DataFrame
+        Wrong repeats summed per (session_group, exercise_name).
+    skips : pd.DataFrame
+        Skipped exercise with the lowest exercise_order per session_group.
+    """
+
+    sessions: pd.DataFrame
+    pairs: pd.DataFrame
+    skips: pd.DataFrame
+
+
+def _first_skipped(skips: pd.DataFrame) -> pd.DataFrame:
+    """Keep the skipped exercise with the lowest exercise_order per session.
+
+    Parameters
+    ----------
+    skips : pd.DataFrame
+        Skipped exercises, in row order.
+
+    Returns
+    -------
+    pd.DataFrame
+        One skipped exercise per session_group.
+    """
+    return skips.sort_values(
+        by=["session_group", "exercise_order"], kind="stable"
+    ).drop_duplicates("session_group", keep="first")
+
+
+def aggregate_session_partials(df: pd.DataFrame) -> SessionPartials:
+    """Aggregate a chunk of exercise data into mergeable partials.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Raw exercise results data, or any contiguous chunk of it.
+
+    Returns
+    -------
+    SessionPartials
+        The partial aggregates of the chunk.
+    """
+    df = df[df["session_group"].notnull()]
+    reasons = {
+        f"leave_exercise_{reason}": df["leave_exercise"] == reason
+        for reason in LEAVE_EXERCISE_REASONS
+    }
+    codes, categories = _category_codes(df, SESSION_FIRST_COLUMNS)
+    sessions = (
+        df.assign(**reasons, **codes)
+        .groupby("session_group", sort=False, observed=True)
+        .agg(
+            **{column: (column, "first") for column in SESSION_FIRST_COLUMNS},
+            **{column: (column, "sum") for column in SESSION_SUM_COLUMNS},
+            **{column: (column, "sum") for column in reasons},
+            number_exercises=("exercise_name", "count"),
+        )
+    )
+    for column, values in categories.items():
+        sessions[column] = _decode_codes(sessions[column], values)
+
+    named = df[df["exercise_name"].notnull()]
+    pairs = (
+        named.groupby(["session_group", "exercise_name"], sort=False, observed=True)[
+            "wrong_repeats"
+        ]
+        .sum()
+        .reset_index()
+    )
+    skips = _first_skipped(
+        named.loc[
+            named["leave_exercise"].notnull(),
+            ["session_group", "exercise_order", "exercise_name"],
+        ]
+    )
+
+    return SessionPartials(sessions, pairs, skips)
+
+
+def merge_session_partials(partials: list[SessionPartials]) -> SessionPartials:
+    """Merge partials computed over consecutive chunks of exercise data.
+
+    Partials must be given in the order of the chunks they came from, so that
+    first values keep the semantics of a groupby over the whole data.
+
+    Parameters
+    ----------
+    partials : list[SessionPartials]
+        The partials to merge, in chunk order.
+
+    Returns
+    -------
+    SessionPartials
+        The merged partial aggregates.
+    """
+    sessions = pd.concat([partial.sessions for partial in partials])
+    sessions = sessions.groupby(level=0, sort=False, observed=True).agg(
+        {
+            column: "first" if column in SESSION_FIRST_COLUMNS else "sum"
+            for column in sessions.columns
+        }
+    )
+    pairs = (
+        pd.concat([partial.pairs for partial in partials])
+        .groupby(["session_group", "exercise_name"], sort=False, observed=True)[
+            "wrong_repeats"
+        ]
+        .sum()
+        .reset_index()
+    )
+    skips = _first_skipped(pd.concat([partial.skips for partial in partials]))
+
+    return SessionPartials(sessions, pairs, skips)
+
+
+def finalize_session_partials(partials: SessionPartials) -> pd.DataFrame:
+    """Turn merged partials into the session features.
+
+    Parameters
+    ----------
+    partials : SessionPartials
+        Partial aggregates covering all of the exercise data.
+
+    Returns
+    -------
+    pd.DataFrame
+        Session data with all features, sorted by session_group and with
+        columns in the order given by `order_columns`.
+    """
+    # grouping with sort=False reorders categories by appearance, so session
+    # groups and exercise names are sorted by value rather than by category
+    grouped = partials.sessions.set_axis(
+        partials.sessions.index.astype(object)
+    ).sort_index()
+    for column, dtype in SESSION_FIRST_COLUMNS.items():
+        grouped[column] = _cast_feature(grouped[column], dtype)
+    for column in SESSION_SUM_COLUMNS:
+        integer = pd.api.types.is_integer_dtype(grouped[column])
+        grouped[column] = grouped[column].astype("int64" if integer else "float64")
+
+    pairs = partials.pairs.astype({"session_group": object, "exercise_name": object})
+    grouped["number_of_distinct_exercises"] = (
+        pairs.groupby("session_group").size().reindex(grouped.index, fill_value=0)
+    )
+    # most wrong repeats first, ties resolve alphabetically as with idxmax
+    most_incorrect = (
+        pairs.sort_values(
+            ["session_group", "wrong_repeats", "exercise_name"],
+            ascending=[True, False, True],
+        )
+        .drop_duplicates("session_group")
+        .set_index("session_group")["exercise_name"]
+    )
+    grouped["exercise_with_most_incorrect"] = most_incorrect.reindex(
+        grouped.index
+    ).astype(object)
+    grouped["first_exercise_skipped"] = (
+        partials.skips.set_index("session_group")["exercise_name"]
+        .reindex(grouped.index)
+        .astype(object)
+    )
+
+    grouped = grouped.rename_axis("session_group").reset_index()
+    grouped = calculate_performance_metrics(grouped)
+    grouped = order_columns(grouped)
 
     return grouped
+
+
+# string columns that are kept dictionary encoded by the Arrow engine
+DICTIONARY_COLUMNS = [
+    "session_group",
+    "patient_id",
+    "patient_name",
+    "therapy_name",
+    "exercise_name",
+    "leave_exercise",
+    "leave_session",
+]
+
+ARROW_CASTS = {"float64": pa.float64(), "int64": pa.int64()}
+
+
+def _dictionary_parts(column: pa.ChunkedArray) -> tuple[pa.Array, pa.Array]:
+    """Split a string column into dictionary indices and dictionary.
+
+    Chunks are combined into one array over a single (unified) dictionary;
+    plain string columns are dictionary encoded first.
+
+    Parameters
+    ----------
+    column : pa.ChunkedArray
+        String or dictionary column of the exercise results.
+
+    Returns
+    -------
+    tuple[pa.Array, pa.Array]
+        The indices of each row and the dictionary values.
+    """
+    if not pa.types.is_dictionary(column.type):
+        column = pc.dictionary_encode(column.cast(pa.string()))
+    array = column.combine_chunks()
+
+    return array.indices, array.dictionary
+
+
+def _rename(table: pa.Table, names: dict[str, str]) -> pa.Table:
+    """Rename the columns of an aggregation result by name.
+
+    The position of the group keys in the output of ``group_by`` differs
+    between pyarrow versions, so columns are never renamed by position.
+    """
+    return table.rename_columns([names.get(name, name) for name in table.column_names])
+
+
+def _first_by(table: pa.Table, keys: list[tuple[str, str]], value: str) -> pa.Table:
+    """Take the first value of each session after sorting by some keys.
+
+    Parameters
+    ----------
+    table : pa.Table
+        Table with a ``session`` code column.
+    keys : list[tuple[str, str]]
+        Sort keys, ties keep the row order (the sort is stable).
+    value : str
+        Column to take the first value of.
+
+    Returns
+    -------
+    pa.Table
+        The ``session`` code and the first value of each session.
+    """
+    first = (
+        table.sort_by(keys)
+        .group_by("session", use_threads=False)
+        .aggregate([(value, "first")])
+    )
+
+    return _rename(first, {f"{value}_first": value})
+
+
+def build_session_features_arrow(table: pa.Table) -> pa.Table:
+    """Build every session feature with Arrow compute kernels.
+
+    String columns are aggregated on their dictionary indices and wrapped
+    back into dictionary arrays at the end, so no string is materialized
+    between the parquet read and write. Groupings are unthreaded, so first
+    values keep the row order semantics of a pandas groupby first.
+
+    Parameters
+    ----------
+    table : pa.Table
+        Raw exercise results data, string columns preferably read as
+        dictionaries.
+
+    Returns
+    -------
+    pa.Table
+        Session data with all features, sorted by session_group and with
+        columns in the order given by `FEATURE_COLUMNS`.
+    """
+    sessions, session_values = _dictionary_parts(table.column("session_group"))
+    if sessions.null_count:
+        valid = pc.is_valid(sessions)
+        table = table.filter(valid)
+        sessions = sessions.filter(valid)
+    # one key type for the groupings and joins below
+    sessions = sessions.cast(pa.int64())
+
+    dictionaries = {}
+    work = {"session": sessions}
+    for column in DICTIONARY_COLUMNS[1:]:
+        work[column], dictionaries[column] = _dictionary_parts(table.column(column))
+    for column in [*SESSION_FIRST_COLUMNS, *SESSION_SUM_COLUMNS, "exercise_order"]:
+        if column not in work:
+            work[column] = table.column(column)
+    if pa.types.is_floating(work["exercise_order"].type):
+        # sort NaN and null orders alike, both last
+        work["exercise_order"] = pc.fill_null(work["exercise_order"], np.nan)
+
+    # position of each row's leave_exercise in LEAVE_EXERCISE_REASONS
+    reason = pc.take(
+        pc.index_in(
+            dictionaries["leave_exercise"],
+            value_set=pa.array(LEAVE_EXERCISE_REASONS),
+        ),
+        work["leave_exercise"],
+    )
+    for i, name in enumerate(LEAVE_EXERCISE_REASONS):
+        work[f"leave_exercise_{name}"] = pc.equal(reason, i)
+    work = pa.table(work)
+
+    sum_options = pc.ScalarAggregateOptions(min_count=0)
+    sum_columns = [
+        *SESSION_SUM_COLUMNS,
+        *[f"leave_exercise_{name}" for name in LEAVE_EXERCISE_REASONS],
+    ]
+    aggregations = [
+        *[(column, "first") for column in SESSION_FIRST_COLUMNS],
+        *[(column, "sum", sum_options) for column in sum_columns],
+        ("exercise_name", "count"),
+        ("exercise_name", "count_distinct"),
+    ]
+    grouped = _rename(
+        work.group_by("session", use_threads=False).aggregate(aggregations),
+        {
+            **{f"{column}_first": column for column in SESSION_FIRST_COLUMNS},
+            **{f"{column}_sum": column for column in sum_columns},
+            "exercise_name_count": "number_exercises",
+            "exercise_name_count_distinct": "number_of_distinct_exercises",
+        },
+    )
+
+    # exercise names ranked alphabetically so ties resolve as with idxmax
+    exercise_rank = pc.rank(dictionaries["exercise_name"], sort_keys="ascending")
+    named = work.select(
+        [
+            "session",
+            "exercise_name",
+            "wrong_repeats",
+            "leave_exercise",
+            "exercise_order",
+        ]
+    )
+    if work.column("exercise_name").null_count:
+        named = named.filter(pc.is_valid(named.column("exercise_name")))
+    pairs = _rename(
+        named.group_by(["session", "exercise_name"], use_threads=False).aggregate(
+            [("wrong_repeats", "sum", sum_options)]
+        ),
+        {"wrong_repeats_sum": "wrong_repeats"},
+    )
+    pairs = pairs.append_column(
+        "rank", pc.take(exercise_rank, pairs.column("exercise_name"))
+    )
+    most_incorrect = _rename(
+        _first_by(
+            pairs,
+            [("wrong_repeats", "descending"), ("rank", "ascending")],
+            "exercise_name",
+        ),
+        {"exercise_name": "exercise_with_most_incorrect"},
+    )
+
+    skipped = named.filter(pc.is_valid(named.column("leave_exercise")))
+    first_skipped = _rename(
+        _first_by(skipped, [("exercise_order", "ascending")], "exercise_name"),
+        {"exercise_name": "first_exercise_skipped"},
+    )
+
+    grouped = grouped.join(most_incorrect, "session").join(first_skipped, "session")
+    grouped = grouped.append_column(
+        "session_rank",
+        pc.take(pc.rank(session_values, sort_keys="ascending"), grouped["session"]),
+    ).sort_by("session_rank")
+
+    columns = {
+        "session_group": pa.DictionaryArray.from_arrays(
+            grouped["session"].combine_chunks(), session_values
+        )
+    }
+    for column in grouped.column_names:
+        values = grouped[column].combine_chunks()
+        if column in dictionaries:
+            values = pa.DictionaryArray.from_arrays(values, dictionaries[column])
+        elif column in ("exercise_with_most_incorrect", "first_exercise_skipped"):
+            values = pa.DictionaryArray.from_arrays(
+                values, dictionaries["exercise_name"]
+            )
+        elif SESSION_FIRST_COLUMNS.get(column) in ARROW_CASTS:
+            values = values.cast(ARROW_CASTS[SESSION_FIRST_COLUMNS[column]])
+        elif column in sum_columns and not pa.types.is_floating(values.type):
+            values = values.cast(pa.int64())
+        columns[column] = values
+
+    columns["perc_correct_repeats"] = pc.divide(
+        columns["correct_repeats"].cast(pa.float64()),
+        pc.add(columns["correct_repeats"], columns["wrong_repeats"]).cast(pa.float64()),
+    )
+
+    return pa.table({column: columns[column] for column in FEATURE_COLUMNS})
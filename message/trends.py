@@ -0,0 +1,267 @@
+"""Patient trend features, across the sessions of each patient."""
+
+import pandas as pd
+import pyarrow as pa
+
+from message.transform import LEAVE_EXERCISE_REASONS
+
+# session features followed across the sessions of a patient
+TREND_METRICS = ["pain", "fatigue", "perc_correct_repeats", "skip_rate"]
+# sessions in the moving averages, the current one included
+TREND_WINDOW = 3
+# trend feature columns, in the order they are written
+TREND_COLUMNS = [
+    "skip_rate",
+    "previous_sessions",
+    "nok_streak",
+    *[f"{metric}_delta" for metric in TREND_METRICS],
+    *[f"{metric}_avg" for metric in TREND_METRICS],
+]
+# session feature columns the trends are computed from
+SESSION_COLUMNS = [
+    "patient_id",
+    "session_number",
+    "pain",
+    "fatigue",
+    "perc_correct_repeats",
+    "number_exercises",
+    "session_is_nok",
+    *[f"leave_exercise_{reason}" for reason in LEAVE_EXERCISE_REASONS],
+]
+# columns of the running state, the last sessions of every patient
+STATE_COLUMNS = [
+    "patient_id",
+    "session_number",
+    *TREND_METRICS,
+    "previous_sessions",
+    "nok_streak",
+]
+
+
+def skip_rate(features: pd.DataFrame) -> pd.Series:
+    """Share of the exercises of each session that were skipped.
+
+    Parameters
+    ----------
+    features : pd.DataFrame
+        Session features.
+
+    Returns
+    -------
+    pd.Series
+        The skip rate, NaN for sessions without exercises.
+    """
+    skipped = features[
+        [f"leave_exercise_{reason}" for reason in LEAVE_EXERCISE_REASONS]
+    ].sum(axis=1)
+    exercises = features["number_exercises"].where(features["number_exercises"] > 0)
+
+    return (skipped / exercises).astype("float64")
+
+
+def empty_state() -> pd.DataFrame:
+    """The running state of no patient."""
+    return pd.DataFrame(
+        {
+            "patient_id": pd.Series(dtype=object),
+            "session_number": pd.Series(dtype="int64"),
+            **{metric: pd.Series(dtype="float64") for metric in TREND_METRICS},
+            "previous_sessions": pd.Series(dtype="int64"),
+            "nok_streak": pd.Series(dtype="int64"),
+        }
+    )
+
+
+def stale_patients(state: pd.DataFrame, sessions: pd.DataFrame) -> set:
+    """Find the patients with sessions that are not newer than their state.
+
+    Their trends are only right once they are recomputed from all of their
+    sessions, see `update_patient_trends`.
+
+    Parameters
+    ----------
+    state : pd.DataFrame
+        The running state.
+    sessions : pd.DataFrame
+        Session features to add.
+
+    Returns
+    -------
+    set
+        The patient ids.
+    """
+    last = state.groupby("patient_id")["session_number"].max()
+    first = sessions.groupby("patient_id")["session_number"].min()
+    last = last.reindex(first.index)
+
+    return set(first.index[first <= last])
+
+
+def update_patient_trends(
+    sessions: pd.DataFrame, state: pd.DataFrame | None = None
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Compute the trend features of new sessions from the running state of
+    their patients.
+
+    Sessions of a patient are ordered by session_number. For each metric of
+    `TREND_METRICS`, the trends are its change since the previous session
+    and its average over the last `TREND_WINDOW` sessions; a session also
+    gets its number of previous sessions and the number of consecutive nok
+    sessions it ends. The state keeps the last ``TREND_WINDOW - 1`` sessions
+    of every patient, so the cost depends on the new sessions only. Sessions
+    without a patient_id get no trends.
+
+    Parameters
+    ----------
+    sessions : pd.DataFrame
+        Session features, all newer than the state of their patient; see
+        `stale_patients` for the patients to recompute from all of their
+        sessions, without their state.
+    state : pd.DataFrame, optional
+        The running state, none by default.
+
+    Returns
+    -------
+    tuple[pd.DataFrame, pd.DataFrame]
+        The trend features, aligned with the sessions, and the updated
+        running state.
+    """
+    state = empty_state() if state is None else state
+    stale = stale_patients(state, sessions)
+    if stale:
+        raise ValueError(
+            f"sessions not newer than the state of {len(stale)} patients, "
+            "recompute them without their state"
+        )
+
+    new = sessions.loc[sessions["patient_id"].notnull()]
+    new = pd.DataFrame(
+        {
+            "patient_id": new["patient_id"],
+            "session_number": new["session_number"],
+            **{
+                metric: new[metric].astype("float64")
+                for metric in TREND_METRICS
+                if metric != "skip_rate"
+            },
+            "skip_rate": skip_rate(new),
+            "nok": new["session_is_nok"].fillna(False).astype(bool),
+            "row": new.index,
+        }
+    )
+    seeds = state[state["patient_id"].isin(set(new["patient_id"]))].assign(
+        nok=lambda seeds: seeds["nok_streak"] > 0, row=None
+    )
+    combined = pd.concat([seeds, new], ignore_index=True).sort_values(
+        ["patient_id", "session_number"], kind="stable", ignore_index=True
+    )
+    patients = combined.groupby("patient_id", sort=False)
+
+    # seeds carry their number of previous sessions, the first one counts
+    # those before it
+    position = patients.cumcount()
+    combined["previous_sessions"] = (
+        position + patients["previous_sessions"].transform("first").fillna(0)
+    ).astype("int64")
+
+    # nok sessions of each run, runs end with a session that is not nok; the
+    # first run continues the streak from before the first seed
+    nok = combined["nok"].astype("int64")
+    run = (1 - nok).groupby(combined["patient_id"], sort=False).cumsum()
+    streak = nok.groupby([combined["patient_id"], run], sort=False).cumsum()
+    carried = (
+        patients["nok_streak"].transform("first")
+        - patients["nok"].transform("first").astype("int64")
+    ).fillna(0)
+    combined["nok_streak"] = (streak + carried.where(run == 0, 0)).astype("int64")
+
+    # the window is built from shifted columns, a grouped rolling window
+    # computes its bounds group by group
+    window = [
+        combined[TREND_METRICS],
+        *[patients[TREND_METRICS].shift(lag) for lag in range(1, TREND_WINDOW)],
+    ]
+    totals = sum(values.fillna(0) for values in window)
+    counts = sum(values.notnull().astype("int64") for values in window)
+    for metric in TREND_METRICS:
+        combined[f"{metric}_delta"] = combined[metric] - window[1][metric]
+        combined[f"{metric}_avg"] = totals[metric] / counts[metric].where(
+            counts[metric] > 0
+        )
+
+    added = combined[combined["row"].notnull()].set_index("row")
+    # counts stay integers when sessions without a patient get no trends
+    trends = (
+        added[TREND_COLUMNS]
+        .reindex(sessions.index)
+        .astype({"previous_sessions": "Int64", "nok_streak": "Int64"})
+    )
+    trends["skip_rate"] = skip_rate(sessions)
+
+    updated = pd.concat(
+        [
+            state[~state["patient_id"].isin(set(new["patient_id"]))],
+            combined.groupby("patient_id", sort=False).tail(TREND_WINDOW - 1)[
+                STATE_COLUMNS
+            ],
+        ],
+        ignore_index=True,
+    ).astype(empty_state().dtypes.to_dict())
+
+    return trends, updated
+
+
+def add_patient_trends(features: pd.DataFrame) -> pd.DataFrame:
+    """Add the trend features to session features, from all of their
+    sessions.
+
+    Parameters
+    ----------
+    features : pd.DataFrame
+        Session features of whole patient histories.
+
+    Returns
+    -------
+    pd.DataFrame
+        The features with the trend columns, replacing any previous ones.
+    """
+    features = features.drop(columns=TREND_COLUMNS, errors="ignore")
+    trends, _ = update_patient_trends(features)
+
+    return pd.concat([features, trends], axis=1)
+
+
+def add_patient_trends_arrow(features: pa.Table) -> pa.Table:
+    """Add the trend features to session features in an Arrow table, from
+    all of their sessions.
+
+    Only the `SESSION_COLUMNS` the trends are computed from go through
+    pandas; the other columns stay as they are.
+
+    Parameters
+    ----------
+    features : pa.Table
+        Session features of whole patient histories.
+
+    Returns
+    -------
+    pa.Table
+        The features with the trend columns, replacing any previous ones.
+    """
+    sessions = {}
+    for column in SESSION_COLUMNS:
+        values = features.column(column)
+        if pa.types.is_dictionary(values.type):
+            values = values.cast(values.type.value_type)
+        sessions[column] = values
+    trends, _ = update_patient_trends(pa.table(sessions).to_pandas())
+
+    features = features.drop(
+        [column for column in TREND_COLUMNS if column in features.column_names]
+    )
+    for column in TREND_COLUMNS:
+        features = features.append_column(
+            column, pa.array(trends[column], from_pandas=True)
+        )
+
+    return features
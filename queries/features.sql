@@ -1 +1,170 @@
-###### YOUR CODE HERE ######
\ No newline at end of file
+-- Session features from the raw exercise results.
+--
+-- Reads the parquet file directly. Row order matters for the "first" values:
+-- they are the first non-null value of each session in file order, as with a
+-- pandas groupby first.
+WITH exercise AS (
+    SELECT *
+    FROM read_parquet('{exercise_file}', file_row_number = true)
+    WHERE session_group IS NOT NULL
+),
+
+sessions AS (
+    SELECT
+        session_group,
+        arg_min(patient_id, file_row_number) FILTER (WHERE patient_id IS NOT NULL) AS patient_id,
+        arg_min(patient_name, file_row_number) FILTER (WHERE patient_name IS NOT NULL) AS patient_name,
+        arg_min(patient_age, file_row_number) FILTER (WHERE patient_age IS NOT NULL) AS patient_age,
+        arg_min(pain, file_row_number) FILTER (WHERE pain IS NOT NULL) AS pain,
+        arg_min(fatigue, file_row_number) FILTER (WHERE fatigue IS NOT NULL) AS fatigue,
+        arg_min(therapy_name, file_row_number) FILTER (WHERE therapy_name IS NOT NULL) AS therapy_name,
+        arg_min(session_number, file_row_number) FILTER (WHERE session_number IS NOT NULL) AS session_number,
+        arg_min(leave_session, file_row_number) FILTER (WHERE leave_session IS NOT NULL) AS leave_session,
+        arg_min(quality, file_row_number) FILTER (WHERE quality IS NOT NULL) AS quality,
+        arg_min(quality_reason_movement_detection, file_row_number) FILTER (WHERE quality_reason_movement_detection IS NOT NULL) AS quality_reason_movement_detection,
+        arg_min(quality_reason_my_self_personal, file_row_number) FILTER (WHERE quality_reason_my_self_personal IS NOT NULL) AS quality_reason_my_self_personal,
+        arg_min(quality_reason_other, file_row_number) FILTER (WHERE quality_reason_other IS NOT NULL) AS quality_reason_other,
+        arg_min(quality_reason_exercises, file_row_number) FILTER (WHERE quality_reason_exercises IS NOT NULL) AS quality_reason_exercises,
+        arg_min(quality_reason_tablet, file_row_number) FILTER (WHERE quality_reason_tablet IS NOT NULL) AS quality_reason_tablet,
+        arg_min(quality_reason_tablet_and_or_motion_trackers, file_row_number) FILTER (WHERE quality_reason_tablet_and_or_motion_trackers IS NOT NULL) AS quality_reason_tablet_and_or_motion_trackers,
+        arg_min(quality_reason_easy_of_use, file_row_number) FILTER (WHERE quality_reason_easy_of_use IS NOT NULL) AS quality_reason_easy_of_use,
+        arg_min(quality_reason_session_speed, file_row_number) FILTER (WHERE quality_reason_session_speed IS NOT NULL) AS quality_reason_session_speed,
+        arg_min(session_is_nok, file_row_number) FILTER (WHERE session_is_nok IS NOT NULL) AS session_is_nok,
+        count(*) FILTER (WHERE leave_exercise = 'system_problem') AS leave_exercise_system_problem,
+        count(*) FILTER (WHERE leave_exercise = 'other') AS leave_exercise_other,
+        count(*) FILTER (WHERE leave_exercise = 'unable_perform') AS leave_exercise_unable_perform,
+        count(*) FILTER (WHERE leave_exercise = 'pain') AS leave_exercise_pain,
+        count(*) FILTER (WHERE leave_exercise = 'tired') AS leave_exercise_tired,
+        count(*) FILTER (WHERE leave_exercise = 'technical_issues') AS leave_exercise_technical_issues,
+        count(*) FILTER (WHERE leave_exercise = 'difficulty') AS leave_exercise_difficulty,
+        coalesce(sum(prescribed_repeats), 0) AS prescribed_repeats,
+        coalesce(sum(training_time), 0) AS training_time,
+        coalesce(sum(correct_repeats), 0) AS correct_repeats,
+        coalesce(sum(wrong_repeats), 0) AS wrong_repeats,
+        count(exercise_name) AS number_exercises,
+        count(DISTINCT exercise_name) AS number_of_distinct_exercises,
+        -- skipped exercises ordered by exercise_order, ties in file order
+        first(exercise_name ORDER BY exercise_order NULLS LAST, file_row_number)
+            FILTER (WHERE leave_exercise IS NOT NULL AND exercise_name IS NOT NULL) AS first_exercise_skipped
+    FROM exercise
+    GROUP BY session_group
+),
+
+exercise_wrong_repeats AS (
+    SELECT
+        session_group,
+        exercise_name,
+        coalesce(sum(wrong_repeats), 0) AS wrong_repeats
+    FROM exercise
+    WHERE exercise_name IS NOT NULL
+    GROUP BY session_group, exercise_name
+),
+
+most_incorrect AS (
+    -- ties resolve alphabetically
+    SELECT
+        session_group,
+        first(exercise_name ORDER BY wrong_repeats DESC, exercise_name) AS exercise_with_most_incorrect
+    FROM exercise_wrong_repeats
+    GROUP BY session_group
+),
+
+features AS (
+    SELECT
+        s.session_group,
+        s.patient_id,
+        s.patient_name,
+        s.patient_age,
+        CAST(s.pain AS DOUBLE) AS pain,
+        CAST(s.fatigue AS DOUBLE) AS fatigue,
+        s.therapy_name,
+        CAST(s.session_number AS BIGINT) AS session_number,
+        s.leave_session,
+        CAST(s.quality AS DOUBLE) AS quality,
+        CAST(s.quality_reason_movement_detection AS BIGINT) AS quality_reason_movement_detection,
+        CAST(s.quality_reason_my_self_personal AS BIGINT) AS quality_reason_my_self_personal,
+        CAST(s.quality_reason_other AS BIGINT) AS quality_reason_other,
+        CAST(s.quality_reason_exercises AS BIGINT) AS quality_reason_exercises,
+        CAST(s.quality_reason_tablet AS BIGINT) AS quality_reason_tablet,
+        CAST(s.quality_reason_tablet_and_or_motion_trackers AS BIGINT) AS quality_reason_tablet_and_or_motion_trackers,
+        CAST(s.quality_reason_easy_of_use AS BIGINT) AS quality_reason_easy_of_use,
+        CAST(s.quality_reason_session_speed AS BIGINT) AS quality_reason_session_speed,
+        s.session_is_nok,
+        CAST(s.leave_exercise_system_problem AS BIGINT) AS leave_exercise_system_problem,
+        CAST(s.leave_exercise_other AS BIGINT) AS leave_exercise_other,
+        CAST(s.leave_exercise_unable_perform AS BIGINT) AS leave_exercise_unable_perform,
+        CAST(s.leave_exercise_pain AS BIGINT) AS leave_exercise_pain,
+        CAST(s.leave_exercise_tired AS BIGINT) AS leave_exercise_tired,
+        CAST(s.leave_exercise_technical_issues AS BIGINT) AS leave_exercise_technical_issues,
+        CAST(s.leave_exercise_difficulty AS BIGINT) AS leave_exercise_difficulty,
+        CAST(s.prescribed_repeats AS {prescribed_repeats_type}) AS prescribed_repeats,
+        CAST(s.training_time AS {training_time_type}) AS training_time,
+        CAST(s.correct_repeats AS DOUBLE) / CAST(s.correct_repeats + s.wrong_repeats AS DOUBLE) AS perc_correct_repeats,
+        s.number_exercises,
+        s.number_of_distinct_exercises,
+        m.exercise_with_most_incorrect,
+        s.first_exercise_skipped
+    FROM sessions AS s
+    LEFT JOIN most_incorrect AS m USING (session_group)
+),
+
+patient_sessions AS (
+    SELECT
+        *,
+        CAST(
+            leave_exercise_system_problem + leave_exercise_other
+            + leave_exercise_unable_perform + leave_exercise_pain
+            + leave_exercise_tired + leave_exercise_technical_issues
+            + leave_exercise_difficulty AS DOUBLE
+        ) / nullif(number_exercises, 0) AS skip_rate,
+        coalesce(session_is_nok, false) AS nok
+    FROM features
+),
+
+patient_runs AS (
+    -- runs of nok sessions, each ended by a session that is not nok
+    SELECT
+        *,
+        sum(CASE WHEN nok THEN 0 ELSE 1 END) OVER patient_history AS run
+    FROM patient_sessions
+    WINDOW patient_history AS (
+        PARTITION BY patient_id
+        ORDER BY session_number NULLS LAST, session_group
+        ROWS UNBOUNDED PRECEDING
+    )
+)
+
+-- patient trends, over the sessions of each patient ordered by
+-- session_number, ties in session_group order; sessions without a patient
+-- only get their skip rate
+SELECT
+    * EXCLUDE (skip_rate, nok, run),
+    skip_rate,
+    CASE WHEN patient_id IS NOT NULL THEN row_number() OVER patient - 1 END AS previous_sessions,
+    CASE WHEN patient_id IS NOT NULL THEN CAST(sum(CAST(nok AS BIGINT)) OVER patient_run AS BIGINT) END AS nok_streak,
+    CASE WHEN patient_id IS NOT NULL THEN pain - lag(pain) OVER patient END AS pain_delta,
+    CASE WHEN patient_id IS NOT NULL THEN fatigue - lag(fatigue) OVER patient END AS fatigue_delta,
+    CASE WHEN patient_id IS NOT NULL THEN perc_correct_repeats - lag(perc_correct_repeats) OVER patient END AS perc_correct_repeats_delta,
+    CASE WHEN patient_id IS NOT NULL THEN skip_rate - lag(skip_rate) OVER patient END AS skip_rate_delta,
+    CASE WHEN patient_id IS NOT NULL THEN avg(pain) OVER patient_window END AS pain_avg,
+    CASE WHEN patient_id IS NOT NULL THEN avg(fatigue) OVER patient_window END AS fatigue_avg,
+    CASE WHEN patient_id IS NOT NULL THEN avg(perc_correct_repeats) OVER patient_window END AS perc_correct_repeats_avg,
+    CASE WHEN patient_id IS NOT NULL THEN avg(skip_rate) OVER patient_window END AS skip_rate_avg
+FROM patient_runs
+WINDOW
+    patient AS (
+        PARTITION BY patient_id
+        ORDER BY session_number NULLS LAST, session_group
+    ),
+    patient_run AS (
+        PARTITION BY patient_id, run
+        ORDER BY session_number NULLS LAST, session_group
+        ROWS UNBOUNDED PRECEDING
+    ),
+    -- the last {trend_preceding} sessions and the current one
+    patient_window AS (
+        PARTITION BY patient_id
+        ORDER BY session_number NULLS LAST, session_group
+        ROWS BETWEEN {trend_preceding} PRECEDING AND CURRENT ROW
+    )
+ORDER BY session_group
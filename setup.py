@@ -1,6 +1,7 @@
 from setuptools import find_packages, setup
 
 packages = [
+    "aiohttp==3.9.1",
     "duckdb==0.10.0",
     "jupyter_client==8.6.0",
     "jupyter_core==5.7.1",
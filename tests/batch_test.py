@@ -0,0 +1,93 @@
+import asyncio
+import json
+import time
+
+from stubs import ChatCompletionsStub
+
+import message.batch
+from message.batch import RateLimiter, generate_batch
+from message.data import get_session_groups
+from message.model import ChatModel
+
+
+def run_generate_batch(session_groups, output, **kwargs):
+    async def run():
+        async with (
+            ChatCompletionsStub(delay=0.02) as stub,
+            ChatModel(api_base=stub.api_base, max_concurrency=2) as model,
+        ):
+            summary = await generate_batch(
+                session_groups, output, concurrency=2, chat_model=model, **kwargs
+            )
+        return stub, summary
+
+    return asyncio.run(run())
+
+
+def test_rate_limiter_waits_for_tokens():
+    async def run():
+        limiter = RateLimiter(requests_per_minute=6_000, tokens_per_minute=6_000)
+        await limiter.acquire(6_000)
+        start = time.perf_counter()
+        await limiter.acquire(50)
+        return time.perf_counter() - start
+
+    # 100 tokens per second
+    assert 0.4 < asyncio.run(run()) < 1
+
+
+def test_generate_batch_resumes(settings_env, tmp_path):
+    session_groups = get_session_groups()[:5]
+    output = tmp_path / "drafts.jsonl"
+
+    stub, summary = run_generate_batch([*session_groups, "unknown"], output)
+
+    assert summary == {"drafted": 5, "failed": 1, "skipped": 0}
+    assert stub.max_in_flight <= 2
+    drafts = [json.loads(line) for line in output.read_text().splitlines()]
+    messages = {draft["session_group"]: draft["message"] for draft in drafts}
+    assert messages == {
+        **{session_group: "Great session!" for session_group in session_groups},
+        "unknown": None,
+    }
+
+    # a crash cut off the last line, and one more session group is requested
+    with open(output, "a") as f:
+        f.write('{"session_group": "cut')
+    more = get_session_groups()[5:6]
+    # duplicates are drafted and counted once
+    stub, summary = run_generate_batch([*session_groups, *more, *more], output)
+
+    assert summary == {"drafted": 1, "failed": 0, "skipped": 5}
+    assert len(stub.requests) == 1
+    last = json.loads(output.read_text().splitlines()[-1])
+    assert last == {
+        "session_group": more[0],
+        "message": "Great session!",
+        "error": None,
+    }
+
+
+def test_generate_batch_keeps_going_after_a_failure(
+    settings_env, tmp_path, monkeypatch
+):
+    session_groups = get_session_groups()[:4]
+    system_message = message.batch.system_message
+
+    def failing_system_message(features):
+        if features[0]["session_group"] == session_groups[1]:
+            raise KeyError("pain")
+        return system_message(features)
+
+    monkeypatch.setattr(message.batch, "system_message", failing_system_message)
+    output = tmp_path / "drafts.jsonl"
+
+    _, summary = run_generate_batch(session_groups, output)
+
+    assert summary == {"drafted": 3, "failed": 1, "skipped": 0}
+    drafts = [json.loads(line) for line in output.read_text().splitlines()]
+    errors = {draft["session_group"]: draft["error"] for draft in drafts}
+    assert errors == {
+        **{session_group: None for session_group in session_groups},
+        session_groups[1]: "KeyError('pain')",
+    }
@@ -0,0 +1,139 @@
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from message.benchmark import (
+    _measure_in_process,
+    compare_to_baseline,
+    features_match,
+    format_comparison,
+    measure_startup,
+    run_benchmark,
+    run_regression_benchmark,
+)
+from message.synthetic import SCHEMA, generate_exercise_results, write_exercise_results
+from message.transform import build_session_features
+
+
+def test_generate_exercise_results_is_deterministic():
+    first = pd.concat(generate_exercise_results(5_000, seed=1, chunk_rows=2_000))
+    second = pd.concat(generate_exercise_results(5_000, seed=1, chunk_rows=2_000))
+
+    pd.testing.assert_frame_equal(first, second)
+    assert len(first) >= 5_000
+    assert first["session_exercise_result_sword_id"].is_unique
+
+
+def test_synthetic_distributions(tmp_path):
+    path = write_exercise_results(tmp_path, 30_000, seed=0, chunk_rows=10_000)
+    assert pq.read_schema(path).remove_metadata() == SCHEMA
+
+    df = pd.read_parquet(path)
+    features = build_session_features(df)
+
+    assert 13 < features["number_exercises"].mean() < 17
+    # repeated exercises within a session
+    repeated = features["number_exercises"] - features["number_of_distinct_exercises"]
+    assert repeated.mean() > 3
+    # leave_exercise is null unless the exercise was skipped
+    assert 0.005 < df["leave_exercise"].notnull().mean() < 0.02
+    assert features["pain"].isnull().mean() > 0.05
+
+
+def test_run_benchmark(tmp_path):
+    report = run_benchmark([2_000], ["py", "sql"], tmp_path)
+
+    assert [result["engine"] for result in report["results"]] == ["py", "sql"]
+    for result in report["results"]:
+        assert result["error"] is None
+        assert result["parity"]
+        assert result["seconds"] > 0
+        assert result["peak_rss_mb"] > 0
+
+
+def test_features_match_detects_differences(exercise_df):
+    features = build_session_features(exercise_df)
+    changed = features.assign(number_exercises=features["number_exercises"] + 1)
+
+    assert features_match(features, features.iloc[::-1])
+    assert not features_match(features, changed)
+
+
+def test_cli_startup_is_lazy(monkeypatch):
+    # the commands that do not call the LLM must not need its settings
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+
+    for args in [["--help"], ["transform", "--help"]]:
+        result = measure_startup(args, repeat=1)
+
+        assert result["error"] is None
+        assert result["loaded"] == []
+
+
+def test_run_regression_benchmark(tmp_path):
+    report = run_regression_benchmark(tmp_path, sizes=[2_000], repeat=2)
+
+    assert [(result["case"], result["rows"]) for result in report["results"]] == [
+        ("transform_features_py", 2_000),
+        ("get_features", 2_000),
+    ]
+    for result in report["results"]:
+        assert result["error"] is None
+        assert len(result["runs"]) == 2
+        assert result["seconds"] == min(result["runs"]) > 0
+
+
+def test_compare_to_baseline():
+    def report(*results):
+        return {
+            "results": [
+                {
+                    "case": case,
+                    "rows": 1_000,
+                    "seconds": seconds,
+                    "memory_mb": memory_mb,
+                    "error": None,
+                }
+                for case, seconds, memory_mb in results
+            ]
+        }
+
+    baseline = report(
+        ("slower", 1.0, 100.0), ("faster", 1.0, 100.0), ("noise", 0.01, 1)
+    )
+    current = report(
+        ("slower", 3.0, 110.0),
+        ("faster", 0.5, 100.0),
+        # tripled, but under the noise floor
+        ("noise", 0.03, 3),
+        ("added", 1.0, 100.0),
+    )
+
+    comparison = compare_to_baseline(current, baseline, time_tolerance=0.25)
+
+    statuses = {(row["case"], row["metric"]): row["status"] for row in comparison}
+    assert statuses == {
+        ("slower", "seconds"): "regression",
+        ("slower", "memory_mb"): "ok",
+        ("faster", "seconds"): "improved",
+        ("faster", "memory_mb"): "ok",
+        ("noise", "seconds"): "ok",
+        ("noise", "memory_mb"): "ok",
+        ("added", "seconds"): "new",
+        ("added", "memory_mb"): "new",
+    }
+    table = format_comparison(comparison).splitlines()
+    assert len(table) == 1 + len(comparison)
+    assert table[1].startswith("! slower")
+    assert "+200.0%" in table[1]
+
+
+def _exit_without_measurements(code, queue):
+    os._exit(code)
+
+
+def test_measure_in_process_reports_crashes():
+    assert _measure_in_process(_exit_without_measurements, 3) == {
+        "error": "exit code 3"
+    }
@@ -0,0 +1,80 @@
+import os
+import time
+
+from message.cache import EVICT_TARGET, ResponseCache
+
+PARAMS = {
+    "model": "gpt-4o-mini",
+    "temperature": 0,
+    "messages": [{"role": "system", "content": "Write a message."}],
+}
+
+
+def test_key_is_canonical():
+    reordered = dict(reversed(PARAMS.items()))
+    with_transport = {**PARAMS, "request_timeout": (1, 2), "stream": True}
+
+    assert ResponseCache.key(PARAMS) == ResponseCache.key(reordered)
+    assert ResponseCache.key(PARAMS) == ResponseCache.key(with_transport)
+    assert ResponseCache.key(PARAMS) != ResponseCache.key({**PARAMS, "temperature": 1})
+
+
+def test_get_set_counts_hits_and_misses(tmp_path):
+    cache = ResponseCache(tmp_path, max_bytes=2**20, max_age=60)
+    key = cache.key(PARAMS)
+
+    assert cache.get(key) is None
+    cache.set(key, "Great job!", params=PARAMS)
+    assert cache.get(key) == "Great job!"
+    # shared across instances
+    assert ResponseCache(tmp_path, max_bytes=2**20, max_age=60).get(key)
+
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["entries"] == 1
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = ResponseCache(tmp_path, max_bytes=2**20, max_age=0.05)
+    key = cache.key(PARAMS)
+    cache.set(key, "Great job!")
+    time.sleep(0.1)
+
+    assert cache.get(key) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(tmp_path, max_bytes=2**20, max_age=60)
+    keys = [cache.key({**PARAMS, "seed": i}) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.set(key, "x" * 100)
+        path = cache._path(key)
+        os.utime(path, (i, path.stat().st_mtime))
+    # reading the oldest entry makes it the most recently used
+    cache.get(keys[0])
+
+    # room for two entries, their sizes differ by the digits of created_at
+    room = sum(cache._path(key).stat().st_size for key in keys[::2])
+    cache.max_bytes = int(room / EVICT_TARGET) + 1
+
+    assert cache.evict() == 1
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == cache.get(keys[2]) == "x" * 100
+
+
+def test_full_cache_is_not_scanned_on_every_write(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path, max_bytes=2**20, max_age=60)
+    keys = [cache.key({**PARAMS, "seed": i}) for i in range(100)]
+    cache.set(keys[0], "x" * 100)
+    cache.max_bytes = 50 * cache._path(keys[0]).stat().st_size
+
+    scans = []
+    entries = cache._entries
+    monkeypatch.setattr(cache, "_entries", lambda: scans.append(1) or entries())
+    for key in keys[1:]:
+        cache.set(key, "x" * 100)
+
+    # each eviction frees room for several writes, rather than for one
+    assert 0 < len(scans) < 15
+    assert cache.stats()["bytes"] <= cache.max_bytes
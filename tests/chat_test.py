@@ -0,0 +1,222 @@
+import asyncio
+import time
+
+import pytest
+from stubs import ChatCompletionsStub
+
+from message.config import get_settings
+from message.data import get_session_groups
+from message.io import chat_file
+from message.model import ChatModel
+from message.store import ChatStore
+
+REPLY = "Hi Ann, great job on your session today, keep it up!"
+MESSAGES = [{"role": "system", "content": "Write a message."}]
+
+
+@pytest.fixture
+def chat(settings_env):
+    import message.chat
+
+    return message.chat
+
+
+def answer_after(seconds: float, line: str):
+    async def read_line() -> str:
+        await asyncio.sleep(seconds)
+        return line
+
+    return read_line
+
+
+def run_generate_message(chat, monkeypatch, stub, read_line):
+    async def run():
+        async with stub, ChatModel(api_base=stub.api_base) as model:
+            monkeypatch.setattr(chat, "chat_model", model)
+            monkeypatch.setattr(chat, "read_line", read_line)
+            return await chat.generate_message(MESSAGES)
+
+    return asyncio.run(run())
+
+
+def test_generate_message_streams_full_message(chat, monkeypatch, capsys):
+    stub = ChatCompletionsStub(reply=REPLY)
+
+    message, response = run_generate_message(
+        chat, monkeypatch, stub, answer_after(0.2, "Accept\n")
+    )
+
+    assert (message, response) == (REPLY, "accept")
+    assert capsys.readouterr().out.startswith(f"Message: {REPLY}\nAccept")
+
+
+def test_generate_message_accept_waits_for_full_message(chat, monkeypatch):
+    stub = ChatCompletionsStub(reply=REPLY, token_delay=0.02)
+
+    message, response = run_generate_message(
+        chat, monkeypatch, stub, answer_after(0, "accept\n")
+    )
+
+    assert (message, response) == (REPLY, "accept")
+
+
+@pytest.mark.parametrize("answer", ["edit", "reject"])
+def test_generate_message_cancels_generation(chat, monkeypatch, capsys, answer):
+    stub = ChatCompletionsStub(reply=REPLY, token_delay=0.5)
+
+    start = time.perf_counter()
+    message, response = run_generate_message(
+        chat, monkeypatch, stub, answer_after(0.1, f"{answer}\n")
+    )
+
+    assert (message, response) == (None, answer)
+    assert time.perf_counter() - start < 1
+    assert stub.chunks_sent < len(REPLY.split(" "))
+    assert "Generation cancelled" in capsys.readouterr().out
+
+
+def reply_by_category(request: dict) -> str:
+    last = request["messages"][-1]["content"]
+    for category in ["Tone", "Generic", "Engagement", "Factuality"]:
+        if f"**Category: {category}**" in last:
+            return f"{category} revision"
+
+    return "Draft"
+
+
+def test_speculation_budget_and_take(chat, monkeypatch):
+    async def run():
+        async with (
+            ChatCompletionsStub(reply=reply_by_category) as stub,
+            ChatModel(api_base=stub.api_base) as model,
+        ):
+            monkeypatch.setattr(chat, "chat_model", model)
+            speculation = chat.Speculation(budget=6)
+            speculation.start(MESSAGES)
+            first_round = len(speculation.revisions)
+            revision = speculation.take("generic")
+            others_cancelled = not speculation.revisions
+            message = await revision
+            speculation.start(MESSAGES)
+            second_round = len(speculation.revisions)
+            speculation.cancel()
+        return first_round, others_cancelled, message, second_round
+
+    assert asyncio.run(run()) == (4, True, "Generic revision", 2)
+
+
+def test_run_chat_uses_speculative_revision(chat, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    session_group = get_session_groups()[0]
+    answers = iter(["edit\n", "accept\n"])
+    inputs = iter(["tone", ""])
+
+    async def read_line() -> str:
+        await asyncio.sleep(0.05)
+        return next(answers)
+
+    monkeypatch.setattr(chat, "read_line", read_line)
+    monkeypatch.setattr("builtins.input", lambda prompt="": next(inputs))
+
+    async def run():
+        async with ChatCompletionsStub(reply=reply_by_category) as stub:
+            model = ChatModel(api_base=stub.api_base)
+            monkeypatch.setattr(chat, "chat_model", model)
+            await chat.run_chat(session_group, speculate=True, chat_id="chat")
+        return stub
+
+    stub = asyncio.run(run())
+
+    # the finished chat moved from its journal to the store
+    assert not chat_file("chat").exists()
+    store = ChatStore(get_settings().CHAT_STORE_PATH)
+    chat_history = store.get_messages("chat")
+    assert chat_history[-1] == {"role": "assistant", "content": "Tone revision"}
+    [stored] = store.find_chats(category="tone")
+    assert stored["chat_id"] == "chat"
+    assert stored["session_group"] == session_group
+    assert stored["outcome"] == "accept"
+    # the revision was not requested again after the reviewer picked it
+    tone_requests = [
+        request
+        for request in stub.requests
+        if len(request["messages"]) == 2
+        and "**Category: Tone**" in request["messages"][-1]["content"]
+    ]
+    assert len(tone_requests) == 1
+
+
+def test_run_chat_reject_answer_does_not_block(chat, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+
+    async def read_line() -> str:
+        return "reject\n"
+
+    def slow_input(prompt=""):
+        time.sleep(0.2)
+        return "My own answer"
+
+    monkeypatch.setattr(chat, "read_line", read_line)
+    monkeypatch.setattr("builtins.input", slow_input)
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        async with ChatCompletionsStub(reply=REPLY, token_delay=0.01) as stub:
+            model = ChatModel(api_base=stub.api_base)
+            monkeypatch.setattr(chat, "chat_model", model)
+            start = ticks
+            await chat.run_chat(get_session_groups()[0], chat_id="chat")
+        ticker.cancel()
+        return ticks - start
+
+    # the event loop kept running while the answer was typed
+    assert asyncio.run(run()) >= 10
+    store = ChatStore(get_settings().CHAT_STORE_PATH)
+    assert store.get_messages("chat")[-1] == {
+        "role": "assistant",
+        "content": "My own answer",
+    }
+    assert store.find_chats(outcome="reject")[0]["chat_id"] == "chat"
+
+
+def test_feedback_rounds(chat):
+    chat_history = [
+        chat.system_message([]),
+        {"role": "assistant", "content": "Draft"},
+        *chat.feedback_messages("tone", "Mention the squats"),
+        *chat.feedback_messages("generic", ""),
+        {"role": "assistant", "content": "Revision"},
+    ]
+
+    assert chat.feedback_rounds(chat_history) == [
+        ("tone", "Mention the squats"),
+        ("generic", ""),
+    ]
+
+
+def test_fold_feedback(chat):
+    messages = [
+        *chat.feedback_messages("tone", "Mention the squats"),
+        *chat.feedback_messages("tone", ""),
+        *chat.feedback_messages("engagement", "Shorter"),
+    ]
+
+    folded = chat.fold_feedback(messages)
+
+    assert folded["role"] == "system"
+    content = folded["content"]
+    assert content.count("**Category: Tone**") == 1
+    assert "**Category: Engagement**" in content
+    assert "Reviewer: Mention the squats" in content
+    assert "Reviewer: Shorter" in content
+    # the repeated feedback guidelines are dropped
+    assert "## Guidelines" not in content
+    assert len(content) < sum(len(message["content"]) for message in messages) / 3
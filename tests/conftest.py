@@ -0,0 +1,113 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+QUALITY_REASONS = [
+    "movement_detection",
+    "my_self_personal",
+    "other",
+    "exercises",
+    "tablet",
+    "tablet_and_or_motion_trackers",
+    "easy_of_use",
+    "session_speed",
+]
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        help="Run the performance regression tests.",
+    )
+    parser.addoption(
+        "--update-baselines",
+        action="store_true",
+        help="Record the performance baselines of this machine.",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: performance regression test, run with --benchmark"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="performance regression test, needs --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def exercise_df():
+    rows = [
+        # session_group, exercise_name, order, wrong, leave_exercise, pain, nok
+        ("b", "squat", 2, 3, None, np.nan, None),
+        ("a", "plank", 1, 1, "pain", 4.0, True),
+        ("b", "bridge", 1, 3, "tired", 2.0, None),
+        ("a", "squat", 3, 0, "other", 4.0, True),
+        ("c", "plank", 1, 0, None, 0.0, False),
+        ("a", "plank", 2, 2, None, 4.0, True),
+        ("b", None, 3, 5, "difficulty", 2.0, None),
+        ("c", "plank", 2, np.nan, None, 0.0, False),
+        ("a", "bridge", 4, 3, "pain", 4.0, True),
+    ]
+    df = pd.DataFrame(
+        rows,
+        columns=[
+            "session_group",
+            "exercise_name",
+            "exercise_order",
+            "wrong_repeats",
+            "leave_exercise",
+            "pain",
+            "session_is_nok",
+        ],
+    )
+    df.insert(0, "session_exercise_result_sword_id", range(100, 100 + len(df)))
+    df["patient_id"] = df["session_group"].map({"a": "p1", "b": "p1", "c": "p2"})
+    df["patient_name"] = df["patient_id"].map({"p1": "Ann", "p2": "Bob"})
+    df["patient_age"] = df["patient_id"].map({"p1": 40, "p2": 65})
+    df["fatigue"] = df["pain"]
+    df["therapy_name"] = "knee"
+    df["session_number"] = df["session_group"].map({"a": 1, "b": 2, "c": 1})
+    df["leave_session"] = df["session_group"].map({"a": None, "b": "pain", "c": None})
+    df["quality"] = 5.0
+    for reason in QUALITY_REASONS:
+        df[f"quality_reason_{reason}"] = 0
+    df["prescribed_repeats"] = 10
+    df["training_time"] = 60
+    df["correct_repeats"] = 10 - df["wrong_repeats"].fillna(0).astype(int)
+    return df
+
+
+@pytest.fixture(autouse=True)
+def features_path(monkeypatch):
+    from message.config import DATA_DIR, get_settings
+
+    # lookups read the expected features, tests do not run message transform
+    monkeypatch.setenv(
+        "FEATURES_PATH", str(Path(DATA_DIR, "features_expected.parquet"))
+    )
+    get_settings.cache_clear()
+    yield
+    get_settings.cache_clear()
+
+
+@pytest.fixture
+def settings_env(monkeypatch, tmp_path):
+    from message.config import get_settings
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    # tests that cache responses pass their own cache
+    monkeypatch.setenv("LLM_CACHE_ENABLED", "false")
+    monkeypatch.setenv("LLM_CACHE_DIR", str(tmp_path / "llm_cache"))
+    get_settings.cache_clear()
+    yield
+    get_settings.cache_clear()
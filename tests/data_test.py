@@ -1,8 +1,32 @@
 from pathlib import Path
 import pytest
 import pandas as pd
-from message.data import transform_features_py
+import message.data
+from message.benchmark import features_match
+from message.data import (
+    FeatureIndex,
+    partition_exercise_table,
+    read_features,
+    transform_features_arrow,
+    transform_features_incremental,
+    transform_features_parallel,
+    transform_features_py,
+    transform_features_sql,
+)
+from message.io import (
+    feature_offsets_file,
+    iter_exercise_data,
+    load_exercise_data,
+    load_feature_offsets,
+    parquet_column_max,
+    write_features,
+)
+from message.synthetic import write_exercise_results
+from message.transform import build_session_features
+from message.trends import add_patient_trends
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from numpy.testing import assert_array_equal
 
 DATA_DIR = Path(__file__).parent.parent / "data"
@@ -20,9 +44,23 @@ def expected_df():
 
 
 # kind of an anti-pattern, but prevents the function from running multiple times
-@pytest.fixture(scope="session")
-def result_df():
-    df = transform_features_py().reset_index(drop=True).sort_values("session_group")
+@pytest.fixture(scope="session", params=["py", "sql", "arrow"])
+def result_df(request, tmp_path_factory):
+    # engines write features.parquet next to the exercise results, so they
+    # read them through a link, out of the data directory
+    data_dir = tmp_path_factory.mktemp(request.param)
+    (data_dir / "exercise_results.parquet").symlink_to(
+        Path(DATA_DIR, "exercise_results.parquet")
+    )
+    if request.param == "sql":
+        transform_features_sql(data_dir=data_dir)
+        df = pd.read_parquet(Path(data_dir, "features.parquet"))
+    elif request.param == "arrow":
+        transform_features_arrow(data_dir=data_dir)
+        df = pd.read_parquet(Path(data_dir, "features.parquet"))
+    else:
+        df = transform_features_py(data_dir=data_dir)
+    df = df.reset_index(drop=True).sort_values("session_group")
     return df
 
 
@@ -126,3 +164,287 @@ def test_identify_most_incorrect_exercise(result_df, exercise_with_most_incorrec
     )
 
     assert np.all((trans_col + session_col) > 0)
+
+
+@pytest.fixture
+def exercise_data_dir(tmp_path, exercise_df):
+    exercise_df.to_parquet(tmp_path / "exercise_results.parquet")
+    return tmp_path
+
+
+def test_load_exercise_data_compact_dtypes(exercise_data_dir, exercise_df):
+    df = load_exercise_data(exercise_data_dir)
+
+    assert "session_exercise_result_sword_id" not in df
+    assert df["exercise_name"].cat.categories.tolist() == ["bridge", "plank", "squat"]
+    assert df["exercise_order"].dtype == "int8"
+    assert df["session_is_nok"].dtype == "boolean"
+    # integers with missing values, and scores, keep their precision
+    assert df["wrong_repeats"].dtype == "float64"
+    assert df["pain"].dtype == "float64"
+    assert df.memory_usage(deep=True).sum() < exercise_df.memory_usage(deep=True).sum()
+
+    pd.testing.assert_frame_equal(
+        build_session_features(df), build_session_features(exercise_df)
+    )
+
+
+def test_iter_exercise_data_matches_load(exercise_data_dir):
+    batches = list(iter_exercise_data(exercise_data_dir, batch_rows=4))
+
+    assert [len(batch) for batch in batches] == [4, 4, 1]
+    # each batch is downcast on its own, so only the values must match
+    pd.testing.assert_frame_equal(
+        pd.concat(batches, ignore_index=True).astype(object),
+        load_exercise_data(exercise_data_dir).astype(object),
+    )
+
+
+def test_partition_exercise_table(exercise_df):
+    table = pa.Table.from_pandas(exercise_df, preserve_index=False)
+    partitions = partition_exercise_table(table, 2)
+
+    assert sum(len(partition) for partition in partitions) == len(table)
+    seen = set()
+    for partition in partitions:
+        sessions = set(partition.column("session_group").to_pylist())
+        assert not sessions & seen
+        seen |= sessions
+        # rows keep their original relative order
+        ids = partition.column("exercise_order").to_pylist()
+        expected = exercise_df[exercise_df["session_group"].isin(sessions)]
+        assert ids == expected["exercise_order"].tolist()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_transform_features_parallel(exercise_data_dir, exercise_df, workers):
+    result = transform_features_parallel(workers, data_dir=exercise_data_dir)
+
+    pd.testing.assert_frame_equal(
+        result, add_patient_trends(build_session_features(exercise_df))
+    )
+
+
+def test_transform_features_incremental(exercise_data_dir, exercise_df, monkeypatch):
+    full = transform_features_incremental(data_dir=exercise_data_dir)
+    assert (exercise_data_dir / "features.manifest.json").exists()
+    pd.testing.assert_frame_equal(
+        pd.read_parquet(exercise_data_dir / "features.parquet"), full
+    )
+
+    new_rows = exercise_df[exercise_df["session_group"] == "c"].assign(
+        session_group="d",
+        session_exercise_result_sword_id=lambda df: (
+            df["session_exercise_result_sword_id"] + 1000
+        ),
+    )
+    updated_df = pd.concat([exercise_df, new_rows], ignore_index=True)
+    pq.write_table(
+        pa.Table.from_pandas(updated_df, preserve_index=False),
+        exercise_data_dir / "exercise_results.parquet",
+        row_group_size=len(exercise_df),
+    )
+
+    calls = []
+
+    def build_session_features_spy(df):
+        calls.append(set(df["session_group"]))
+        return build_session_features(df)
+
+    monkeypatch.setattr(
+        message.data, "build_session_features", build_session_features_spy
+    )
+    result = transform_features_incremental(data_dir=exercise_data_dir)
+
+    # the first row group is unchanged, so only the new session is recomputed
+    assert calls == [{"d"}]
+    pd.testing.assert_frame_equal(
+        result, add_patient_trends(build_session_features(updated_df))
+    )
+
+    assert transform_features_incremental(data_dir=exercise_data_dir).equals(result)
+    assert len(calls) == 1
+
+    transform_features_incremental(full_refresh=True, data_dir=exercise_data_dir)
+    assert calls[-1] == {"a", "b", "c", "d"}
+
+
+def test_transform_features_incremental_rewritten_row_group(
+    exercise_data_dir, exercise_df
+):
+    exercise_file = exercise_data_dir / "exercise_results.parquet"
+    exercise_df.to_parquet(exercise_file, index=False, row_group_size=5)
+    transform_features_incremental(data_dir=exercise_data_dir)
+
+    # the second row group loses the last row of "b", which has rows in the
+    # first one
+    updated_df = exercise_df.drop(index=6)
+    updated_df.to_parquet(exercise_file, index=False, row_group_size=5)
+    result = transform_features_incremental(data_dir=exercise_data_dir)
+
+    pd.testing.assert_frame_equal(
+        result, add_patient_trends(build_session_features(updated_df))
+    )
+
+
+def test_parquet_column_max(exercise_data_dir):
+    exercise_file = exercise_data_dir / "exercise_results.parquet"
+
+    assert parquet_column_max(exercise_file, "session_exercise_result_sword_id") == 108
+    assert parquet_column_max(exercise_file, "missing") is None
+
+
+@pytest.fixture
+def features_file(tmp_path, exercise_df):
+    path = tmp_path / "features.parquet"
+    build_session_features(exercise_df).to_parquet(path, index=False)
+    return path
+
+
+def test_feature_index_matches_filter(features_file):
+    features = pd.read_parquet(features_file)
+    index = FeatureIndex(features_file)
+
+    for session_group in ["a", "b", "c", "unknown"]:
+        expected = features[features["session_group"] == session_group].to_dict(
+            orient="records"
+        )
+        assert repr(index.get(session_group)) == repr(expected)
+
+    assert list(index.get_many(["c", "a"])) == ["c", "a"]
+
+
+def test_feature_index_invalidation_and_lru(features_file):
+    index = FeatureIndex(features_file, cache_size=2)
+    index.get_many(["a", "b", "c"])
+    assert list(index._records) == ["b", "c"]
+
+    features = pd.read_parquet(features_file)
+    features["patient_age"] = 99
+    features.iloc[:1].to_parquet(features_file, index=False)
+
+    assert index.get("a")[0]["patient_age"] == 99
+    assert index.get("b") == []
+
+
+def test_write_features_layout(tmp_path, monkeypatch):
+    features = build_session_features(
+        load_exercise_data(write_exercise_results(tmp_path, 3_000, seed=0).parent)
+    )
+    shuffled = features.sample(frac=1, random_state=0)
+    path = tmp_path / "features.parquet"
+    write_features(shuffled, path, row_group_rows=20)
+
+    offsets = load_feature_offsets(path)
+    assert feature_offsets_file(path).exists()
+    assert offsets["sorted"]
+    assert len(offsets["row_groups"]) == -(-len(features) // 20)
+    assert pd.read_parquet(path)["session_group"].is_monotonic_increasing
+
+    read_row_groups = pq.ParquetFile.read_row_groups
+    reads = []
+
+    def spy(self, row_groups, *args, **kwargs):
+        reads.append(row_groups)
+        return read_row_groups(self, row_groups, *args, **kwargs)
+
+    monkeypatch.setattr(pq.ParquetFile, "read_row_groups", spy)
+    session_groups = features["session_group"].iloc[[5, 50]].tolist()
+    result = read_features(path, session_groups)
+
+    expected = features[features["session_group"].isin(session_groups)]
+    pd.testing.assert_frame_equal(
+        result.sort_values("session_group", ignore_index=True),
+        expected.sort_values("session_group", ignore_index=True),
+        # columns without nulls in the rows read lose their object dtype
+        check_dtype=False,
+    )
+    # one row per session group, so one row group each
+    assert len(reads[0]) == 2
+    assert read_features(path, ["unknown"]).empty
+
+    # a stale sidecar is not used
+    shuffled.to_parquet(path, index=False, row_group_size=20)
+    assert not load_feature_offsets(path)["sorted"]
+    assert len(read_features(path, session_groups)) == len(expected)
+
+
+def test_feature_index_reads_row_groups(tmp_path, monkeypatch):
+    features = add_patient_trends(
+        build_session_features(
+            load_exercise_data(write_exercise_results(tmp_path, 3_000, seed=0).parent)
+        )
+    )
+    path = tmp_path / "features.parquet"
+    write_features(features, path, row_group_rows=20)
+    features = pd.read_parquet(path)
+
+    reads = []
+
+    def read_features_spy(path, session_groups):
+        reads.append(session_groups)
+        return read_features(path, session_groups)
+
+    monkeypatch.setattr(message.data, "read_features", read_features_spy)
+    monkeypatch.setattr(message.data.pd, "read_parquet", None)
+    index = FeatureIndex(path)
+    session_groups = features["session_group"].iloc[[5, 50]].tolist()
+
+    expected = {
+        session_group: features[features["session_group"] == session_group].to_dict(
+            orient="records"
+        )
+        for session_group in session_groups + ["unknown"]
+    }
+    assert repr(index.get_many(session_groups + ["unknown"])) == repr(expected)
+    assert repr(index.get(session_groups[0])) == repr(expected[session_groups[0]])
+    # cache misses are read together, hits are not read again
+    assert reads == [session_groups + ["unknown"]]
+    assert index.session_groups() == features["session_group"].tolist()
+
+
+def test_transform_features_sql(exercise_data_dir, exercise_df):
+    transform_features_sql(data_dir=exercise_data_dir, threads=2)
+    result = pd.read_parquet(exercise_data_dir / "features.parquet")
+    # without pandas metadata, counts without nulls read back as int64
+    expected = add_patient_trends(build_session_features(exercise_df)).astype(
+        {"previous_sessions": "int64", "nok_streak": "int64"}
+    )
+
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_transform_features_sql_fractional_sums(tmp_path, exercise_df):
+    exercise_df["prescribed_repeats"] = exercise_df["prescribed_repeats"].where(
+        exercise_df.index != 0
+    )
+    exercise_df["training_time"] = 60.1
+    exercise_df.to_parquet(tmp_path / "exercise_results.parquet")
+
+    transform_features_sql(data_dir=tmp_path)
+    result = pd.read_parquet(tmp_path / "features.parquet")
+    expected = transform_features_py(data_dir=tmp_path)
+
+    assert result["training_time"].tolist() == pytest.approx([240.4, 180.3, 120.2])
+    assert features_match(expected, result)
+
+
+def test_transform_features_arrow(exercise_data_dir, exercise_df):
+    table = transform_features_arrow(data_dir=exercise_data_dir)
+    result = pd.read_parquet(exercise_data_dir / "features.parquet")
+    expected = add_patient_trends(build_session_features(exercise_df)).astype(
+        {"previous_sessions": "int64", "nok_streak": "int64"}
+    )
+
+    assert pa.types.is_dictionary(table.schema.field("therapy_name").type)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_engine_trends_match(tmp_path):
+    data_dir = write_exercise_results(tmp_path, 5_000, seed=0).parent
+    expected = transform_features_py(data_dir=data_dir)
+
+    transform_features_sql(data_dir=data_dir)
+    assert features_match(expected, pd.read_parquet(data_dir / "features.parquet"))
+    transform_features_arrow(data_dir=data_dir)
+    assert features_match(expected, pd.read_parquet(data_dir / "features.parquet"))
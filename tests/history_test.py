@@ -0,0 +1,53 @@
+from message.history import compact_history, count_tokens
+
+BASE = {"role": "system", "content": "base " * 100}
+
+
+def feedback_round(i: int) -> list[dict[str, str]]:
+    return [
+        {"role": "system", "content": f"feedback guidelines {i} " * 20},
+        {"role": "user", "content": f"extra feedback {i}"},
+    ]
+
+
+def fold(messages):
+    return {"role": "system", "content": f"folded {len(messages)}"}
+
+
+def test_count_tokens():
+    assert count_tokens([]) == 0
+    assert count_tokens([{"role": "user", "content": "x" * 40}]) == 14
+
+
+def test_compact_history_within_budget():
+    messages = [BASE, *feedback_round(1), *feedback_round(2)]
+
+    assert compact_history(messages, 10_000, fold) is messages
+
+
+def test_compact_history_folds_older_rounds():
+    draft = {"role": "assistant", "content": "latest draft"}
+    messages = [
+        BASE,
+        *feedback_round(1),
+        {"role": "assistant", "content": "old draft"},
+        *feedback_round(2),
+        draft,
+        *feedback_round(3),
+    ]
+
+    compacted = compact_history(messages, 200, fold)
+
+    assert compacted == [
+        BASE,
+        {"role": "system", "content": "folded 4"},
+        draft,
+        *feedback_round(3),
+    ]
+    assert count_tokens(compacted) < count_tokens(messages)
+
+
+def test_compact_history_keeps_a_single_round():
+    messages = [BASE, *feedback_round(1)]
+
+    assert compact_history(messages, 10, fold) == messages
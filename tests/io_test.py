@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+import message.io
+from message.io import ChatJournal, chat_file, load_chat_history
+
+
+def messages(n: int, prefix: str = "message") -> list[dict[str, str]]:
+    return [{"role": "user", "content": f"{prefix} {i}"} for i in range(n)]
+
+
+@pytest.fixture(autouse=True)
+def chats_dir(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+
+
+def test_load_chat_history_without_journal():
+    assert load_chat_history("missing") == []
+    assert not chat_file("missing").exists()
+
+
+def test_journal_appends_and_replays():
+    async def run():
+        journal = ChatJournal("chat")
+        for chat_message in messages(3):
+            journal.append(chat_message)
+        await journal.flush()
+        flushed = load_chat_history("chat")
+        journal.append({"role": "assistant", "content": "done"})
+        await journal.close()
+        return flushed
+
+    assert asyncio.run(run()) == messages(3)
+    assert load_chat_history("chat") == [
+        *messages(3),
+        {"role": "assistant", "content": "done"},
+    ]
+
+
+def test_journal_recovers_cut_off_line():
+    chat_file("chat").parent.mkdir()
+    chat_file("chat").write_text(
+        '{"role": "user", "content": "kept"}\n{"role": "user", "cont'
+    )
+    assert load_chat_history("chat") == [{"role": "user", "content": "kept"}]
+
+    async def run():
+        journal = ChatJournal("chat")
+        journal.append({"role": "user", "content": "appended"})
+        await journal.close()
+
+    asyncio.run(run())
+
+    assert load_chat_history("chat") == [
+        {"role": "user", "content": "kept"},
+        {"role": "user", "content": "appended"},
+    ]
+
+
+def test_journal_batches_fsyncs(monkeypatch):
+    fsyncs = []
+    monkeypatch.setattr(message.io.os, "fsync", fsyncs.append)
+
+    async def run():
+        journals = [
+            ChatJournal(f"chat-{i}", fsync="batch", fsync_interval=60)
+            for i in range(20)
+        ]
+        for chat_message in messages(50):
+            for journal in journals:
+                journal.append(chat_message)
+        await asyncio.gather(*[journal.close() for journal in journals])
+
+    asyncio.run(run())
+
+    for i in range(20):
+        assert load_chat_history(f"chat-{i}") == messages(50)
+    # one fsync per journal, when it is closed
+    assert len(fsyncs) == 20
+
+
+def test_journal_never_fsyncs(monkeypatch):
+    fsyncs = []
+    monkeypatch.setattr(message.io.os, "fsync", fsyncs.append)
+
+    async def run():
+        journal = ChatJournal("chat", fsync="never")
+        journal.append(messages(1)[0])
+        await journal.close()
+
+    asyncio.run(run())
+
+    assert load_chat_history("chat") == messages(1)
+    assert fsyncs == []
+
+
+def test_journal_errors_resolve_waiters():
+    class FailingFile:
+        def __init__(self, file):
+            self.file = file
+
+        def close(self):
+            self.file.close()
+            raise OSError("disk gone")
+
+    def failing_callback(error):
+        raise RuntimeError("Event loop is closed")
+
+    async def run():
+        journal = ChatJournal("chat", fsync="never")
+        journal.append(messages(1)[0])
+        await journal.flush()
+        journal._file = FailingFile(journal._file)
+        # a callback to a closed event loop does not stop the writer thread
+        message.io._journal_writer.submit("flush", journal, failing_callback)
+        with pytest.raises(OSError, match="disk gone"):
+            await asyncio.wait_for(journal.close(), 5)
+
+        other = ChatJournal("other", fsync="never")
+        other.append(messages(1)[0])
+        await asyncio.wait_for(other.close(), 5)
+
+    asyncio.run(run())
+
+    assert load_chat_history("other") == messages(1)
+
+
+def test_journal_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        ChatJournal("chat", fsync="sometimes")
@@ -0,0 +1,103 @@
+import asyncio
+import json
+
+from stubs import ChatCompletionsStub
+
+from message.data import transform_features_py
+from message.metrics import Metrics, get_metrics, peak_rss_mb
+from message.model import ChatModel
+from message.synthetic import write_exercise_results
+
+STAGES = [
+    "load_exercise_data",
+    "aggregate_session_data",
+    "add_reason_counts",
+    "identify_most_incorrect_exercise",
+    "identify_first_exercise_skipped",
+    "calculate_performance_metrics",
+    "order_columns",
+    "build_session_features",
+    "add_patient_trends",
+]
+
+
+def test_stages_and_export(tmp_path):
+    metrics = Metrics()
+    with metrics.stage("outer", rows_in=10) as outer:
+        with metrics.stage("inner", rows_in=10) as inner:
+            inner["rows_out"] = 5
+        outer["rows_out"] = 2
+    # an enclosing stage includes the peak of its nested stages
+    assert outer["peak_rss_mb"] >= inner["peak_rss_mb"] > 0
+    with metrics.stage("inner", rows_in=4):
+        pass
+    metrics.inc("requests_total", status="ok")
+    metrics.inc("requests_total", 2, status="ok")
+    for seconds in [0.01, 0.3, 100]:
+        metrics.observe("request_seconds", seconds, model='gpt "4"')
+
+    prom_file, json_file = metrics.export(tmp_path, "run")
+
+    stages = json.loads(json_file.read_text())["stages"]
+    assert stages["inner"]["calls"] == 2
+    assert stages["inner"]["rows_in"] == 14
+    assert stages["outer"]["rows_out"] == 2
+    prom = prom_file.read_text()
+    assert 'message_stage_rows_out{stage="inner"} 5' in prom
+    assert 'message_requests_total{status="ok"} 3' in prom
+    assert 'message_request_seconds_bucket{le="0.5",model="gpt \\"4\\""} 2' in prom
+    assert 'message_request_seconds_bucket{le="+Inf",model="gpt \\"4\\""} 3' in prom
+    assert 'message_request_seconds_count{model="gpt \\"4\\""} 3' in prom
+
+
+def test_stages_keep_the_process_peak():
+    metrics = Metrics()
+    data = b"x" * (64 * 1024**2)
+    peak = peak_rss_mb()
+    del data
+
+    with metrics.stage("after_peak") as record:
+        pass
+
+    # the stage is past the peak, which it does not reset
+    assert record["peak_rss_mb"] < peak - 32
+    assert peak_rss_mb() > peak - 32
+
+
+def test_transform_stages(tmp_path):
+    write_exercise_results(tmp_path, 5_000, seed=0)
+    get_metrics().clear()
+
+    features = transform_features_py(tmp_path)
+
+    stages = get_metrics().stages
+    assert list(stages) == STAGES
+    assert stages["build_session_features"]["rows_out"] == len(features)
+    assert stages["order_columns"]["rows_out"] == len(features)
+    assert stages["aggregate_session_data"]["rows_in"] >= 5_000
+
+
+def test_chat_model_metrics(settings_env):
+    async def run():
+        async with (
+            ChatCompletionsStub(reply="Hello there") as stub,
+            ChatModel(api_base=stub.api_base) as model,
+        ):
+            messages = [{"role": "user", "content": "Hi"}]
+            await model.aget_completion(model="gpt-4o-mini", messages=messages)
+            stream = model.astream_completion(model="gpt-4o-mini", messages=messages)
+            assert [token async for token in stream] == ["Hello", " there"]
+
+    get_metrics().clear()
+    asyncio.run(run())
+
+    counters = {
+        (counter["name"], tuple(sorted(counter["labels"].items()))): counter["value"]
+        for counter in get_metrics().to_dict()["counters"]
+    }
+    labels = (("model", "gpt-4o-mini"), ("status", "ok"))
+    assert counters[("llm_requests_total", (*labels, ("stream", "false")))] == 1
+    assert counters[("llm_requests_total", (*labels, ("stream", "true")))] == 1
+    histograms = {h["name"]: h for h in get_metrics().to_dict()["histograms"]}
+    assert histograms["llm_first_token_seconds"]["count"] == 1
+    assert histograms["llm_queue_seconds"]["count"] == 2
@@ -0,0 +1,120 @@
+import asyncio
+
+import openai
+import pytest
+from stubs import ChatCompletionsStub
+
+from message.cache import ResponseCache
+from message.model import ChatModel
+
+MESSAGES = [{"role": "user", "content": "Hello!"}]
+
+
+def test_aget_completion_reuses_connections(settings_env):
+    async def run():
+        async with (
+            ChatCompletionsStub() as stub,
+            ChatModel(api_base=stub.api_base) as model,
+        ):
+            replies = [
+                await model.aget_completion(model="gpt-4o-mini", messages=MESSAGES)
+                for _ in range(3)
+            ]
+        return stub, replies
+
+    stub, replies = asyncio.run(run())
+
+    assert replies == ["Great session!"] * 3
+    assert stub.requests[0]["messages"] == MESSAGES
+    assert len(stub.peers) == 1
+
+
+def test_aget_completion_concurrency_limit(settings_env):
+    async def run():
+        async with (
+            ChatCompletionsStub(delay=0.05) as stub,
+            ChatModel(api_base=stub.api_base, max_concurrency=3) as model,
+        ):
+            await asyncio.gather(
+                *[
+                    model.aget_completion(model="gpt-4o-mini", messages=MESSAGES)
+                    for _ in range(10)
+                ]
+            )
+        return stub
+
+    stub = asyncio.run(run())
+
+    assert len(stub.requests) == 10
+    assert stub.max_in_flight == 3
+    assert len(stub.peers) <= 3
+
+
+def test_aget_completion_timeout(settings_env):
+    async def run():
+        async with (
+            ChatCompletionsStub(delay=1.0) as stub,
+            ChatModel(api_base=stub.api_base, timeout=0.1) as model,
+        ):
+            await model.aget_completion(model="gpt-4o-mini", messages=MESSAGES)
+
+    with pytest.raises(openai.error.Timeout):
+        asyncio.run(run())
+
+
+def test_astream_completion(settings_env):
+    async def run():
+        async with (
+            ChatCompletionsStub(reply="You did great today") as stub,
+            ChatModel(api_base=stub.api_base) as model,
+        ):
+            tokens = [
+                token
+                async for token in model.astream_completion(
+                    model="gpt-4o-mini", messages=MESSAGES
+                )
+            ]
+        return stub, tokens
+
+    stub, tokens = asyncio.run(run())
+
+    assert tokens == ["You", " did", " great", " today"]
+    assert stub.requests[0]["stream"] is True
+
+
+def test_completions_are_cached(settings_env, tmp_path):
+    cache = ResponseCache(tmp_path, max_bytes=2**20, max_age=60)
+
+    async def run():
+        async with (
+            ChatCompletionsStub() as stub,
+            ChatModel(api_base=stub.api_base, cache=cache) as model,
+        ):
+            replies = [
+                await model.aget_completion(model="gpt-4o-mini", messages=MESSAGES),
+                await model.aget_completion(model="gpt-4o-mini", messages=MESSAGES),
+                "".join(
+                    [
+                        token
+                        async for token in model.astream_completion(
+                            model="gpt-4o-mini", messages=MESSAGES
+                        )
+                    ]
+                ),
+                await model.aget_completion(
+                    model="gpt-4o-mini", messages=MESSAGES, bypass_cache=True
+                ),
+            ]
+        return stub, replies, model
+
+    stub, replies, model = asyncio.run(run())
+
+    assert replies == ["Great session!"] * 4
+    assert len(stub.requests) == 2
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert [count["cached"] for count in model.token_counts] == [
+        False,
+        True,
+        True,
+        False,
+    ]
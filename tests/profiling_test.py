@@ -0,0 +1,57 @@
+import json
+
+from typer.testing import CliRunner
+
+from message.data import transform_features_py
+from message.main import app
+from message.metrics import Metrics
+from message.profiling import STAGE_PREFIX, Profiler
+from message.synthetic import write_exercise_results
+
+
+def test_profile_is_attributed_to_stages(tmp_path, monkeypatch):
+    write_exercise_results(tmp_path, 20_000, seed=0)
+    metrics = Metrics()
+    monkeypatch.setattr("message.data.stage", metrics.stage)
+    monkeypatch.setattr("message.transform.stage", metrics.stage)
+    profiler = Profiler(metrics, interval=0.001)
+
+    profiler.start()
+    transform_features_py(tmp_path)
+    profiler.stop()
+    prof_file, collapsed_file, summary_file = profiler.write(tmp_path, "transform")
+
+    assert not metrics.stage_hooks
+    summary = json.loads(summary_file.read_text())
+    stages = summary["stages"]
+    assert set(stages) == set(metrics.stages)
+    build = stages["build_session_features"]
+    assert build["samples"] > 0
+    assert build["samples"] >= stages["aggregate_session_data"]["samples"]
+    assert build["peak_traced_mb"] >= stages["aggregate_session_data"]["peak_traced_mb"]
+    assert summary["peak_traced_mb"] >= build["peak_traced_mb"] > 0
+    assert stages["load_exercise_data"]["allocations"]
+    assert any("transform_features_py" in f["function"] for f in summary["functions"])
+
+    stacks = collapsed_file.read_text().splitlines()
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in stacks) == summary["samples"]
+    assert any(
+        line.startswith(f"{STAGE_PREFIX}build_session_features;") for line in stacks
+    )
+    assert prof_file.stat().st_size > 0
+
+
+def test_cli_profile_option(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHAT_STORE_PATH", str(tmp_path / "chats.sqlite"))
+    monkeypatch.setenv("METRICS_DIR", str(tmp_path / "metrics"))
+    from message.config import get_settings
+
+    get_settings.cache_clear()
+    try:
+        result = CliRunner().invoke(app, ["--profile", "find-chats"])
+    finally:
+        get_settings.cache_clear()
+
+    assert result.exit_code == 0, result.output
+    for suffix in ["prof", "collapsed", "profile.json"]:
+        assert (tmp_path / "metrics" / f"find-chats.{suffix}").exists()
@@ -0,0 +1,44 @@
+from pathlib import Path
+
+import pytest
+
+from message.benchmark import (
+    baseline_file,
+    compare_to_baseline,
+    format_comparison,
+    load_baseline,
+    run_regression_benchmark,
+    save_report,
+)
+from message.config import BASE_DIR, get_settings
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture(scope="session")
+def regression_report():
+    # the fixed-seed datasets are kept across runs
+    return run_regression_benchmark(Path(BASE_DIR, ".benchmarks", "regression"))
+
+
+def test_no_performance_regression(request, regression_report):
+    settings = get_settings()
+    path = baseline_file(settings.BENCHMARK_BASELINES_DIR)
+    baseline = load_baseline(path)
+    if baseline is None or request.config.getoption("--update-baselines"):
+        errors = [result for result in regression_report["results"] if result["error"]]
+        assert not errors, errors
+        path.parent.mkdir(parents=True, exist_ok=True)
+        save_report(regression_report, path)
+        pytest.skip(f"baseline recorded to {path}")
+
+    comparison = compare_to_baseline(
+        regression_report,
+        baseline,
+        time_tolerance=settings.BENCHMARK_TIME_TOLERANCE,
+        memory_tolerance=settings.BENCHMARK_MEMORY_TOLERANCE,
+    )
+    failed = [row for row in comparison if row["status"] in ["regression", "error"]]
+    assert not failed, (
+        f"performance regressed against {path}:\n{format_comparison(comparison)}"
+    )
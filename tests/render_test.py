@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+from message.data import get_features, get_session_groups
+from message.render import render_features, render_session, rendering_savings
+
+SESSION = {
+    "session_group": "group",
+    "patient_id": "patient",
+    "patient_name": "Ann",
+    "patient_age": np.int64(44),
+    "pain": 2.0,
+    "quality": 3.0,
+    "quality_reason_other": 1,
+    "quality_reason_tablet": 0,
+    "session_is_nok": np.bool_(False),
+    "leave_session": None,
+    "leave_exercise_pain": 0.0,
+    "leave_exercise_tired": 2.0,
+    "perc_correct_repeats": 0.9859154929577465,
+    "training_time": float("nan"),
+    "nok_streak": pd.NA,
+}
+
+
+def test_render_session():
+    assert render_session(SESSION) == (
+        "patient_name: Ann\n"
+        "patient_age: 44\n"
+        "pain: 2\n"
+        "quality: 3\n"
+        "quality_reasons: other\n"
+        "session_is_nok: false\n"
+        "leave_exercise: tired 2\n"
+        "perc_correct_repeats: 0.99"
+    )
+
+
+def test_render_session_is_stable():
+    shuffled = dict(reversed(list(SESSION.items())))
+
+    assert render_session(shuffled) == render_session(SESSION)
+
+
+def test_render_session_drops_unset_flag_groups():
+    session = {**SESSION, "quality_reason_other": 0, "leave_exercise_tired": 0.0}
+
+    rendered = render_session(session)
+
+    assert "quality_reasons" not in rendered
+    assert "leave_exercise" not in rendered
+
+
+def test_rendering_saves_tokens():
+    features = [get_features(group) for group in get_session_groups()[:100]]
+
+    savings = rendering_savings(features)
+
+    assert savings["compact_tokens"] < savings["repr_tokens"] / 2
+    assert render_features(features[0]).startswith("patient_name: ")
@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from stubs import ChatCompletionsStub
+
+from message.data import get_session_groups
+from message.io import chat_file, load_chat_history
+from message.model import ChatModel
+from message.store import ChatStore
+
+
+def reply(request: dict) -> str:
+    if any("**Category: Tone**" in m["content"] for m in request["messages"]):
+        return "Tone revision"
+
+    return "Draft"
+
+
+@pytest.fixture
+def serve(settings_env, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    import message.serve
+
+    return message.serve
+
+
+def run_service(serve, tmp_path, scenario, idle_timeout=None, **stub_kwargs):
+    async def run():
+        async with (
+            ChatCompletionsStub(reply=reply, **stub_kwargs) as stub,
+            ChatModel(api_base=stub.api_base) as model,
+        ):
+            store = ChatStore(tmp_path / "chats.sqlite")
+            service = serve.ReviewService(
+                chat_model=model, store=store, idle_timeout=idle_timeout
+            )
+            async with TestClient(TestServer(serve.create_app(service))) as client:
+                return await scenario(client), stub, store
+
+    return asyncio.run(run())
+
+
+def test_review_flow(serve, tmp_path):
+    session_group = get_session_groups()[0]
+
+    async def scenario(client):
+        response = await client.post("/chats", json={"session_group": session_group})
+        assert response.status == 201
+        chat = await response.json()
+        assert chat["draft"] == "Draft"
+
+        url = f"/chats/{chat['chat_id']}"
+        assert (await (await client.get(url)).json())["status"] == "review"
+        response = await client.post(
+            f"{url}/actions",
+            json={"action": "edit", "category": "tone", "feedback": "Warmer"},
+        )
+        assert (await response.json())["draft"] == "Tone revision"
+
+        response = await client.post(f"{url}/actions", json={"action": "accept"})
+        finished = await response.json()
+        assert finished["status"] == "finished"
+
+        response = await client.post(f"{url}/actions", json={"action": "accept"})
+        assert response.status == 404
+
+        return finished, await (await client.get(url)).json()
+
+    (finished, fetched), _, store = run_service(serve, tmp_path, scenario)
+
+    assert fetched == finished
+    assert fetched["outcome"] == "accept"
+    assert fetched["messages"][-1] == {"role": "assistant", "content": "Tone revision"}
+    assert not chat_file(fetched["chat_id"]).exists()
+    [stored] = store.find_chats(category="tone")
+    assert stored["session_group"] == session_group
+
+
+def test_concurrent_reviews(serve, tmp_path):
+    session_groups = get_session_groups()[:10]
+
+    async def scenario(client):
+        async def review(session_group: str) -> dict:
+            response = await client.post(
+                "/chats", json={"session_group": session_group}
+            )
+            chat = await response.json()
+            response = await client.post(
+                f"/chats/{chat['chat_id']}/actions",
+                json={"action": "reject", "message": f"Hi {session_group}"},
+            )
+            return await response.json()
+
+        return await asyncio.gather(*[review(group) for group in session_groups])
+
+    chats, stub, store = run_service(serve, tmp_path, scenario, delay=0.2)
+
+    assert [chat["messages"][-1]["content"] for chat in chats] == [
+        f"Hi {group}" for group in session_groups
+    ]
+    # the drafts were requested concurrently
+    assert stub.max_in_flight > 1
+    assert len(store.find_chats(outcome="reject")) == len(session_groups)
+
+
+def test_invalid_requests(serve, tmp_path):
+    session_group = get_session_groups()[0]
+
+    async def scenario(client):
+        unknown = await client.post("/chats", json={"session_group": "unknown"})
+        chat = await (
+            await client.post("/chats", json={"session_group": session_group})
+        ).json()
+        url = f"/chats/{chat['chat_id']}/actions"
+        invalid = [
+            await client.post(url, json={"action": "approve"}),
+            await client.post(url, json={"action": "edit", "category": "style"}),
+            await client.post(url, json={"action": "reject"}),
+            await client.post(url, data="not json"),
+        ]
+        missing = await client.get("/chats/missing")
+        return unknown.status, [response.status for response in invalid], missing.status
+
+    (unknown, invalid, missing), _, _ = run_service(serve, tmp_path, scenario)
+
+    assert unknown == 404
+    assert invalid == [400, 400, 400, 400]
+    assert missing == 404
+
+
+def test_idle_chats_are_evicted(serve, tmp_path):
+    session_group = get_session_groups()[0]
+
+    async def scenario(client):
+        chat = await (
+            await client.post("/chats", json={"session_group": session_group})
+        ).json()
+        await asyncio.sleep(0.5)
+        response = await client.get(f"/chats/{chat['chat_id']}")
+        return chat, response.status
+
+    (chat, status), _, store = run_service(serve, tmp_path, scenario, idle_timeout=0.1)
+
+    assert status == 404
+    assert store.get_messages(chat["chat_id"]) is None
+    # the journal is closed, the chat stays resumable
+    assert load_chat_history(chat["chat_id"]) == chat["messages"]
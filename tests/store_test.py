@@ -0,0 +1,95 @@
+import json
+
+import pyarrow.parquet as pq
+import pytest
+
+from message.store import ChatStore, import_chat_files
+
+
+def chat_messages(n_edits: int, last: str = "Message") -> list[dict[str, str]]:
+    messages = [{"role": "system", "content": "Write a message."}]
+    for i in range(n_edits):
+        messages.append({"role": "system", "content": f"Revise {i}"})
+    messages.append({"role": "assistant", "content": last})
+    return messages
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ChatStore(tmp_path / "chats.sqlite")
+    store.save_chat("a", "g1", chat_messages(1), "accept", [("tone", "")], 1.0)
+    store.save_chat(
+        "b", "g1", chat_messages(2), "reject", [("tone", "x"), ("generic", "")], 2.0
+    )
+    store.save_chat("c", "g2", chat_messages(0), "accept", [], 3.0)
+    return store
+
+
+def ids(chats: list[dict]) -> list[str]:
+    return [chat["chat_id"] for chat in chats]
+
+
+def test_find_chats(store):
+    assert ids(store.find_chats()) == ["a", "b", "c"]
+    assert ids(store.find_chats(session_group="g1")) == ["a", "b"]
+    assert ids(store.find_chats(outcome="accept")) == ["a", "c"]
+    assert ids(store.find_chats(category="tone")) == ["a", "b"]
+    assert ids(store.find_chats(session_group="g1", category="generic")) == ["b"]
+    assert store.find_chats(session_group="g3") == []
+
+
+def test_save_chat_replaces_chat(store):
+    store.save_chat("a", "g1", chat_messages(0, "Rewritten"), "reject", [], 4.0)
+
+    assert store.get_messages("a") == chat_messages(0, "Rewritten")
+    assert ids(store.find_chats(category="tone")) == ["b"]
+    assert store.get_messages("missing") is None
+
+
+def test_feedback_stats(store):
+    assert store.feedback_stats() == [
+        {"category": "tone", "rounds": 2, "chats": 2, "reject_rate": 0.5},
+        {"category": "generic", "rounds": 1, "chats": 1, "reject_rate": 1.0},
+    ]
+
+
+def test_export_parquet(store, tmp_path):
+    paths = store.export_parquet(tmp_path / "export")
+
+    tables = {path.stem: pq.read_table(path) for path in paths}
+    assert tables["chats"].num_rows == 3
+    assert tables["messages"].num_rows == sum(len(chat_messages(n)) for n in range(3))
+    assert tables["feedback"].column("category").to_pylist() == [
+        "tone",
+        "tone",
+        "generic",
+    ]
+
+
+def test_import_chat_files(tmp_path):
+    chats_dir = tmp_path / "chats"
+    chats_dir.mkdir()
+    chats = {
+        "old": chat_messages(1),
+        "other": chat_messages(0),
+        # in progress, waiting for the draft
+        "open": chat_messages(1)[:-1],
+    }
+    for chat_id, messages in chats.items():
+        with open(chats_dir / f"{chat_id}.jsonl", "w") as f:
+            f.writelines(json.dumps(message) + "\n" for message in messages)
+    store = ChatStore(tmp_path / "chats.sqlite")
+
+    def parse_feedback(messages):
+        return [("tone", "") for message in messages if "Revise" in message["content"]]
+
+    assert import_chat_files(store, chats_dir, parse_feedback) == 2
+    # imported chats are skipped on the next import
+    assert import_chat_files(store, chats_dir, parse_feedback) == 0
+
+    assert store.get_messages("old") == chat_messages(1)
+    assert store.get_messages("open") is None
+    [chat] = store.find_chats(category="tone")
+    assert chat["chat_id"] == "old"
+    assert chat["session_group"] is None
+    assert chat["outcome"] is None
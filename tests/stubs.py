@@ -0,0 +1,108 @@
+import asyncio
+import json
+from typing import Self
+
+from aiohttp import web
+
+
+class ChatCompletionsStub:
+    """Local server that mimics the chat completions endpoint.
+
+    Replies with ``reply``, or ``reply(request)`` if it is callable, after
+    ``delay`` seconds and records the requests,
+    the client connections and the peak number of requests in flight.
+    Streamed replies are sent one word per chunk, ``token_delay`` seconds
+    apart.
+    """
+
+    def __init__(
+        self,
+        reply="Great session!",
+        delay: float = 0.0,
+        token_delay: float = 0.0,
+    ):
+        self.reply = reply
+        self.delay = delay
+        self.token_delay = token_delay
+        self.chunks_sent = 0
+        self.requests = []
+        self.peers = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.api_base = None
+        self._runner = None
+
+    def reply_to(self, request: dict) -> str:
+        return self.reply(request) if callable(self.reply) else self.reply
+
+    async def handle(self, request):
+        body = await request.json()
+        self.requests.append(body)
+        self.peers.add(request.transport.get_extra_info("peername"))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if body.get("stream"):
+                return await self.stream(request, body)
+        finally:
+            self.in_flight -= 1
+
+        return web.json_response(
+            {
+                "id": f"chatcmpl-{len(self.requests)}",
+                "object": "chat.completion",
+                "created": 0,
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": self.reply_to(body),
+                        },
+                        "finish_reason": "stop",
+                    }
+                ],
+            }
+        )
+
+    async def stream(self, request, body: dict):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        reply = self.reply_to(body)
+        for i, token in enumerate(reply.split(" ")):
+            chunk = {
+                "id": f"chatcmpl-{len(self.requests)}",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": token if i == 0 else f" {token}"},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.chunks_sent += 1
+            await asyncio.sleep(self.token_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+
+        return response
+
+    async def __aenter__(self) -> Self:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.api_base = f"http://127.0.0.1:{port}/v1"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._runner.cleanup()
@@ -0,0 +1,94 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from message.transform import (
+    DICTIONARY_COLUMNS,
+    add_reason_counts,
+    aggregate_session_data,
+    aggregate_session_partials,
+    build_session_features,
+    build_session_features_arrow,
+    calculate_performance_metrics,
+    finalize_session_partials,
+    identify_first_exercise_skipped,
+    identify_most_incorrect_exercise,
+    merge_session_partials,
+    order_columns,
+)
+
+
+def transform_legacy(df):
+    grouped = aggregate_session_data(df)
+    grouped = calculate_performance_metrics(grouped)
+    grouped = add_reason_counts(df, grouped)
+    grouped = identify_first_exercise_skipped(df, grouped)
+    grouped = identify_most_incorrect_exercise(df, grouped)
+    return order_columns(grouped)
+
+
+def test_build_session_features_matches_legacy(exercise_df):
+    expected = transform_legacy(exercise_df.copy()).reset_index(drop=True)
+    result = build_session_features(exercise_df)
+
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_build_session_features_does_not_mutate_input(exercise_df):
+    before = exercise_df.copy()
+    build_session_features(exercise_df)
+
+    pd.testing.assert_frame_equal(exercise_df, before)
+
+
+def test_build_session_features_segment_reductions(exercise_df):
+    result = build_session_features(exercise_df).set_index("session_group")
+
+    assert result.loc["a", "first_exercise_skipped"] == "plank"
+    assert result.loc["b", "first_exercise_skipped"] == "bridge"
+    assert pd.isna(result.loc["c", "first_exercise_skipped"])
+    # tie between bridge and plank is resolved alphabetically
+    assert result.loc["a", "exercise_with_most_incorrect"] == "bridge"
+    assert result.loc["b", "number_exercises"] == 2
+    assert result.loc["a", "leave_exercise_pain"] == 2
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 2, 4])
+def test_merged_session_partials_match_single_pass(exercise_df, chunk_rows):
+    partials = [
+        aggregate_session_partials(exercise_df.iloc[start : start + chunk_rows])
+        for start in range(0, len(exercise_df), chunk_rows)
+    ]
+    merged = merge_session_partials(partials[:2])
+    merged = merge_session_partials([merged] + partials[2:])
+
+    pd.testing.assert_frame_equal(
+        finalize_session_partials(merged), build_session_features(exercise_df)
+    )
+
+
+@pytest.mark.parametrize("dictionary", [True, False])
+def test_build_session_features_arrow_matches_pandas(exercise_df, dictionary):
+    table = pa.Table.from_pandas(exercise_df, preserve_index=False)
+    if dictionary:
+        for column in DICTIONARY_COLUMNS:
+            i = table.schema.get_field_index(column)
+            table = table.set_column(i, column, table[column].dictionary_encode())
+
+    result = build_session_features_arrow(table)
+    # dictionaries decode to plain strings; missing strings come back as None
+    result = result.cast(
+        pa.schema(
+            [
+                field.with_type(field.type.value_type)
+                if pa.types.is_dictionary(field.type)
+                else field
+                for field in result.schema
+            ]
+        )
+    ).to_pandas()
+    expected = build_session_features(exercise_df)
+    for column in ["exercise_with_most_incorrect", "first_exercise_skipped"]:
+        expected[column] = expected[column].where(expected[column].notnull(), None)
+
+    pd.testing.assert_frame_equal(result, expected)
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from message.io import load_exercise_data
+from message.synthetic import write_exercise_results
+from message.transform import LEAVE_EXERCISE_REASONS, build_session_features
+from message.trends import (
+    TREND_COLUMNS,
+    add_patient_trends,
+    stale_patients,
+    update_patient_trends,
+)
+
+
+def sessions(patient_ids, session_numbers, pains, noks):
+    return pd.DataFrame(
+        {
+            "session_group": [f"g{i}" for i in range(len(patient_ids))],
+            "patient_id": patient_ids,
+            "session_number": session_numbers,
+            "pain": pains,
+            "fatigue": 0.0,
+            "perc_correct_repeats": 1.0,
+            "number_exercises": 4,
+            "session_is_nok": noks,
+            **{f"leave_exercise_{reason}": 0.0 for reason in LEAVE_EXERCISE_REASONS},
+        }
+    )
+
+
+def test_patient_trends():
+    features = sessions(
+        ["p", "q", "p", "p", None, "p"],
+        [1, 1, 2, 3, 1, 4],
+        [2.0, 5.0, 4.0, np.nan, 1.0, 9.0],
+        [True, False, True, False, True, True],
+    )
+
+    trends, state = update_patient_trends(features)
+
+    assert trends.index.equals(features.index)
+    assert list(trends.columns) == TREND_COLUMNS
+    p = trends[features["patient_id"] == "p"]
+    assert p["previous_sessions"].tolist() == [0, 1, 2, 3]
+    assert p["nok_streak"].tolist() == [1, 2, 0, 1]
+    np.testing.assert_array_equal(p["pain_delta"], [np.nan, 2.0, np.nan, np.nan])
+    # missing values are left out of the averages
+    assert p["pain_avg"].tolist() == [2.0, 3.0, 3.0, 6.5]
+    assert trends.loc[4, "previous_sessions"] is pd.NA
+    assert trends["skip_rate"].eq(0).all()
+    # the state keeps the last sessions of each patient
+    assert state.groupby("patient_id")["session_number"].apply(list).to_dict() == {
+        "p": [3, 4],
+        "q": [1],
+    }
+
+
+def test_update_patient_trends_matches_full(tmp_path):
+    features = build_session_features(
+        load_exercise_data(write_exercise_results(tmp_path, 5_000, seed=0).parent)
+    )
+    expected = add_patient_trends(features)[TREND_COLUMNS]
+
+    state = None
+    chunks = []
+    for low, high in [(0, 10), (10, 20), (20, 40), (40, np.inf)]:
+        chunk = features[features["session_number"].between(low, high - 1)]
+        trends, state = update_patient_trends(chunk, state)
+        chunks.append(trends)
+
+    pd.testing.assert_frame_equal(pd.concat(chunks).loc[expected.index], expected)
+
+
+def test_stale_patients():
+    features = sessions(["p", "p", "q"], [1, 2, 1], [1.0, 2.0, 3.0], False)
+    _, state = update_patient_trends(features)
+    new = sessions(["p", "q", "r"], [2, 2, 1], [1.0, 2.0, 3.0], False)
+
+    assert stale_patients(state, new) == {"p"}
+    with pytest.raises(ValueError):
+        update_patient_trends(new, state)